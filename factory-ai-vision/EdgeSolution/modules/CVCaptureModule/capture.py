@@ -0,0 +1,201 @@
+"""Capture.
+
+Camera / video capture with a selectable decode backend:
+    ffmpeg:    OpenCV FFmpeg backend, FFMPEG_THREADS decode threads.
+    gstreamer: GSTREAMER_PIPELINE, scaling to the send resolution inside
+               the pipeline so full-resolution frames never reach Python.
+    vaapi:     FFmpeg with VAAPI hardware decode, falls back to ffmpeg when
+               OpenCV or the device does not support it.
+
+Frames are grabbed continuously and only retrieved (converted to BGR and
+resized) when they are going to be sent.
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+IMG_WIDTH = 960
+IMG_HEIGHT = 540
+
+DECODE_BACKEND = os.environ.get("DECODE_BACKEND", "ffmpeg")
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", "0"))  # 0: OpenCV default
+# {source}, {width} and {height} are filled in for each camera
+GSTREAMER_PIPELINE = os.environ.get(
+    "GSTREAMER_PIPELINE",
+    "uridecodebin uri={source} ! videoconvert ! videoscale ! "
+    "video/x-raw,format=BGR,width={width},height={height} ! "
+    "appsink drop=true max-buffers=1 sync=false",
+)
+
+
+def get_send_size(width, height):
+    """get_send_size.
+
+    Fit the frame in IMG_WIDTH x IMG_HEIGHT.
+
+    Returns:
+        (width, height, edge), edge is the side that was fitted.
+    """
+    ratio = IMG_WIDTH / width
+    new_height = int(height * ratio + 0.000001)
+    if new_height >= IMG_HEIGHT:
+        ratio = IMG_HEIGHT / height
+        return int(width * ratio + 0.000001), IMG_HEIGHT, "540"
+    return IMG_WIDTH, new_height, "960"
+
+
+def _to_uri(source):
+    if "://" in source:
+        return source
+    return "file://" + os.path.abspath(source)
+
+
+def _open_ffmpeg(source, params):
+    if FFMPEG_THREADS > 0 and hasattr(cv2, "CAP_PROP_N_THREADS"):
+        params = params + [cv2.CAP_PROP_N_THREADS, FFMPEG_THREADS]
+    if params:
+        return cv2.VideoCapture(source, cv2.CAP_FFMPEG, params)
+    return cv2.VideoCapture(source)
+
+
+def open_capture(source, backend=DECODE_BACKEND):
+    """open_capture.
+
+    Returns:
+        (cv2.VideoCapture, name of the backend actually used)
+    """
+    if source == "0":
+        return cv2.VideoCapture(0), "default"
+
+    if backend == "gstreamer":
+        pipeline = GSTREAMER_PIPELINE.format(source=_to_uri(source),
+                                             width=IMG_WIDTH,
+                                             height=IMG_HEIGHT)
+        cam = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+        if cam.isOpened():
+            return cam, "gstreamer"
+        logger.warning("Cannot open GStreamer pipeline %s, fallback to ffmpeg",
+                       pipeline)
+
+    if backend == "vaapi" and hasattr(cv2, "CAP_PROP_HW_ACCELERATION"):
+        cam = _open_ffmpeg(source, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_VAAPI
+        ])
+        if cam.isOpened() and cam.get(cv2.CAP_PROP_HW_ACCELERATION) == \
+                cv2.VIDEO_ACCELERATION_VAAPI:
+            return cam, "vaapi"
+        cam.release()
+        logger.warning("VAAPI decode not available, fallback to ffmpeg")
+
+    return _open_ffmpeg(source, []), "ffmpeg"
+
+
+class FrameCapture:
+    def __init__(self, source, backend=DECODE_BACKEND):
+        self.source = source
+        self.cam, self.backend = open_capture(source, backend)
+        self.is_file = os.path.isfile(source)
+        self.edge = "960"
+        self.grabbed = 0
+        self.retrieved = 0
+
+    def is_opened(self):
+        return self.cam.isOpened()
+
+    def get_fps(self):
+        return self.cam.get(cv2.CAP_PROP_FPS)
+
+    def grab(self):
+        """grab.
+
+        Read the next frame without converting it, cheap enough to call
+        for every frame of the source.
+        """
+        is_ok = self.cam.grab()
+        if is_ok:
+            self.grabbed += 1
+        return is_ok
+
+    def retrieve(self):
+        """retrieve.
+
+        Returns the last grabbed frame fitted in IMG_WIDTH x IMG_HEIGHT, or
+        None.
+        """
+        is_ok, img = self.cam.retrieve()
+        if not is_ok or img is None:
+            return None
+        self.retrieved += 1
+        width, height, self.edge = get_send_size(img.shape[1], img.shape[0])
+        if (width, height) != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, (width, height))
+        return img
+
+    def release(self):
+        self.cam.release()
+
+
+def benchmark(source, cameras=1, seconds=10, fps=0, backend=DECODE_BACKEND):
+    """benchmark.
+
+    Decode the video file with several cameras at once, as fast as
+    possible, and print the decode fps and CPU usage per camera.
+
+    Args:
+        fps: frames retrieved per second per camera, 0 retrieves every frame.
+    """
+    results = [None] * cameras
+
+    def run(i):
+        cap = FrameCapture(source, backend)
+        next_retrieve = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            if not cap.grab():
+                cap.release()
+                cap = FrameCapture(source, backend)
+                continue
+            now = time.time()
+            if fps <= 0 or now >= next_retrieve:
+                cap.retrieve()
+                next_retrieve = now + 1 / fps if fps > 0 else 0
+        results[i] = (cap.backend, cap.grabbed, cap.retrieved)
+        cap.release()
+
+    cpu_start = time.process_time()
+    wall_start = time.time()
+    threads = [
+        threading.Thread(target=run, args=(i,)) for i in range(cameras)
+    ]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    wall = time.time() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    for i, (backend_used, grabbed, retrieved) in enumerate(results):
+        print("camera {}: backend {}, decode {:.1f} fps, retrieve {:.1f} fps".
+              format(i, backend_used, grabbed / wall, retrieved / wall))
+    print("cpu per camera: {:.1f}%".format(cpu / wall / cameras * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture decode benchmark")
+    parser.add_argument("source", help="video file")
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--fps",
+                        type=float,
+                        default=0,
+                        help="retrieved frames per second, 0 for all")
+    parser.add_argument("--backend", default=DECODE_BACKEND)
+    args = parser.parse_args()
+    benchmark(args.source, args.cameras, args.seconds, args.fps, args.backend)
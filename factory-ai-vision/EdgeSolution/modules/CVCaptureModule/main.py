@@ -8,6 +8,7 @@ import requests
 import uvicorn
 from fastapi import FastAPI
 from pydantic import BaseModel
+from rate_controller import MIN_FPS
 from stream_manager import StreamManager
 
 logger = logging.getLogger(__name__)
@@ -21,6 +22,10 @@ class Stream(BaseModel):
     rtsp: str
     fps: float
     endpoint: str
+    # share of the inference endpoint under load, relative to other cameras
+    priority: float = 1.0
+    # rate control never goes below it
+    min_fps: float = MIN_FPS
 
 
 @app.get("/")
@@ -34,6 +39,8 @@ async def index():
                 "cam_id": stream.cam_id,
                 "cam_source": stream.cam_source,
                 "fps": stream.fps,
+                "max_fps": stream.max_fps,
+                "priority": stream.priority,
             }
         )
     return {"number_of_streams": number_of_streams, "infos": infos}
@@ -64,7 +71,8 @@ async def create_stream(stream: Stream):
     if rtsp.startswith(RTSPSIM_PREFIX) and '/upload/' not in rtsp:
         rtsp = "videos" + rtsp.split(RTSPSIM_PREFIX)[1]
     stream_manager.add_stream(stream.stream_id, rtsp,
-                              stream.fps, stream.endpoint)
+                              stream.fps, stream.endpoint, stream.priority,
+                              stream.min_fps)
 
     # FIXME use your stream manager to fix it
 
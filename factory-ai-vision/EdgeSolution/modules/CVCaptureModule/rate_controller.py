@@ -0,0 +1,110 @@
+"""Rate Controller.
+
+Adapts the send rate of every camera to the back-pressure reported by
+InferenceModule (/stream_load) with AIMD: while no stream of an endpoint
+is congested, each camera gains RATE_INCREASE * priority fps per interval
+up to its configured fps; once one is, every camera of the endpoint is
+slowed down by RATE_DECREASE, down to its minimum fps. Cameras end up
+sharing the endpoint in proportion to their priority.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+RATE_CONTROL = os.environ.get("RATE_CONTROL", "true")
+RATE_CONTROL_INTERVAL = float(os.environ.get("RATE_CONTROL_INTERVAL",
+                                             "2"))  # seconds
+MIN_FPS = float(os.environ.get("MIN_FPS", "1"))
+RATE_INCREASE = 0.5  # fps per interval, times the camera priority
+RATE_DECREASE = 0.75
+# above this average inference time (ms) the endpoint is overloaded
+RATE_MAX_LATENCY = float(os.environ.get("RATE_MAX_LATENCY", "1000"))
+
+
+def is_congested(stream, load, last_load):
+    """is_congested.
+
+    Args:
+        stream: CVCaptureModule stream.
+        load: /stream_load entry of the stream, None if not reported.
+        last_load: entry of the previous poll, None on the first one.
+    """
+    # the sender cannot keep up with the frame rate
+    if stream.average_send_time > 1 / stream.fps:
+        return True
+    if load is None:
+        return False
+    if last_load is not None and load["dropped"] > last_load["dropped"]:
+        return True
+    return (load["queue_depth"] > 1 or
+            load["average_inference_time"] > RATE_MAX_LATENCY)
+
+
+class RateController:
+    def __init__(self, get_streams, interval=RATE_CONTROL_INTERVAL):
+        """__init__.
+
+        Args:
+            get_streams: callable returning the current streams.
+            interval (float): seconds between two adjustments.
+        """
+        self.get_streams = get_streams
+        self.interval = interval
+        self.last_loads = {}
+        self.is_alive = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.is_alive = False
+
+    def _run(self):
+        while self.is_alive:
+            time.sleep(self.interval)
+            try:
+                self.update()
+            except Exception:
+                logger.exception("Rate control failed")
+
+    def get_loads(self, endpoint):
+        try:
+            res = requests.get(endpoint + "/stream_load",
+                               timeout=self.interval)
+            res.raise_for_status()
+            return res.json()
+        except Exception as e:
+            logger.debug("Cannot get stream load from %s: %s", endpoint, e)
+            return {}
+
+    def update(self):
+        endpoints = {}
+        for stream in self.get_streams():
+            endpoints.setdefault(stream.endpoint, []).append(stream)
+
+        for endpoint, streams in endpoints.items():
+            loads = self.get_loads(endpoint)
+            congested = False
+            for stream in streams:
+                load = loads.get(stream.cam_id)
+                if is_congested(stream, load,
+                                self.last_loads.get(stream.cam_id)):
+                    congested = True
+                if load is not None:
+                    self.last_loads[stream.cam_id] = load
+
+            for stream in streams:
+                if congested:
+                    fps = stream.fps * RATE_DECREASE
+                else:
+                    fps = stream.fps + RATE_INCREASE * stream.priority
+                stream.set_fps(fps)
+
+        alive_ids = {stream.cam_id for s in endpoints.values() for stream in s}
+        for cam_id in list(self.last_loads):
+            if cam_id not in alive_ids:
+                del self.last_loads[cam_id]
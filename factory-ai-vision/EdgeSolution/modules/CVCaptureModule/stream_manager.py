@@ -2,6 +2,7 @@ import logging
 import threading
 
 import zmq
+from rate_controller import MIN_FPS, RATE_CONTROL, RateController
 from streams import Stream
 
 # FIXME RON
@@ -17,6 +18,9 @@ class StreamManager(object):
         self.context = None
         self.sender = None
         self._init_zmq()
+        self.rate_controller = None
+        if RATE_CONTROL == "true":
+            self.rate_controller = RateController(self.get_streams)
 
     def _init_zmq(self):
 
@@ -24,7 +28,8 @@ class StreamManager(object):
         self.sender = self.context.socket(zmq.PUB)
         self.sender.bind("tcp://*:5556")
 
-    def _add_new_stream(self, stream_id, rtsp, fps, endpoint):
+    def _add_new_stream(self, stream_id, rtsp, fps, endpoint, priority=1.0,
+                        min_fps=MIN_FPS):
         """ internal function, no thread protect """
         logger.info("Add new stream: %s", stream_id)
 
@@ -33,7 +38,8 @@ class StreamManager(object):
             return False
 
         # FIXME RON check this
-        stream = Stream(stream_id, rtsp, fps, endpoint, self.sender)
+        stream = Stream(stream_id, rtsp, fps, endpoint, self.sender,
+                        priority=priority, min_fps=min_fps)
         self.streams[stream_id] = stream
 
     def get_streams(self):
@@ -52,7 +58,8 @@ class StreamManager(object):
     def delete_stream(self, stream_id):
         self._delete_stream_by_id(stream_id)
 
-    def add_stream(self, stream_id, rtsp, fps, endpoint):
+    def add_stream(self, stream_id, rtsp, fps, endpoint, priority=1.0,
+                   min_fps=MIN_FPS):
         self.mutex.acquire()
         if stream_id in self.streams:
             s = self.streams.get(stream_id, None)
@@ -60,8 +67,12 @@ class StreamManager(object):
                 self._delete_stream_by_id(stream_id)
             else:
                 print("nothing change")
+                # rate control settings do not need a restart
+                s.priority = priority
+                s.min_fps = min(min_fps, s.max_fps)
 
-        self._add_new_stream(stream_id, rtsp, fps, endpoint)
+        self._add_new_stream(stream_id, rtsp, fps, endpoint, priority,
+                             min_fps)
         self.mutex.release()
 
         return "ok"
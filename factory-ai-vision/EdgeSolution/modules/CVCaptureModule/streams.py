@@ -5,19 +5,25 @@ import os
 import threading
 import time
 
-import cv2
 import numpy as np
 import requests
 
+from capture import FrameCapture
+from rate_controller import MIN_FPS
+from shared_frame import SharedFrameWriter, get_shm_name
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-IMG_WIDTH = 960
-IMG_HEIGHT = 540
+# http: send raw frames in the request body
+# shm: write frames to /dev/shm and only send the slot to InferenceModule,
+#      both containers need to share /dev/shm (ipc)
+FRAME_TRANSPORT = os.environ.get("FRAME_TRANSPORT", "http")
 
 
 class Stream:
-    def __init__(self, cam_id, cam_source, fps, endpoint, sender):
+    def __init__(self, cam_id, cam_source, fps, endpoint, sender,
+                 priority=1.0, min_fps=MIN_FPS):
         self.cam_id = cam_id
 
         self.mutex = threading.Lock()
@@ -30,7 +36,13 @@ class Stream:
         # else:
         #     frameRate = 10
         self.cam = None
+        self.config_fps = fps
+        # fps is adapted by the RateController between min_fps and max_fps
         self.fps = max(0.1, fps)
+        self.max_fps = self.fps
+        self.min_fps = min(min_fps, self.fps)
+        self.priority = priority
+        self.average_send_time = 0
         self.cam_is_alive = True
 
         self.IMG_WIDTH = 960
@@ -40,65 +52,85 @@ class Stream:
         self.last_img = None
         self.last_update = None
         self.last_send = None
+        self.frame_ready = threading.Condition()
         self.edge = '960'
 
         self.zmq_sender = sender
+        self.shm_writer = None
+        if FRAME_TRANSPORT == "shm":
+            try:
+                self.shm_writer = SharedFrameWriter(get_shm_name(cam_id))
+            except Exception:
+                logger.warning(
+                    "Cannot create shared memory for stream {}, fallback to http".format(
+                        self.cam_id))
         self.start_http()
         # self.start_zmq()
 
-    def start_http(self):
-        def _new_streaming(self):
-            cnt = 0
-            endpoint = self.endpoint + "/predict_opencv?camera_id=" + self.cam_id + '&edge=' + self.edge
-            if self.cam_source == "0":
-                self.cam = cv2.VideoCapture(0)
-            else:
-                self.cam = cv2.VideoCapture(self.cam_source)
-
-            if self.cam.isOpened():
-                cam_fps = self.cam.get(cv2.CAP_PROP_FPS)
-                if cam_fps > 0.0 and cam_fps < self.fps:
-                    self.fps = cam_fps
+    def run_capture(self):
+        """run_capture.
+
+        Grab every frame of the source, but only retrieve (convert and
+        resize) one every 1 / fps seconds, for run_send.
+        """
+        self.cam = FrameCapture(self.cam_source)
+        logger.info("Stream {} decoding with {}".format(self.cam_id,
+                                                        self.cam.backend))
+
+        source_fps = 0
+        if self.cam.is_opened():
+            source_fps = self.cam.get_fps()
+            if source_fps > 0.0 and source_fps < self.max_fps:
+                self.max_fps = source_fps
+                self.set_fps(self.fps)
+
+        next_retrieve = 0
+        while self.cam_is_alive:
+            if not self.cam.grab():
+                self.restart_cam()
+                time.sleep(1)
+                continue
+
+            now = time.time()
+            if now >= next_retrieve:
+                img = self.cam.retrieve()
+                if img is not None:
+                    next_retrieve = now + 1 / self.fps
+                    with self.frame_ready:
+                        self.edge = self.cam.edge
+                        self.last_img = img
+                        self.last_update = now
+                        self.frame_ready.notify_all()
+
+            if self.cam.is_file:
+                # play video files in real time
+                time.sleep(1 / source_fps if source_fps > 0 else 1 / self.fps)
+
+        logger.warning("Stream {} finished".format(self.cam_id))
+        self.cam.release()
 
-            while self.cam_is_alive:
-                cnt += 1
-                is_ok, img = self.cam.read()
-                if is_ok:
-
-                    width = IMG_WIDTH
-                    ratio = IMG_WIDTH / img.shape[1]
-                    height = int(img.shape[0] * ratio + 0.000001)
-                    if height >= self.IMG_HEIGHT:
-                        height = self.IMG_HEIGHT
-                        ratio = self.IMG_HEIGHT / img.shape[0]
-                        width = int(img.shape[1] * ratio + 0.000001)
-                        self.edge = '540'
-
-                    img = cv2.resize(img, (width, height))
-
-                    self.last_img = img
-                    self.last_update = time.time()
-                    time.sleep(1 / self.fps)
-                    # print(jpg)
-                else:
-                    self.restart_cam()
-                    time.sleep(1)
+    def wait_new_frame(self):
+        """wait_new_frame.
 
-            logger.warning("Stream {} finished".format(self.cam_id))
-            self.cam.release()
+        Returns False if no new frame came within a second.
+        """
+        with self.frame_ready:
+            return self.frame_ready.wait_for(
+                lambda: self.last_img is not None and self.last_send != self.
+                last_update or not self.cam_is_alive,
+                timeout=1)
 
+    def start_http(self):
         def run_send(self):
             cnt = 0
             while self.cam_is_alive:
-                if self.last_img is None:
-                    logger.warning(
-                        "stream {} img not ready".format(self.cam_id))
-                    time.sleep(1)
-                    continue
-                if self.last_send == self.last_update:
-                    # logger.warning('no new img')
-                    time.sleep(1 / self.fps)
+                if not self.wait_new_frame():
+                    if self.last_img is None:
+                        logger.warning(
+                            "stream {} img not ready".format(self.cam_id))
                     continue
+                if not self.cam_is_alive:
+                    break
                 cnt += 1
                 if cnt % 30 == 1:
                     logger.warning(
@@ -106,84 +138,93 @@ class Stream:
                             bytes(self.cam_id, "utf-8"), cnt
                         )
                     )
-                # data = cv2.imencode(".jpg", self.last_img)[1].tobytes()
-                data = self.last_img.tobytes()
-                endpoint = self.endpoint + "/predict_opencv?camera_id=" + self.cam_id + '&edge=' + self.edge
-                res = requests.post(endpoint, data=data)
-                self.last_send = self.last_update
-                time.sleep(1 / self.fps)
-
-        threading.Thread(target=_new_streaming,
-                         args=(self,), daemon=True).start()
+                img, last_update = self.last_img, self.last_update
+                start = time.time()
+                # data = cv2.imencode(".jpg", img)[1].tobytes()
+                if not self.send_shm(img):
+                    data = img.tobytes()
+                    endpoint = self.endpoint + "/predict_opencv?camera_id=" + self.cam_id + '&edge=' + self.edge
+                    res = requests.post(endpoint, data=data)
+                self.last_send = last_update
+                self.update_send_time(time.time() - start)
+
+        threading.Thread(target=self.run_capture, daemon=True).start()
         threading.Thread(target=run_send, args=(self,), daemon=True).start()
 
-    def start_zmq(self):
-        def run_capture(self):
-
-            if self.cam_source == "0":
-                self.cam = cv2.VideoCapture(0)
-            else:
-                self.cam = cv2.VideoCapture(self.cam_source)
-            cnt = 0
-            while self.cam_is_alive:
-                is_ok, img = self.cam.read()
-                if is_ok:
-
-                    width = IMG_WIDTH
-                    ratio = IMG_WIDTH / img.shape[1]
-                    height = int(img.shape[0] * ratio + 0.000001)
-                    if height >= self.IMG_HEIGHT:
-                        height = self.IMG_HEIGHT
-                        ratio = self.IMG_HEIGHT / img.shape[0]
-                        width = int(img.shape[1] * ratio + 0.000001)
-
-                    img = cv2.resize(img, (width, height))
-                    self.last_img = img
-                    self.last_update = time.time()
-
-                    time.sleep(1 / self.fps)
-                else:
-                    time.sleep(1)
-                    self.restart_cam()
-            logger.warning("Stream {} finished".format(self.cam_id))
+    def set_fps(self, fps):
+        self.fps = min(self.max_fps, max(self.min_fps, fps))
+
+    def update_send_time(self, send_time):
+        # moving avg, same weights as InferenceModule average_inference_time
+        self.average_send_time = (1 / 16 * send_time +
+                                  15 / 16 * self.average_send_time)
+
+    def send_shm(self, img):
+        """send_shm.
+
+        Returns False if the frame has to be sent through http instead.
+        """
+        if self.shm_writer is None:
+            return False
+        slot = self.shm_writer.write(img)
+        if slot is None:
+            return False
+        params = {"camera_id": self.cam_id}
+        params.update(slot)
+        try:
+            res = requests.post(self.endpoint + "/predict_shm", params=params)
+        except Exception:
+            logger.warning("Cannot send frame through shared memory")
+            return False
+        try:
+            status_code = res.json()[1]
+        except Exception:
+            status_code = res.status_code
+        # 404 when InferenceModule cannot see /dev/shm of this container
+        if status_code == 404:
+            logger.warning(
+                "InferenceModule cannot read shared memory, fallback to http")
+            self.shm_writer.close()
+            self.shm_writer = None
+            return False
+        return True
 
+    def start_zmq(self):
         def run_send(self):
             cnt = 0
             while self.cam_is_alive:
                 cnt += 1
-                if self.last_img is None:
-                    logger.warning(
-                        "stream {} img not ready".format(self.cam_id))
-                    time.sleep(1)
-                    continue
-                if self.last_send == self.last_update:
-                    # logger.warning('no new img')
-                    time.sleep(1 / self.fps)
+                if not self.wait_new_frame():
+                    if self.last_img is None:
+                        logger.warning(
+                            "stream {} img not ready".format(self.cam_id))
                     continue
+                if not self.cam_is_alive:
+                    break
                 if cnt % 30 == 1:
                     logger.warning(
                         "send through channel {} to inference server".format(
                             bytes(self.cam_id, "utf-8")
                         )
                     )
+                img, last_update = self.last_img, self.last_update
                 # self.mutex.acquire()
                 # FIXME may find a better way to deal with encoding
                 self.zmq_sender.send_multipart(
                     [
-                        bytes(self.cam_id, "utf-8"), self.last_img.tobytes(),
+                        bytes(self.cam_id, "utf-8"), img.tobytes(),
                     ]
                 )
-                self.last_send = self.last_update
-                time.sleep(1 / self.fps)
+                self.last_send = last_update
 
-        threading.Thread(target=run_capture, args=(self,), daemon=True).start()
+        threading.Thread(target=self.run_capture, daemon=True).start()
         threading.Thread(target=run_send, args=(self,), daemon=True).start()
 
     def restart_cam(self):
 
         logger.warning("Restarting Cam {}".format(self.cam_id))
 
-        cam = cv2.VideoCapture(self.cam_source)
+        cam = FrameCapture(self.cam_source)
 
         # Protected by Mutex
         self.mutex.acquire()
@@ -300,11 +341,15 @@ class Stream:
         print(type(endpoint))
         print(self.endpoint)
         print(type(self.endpoint))
-        return rtsp != self.cam_source or endpoint != self.endpoint or self.fps != fps
+        return rtsp != self.cam_source or endpoint != self.endpoint or self.config_fps != fps
 
     def delete(self):
         # self.mutex.acquire()
         self.cam_is_alive = False
         # self.mutex.release()
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+        if self.shm_writer:
+            self.shm_writer.close()
 
         logging.info("Deactivate stream {}".format(self.cam_id))
@@ -38,6 +38,8 @@ class PartDetectionModeEnum(str, Enum):
 class UploadModelBody(BaseModel):
     model_uri: str = None
     model_dir: str = None
+    # used instead of model_uri on vpu, /apply only
+    model_uri_fp16: str = None
 
 
 class UpdateEndpointBody(BaseModel):
@@ -69,3 +71,32 @@ class CamerasModel(BaseModel):
     cascade_name: str
     fps: float
     cameras: List[CameraModel]
+
+
+class RetrainModel(BaseModel):
+    is_retrain: bool
+    confidence_min: int
+    confidence_max: int
+    max_images: int
+
+
+class IotHubModel(BaseModel):
+    is_send: bool
+    threshold: int
+    fpm: int
+
+
+class DeploymentModel(BaseModel):
+    """Desired state of the module, applied at once by /apply."""
+
+    version: str
+    part_detection_id: int = None
+    part_detection_mode: PartDetectionModeEnum
+    endpoint: UpdateEndpointBody = None
+    model: UploadModelBody = None
+    parts: List[PartModel]
+    retrain: RetrainModel
+    iothub: IotHubModel
+    prob_threshold: int
+    max_people: int
+    cameras: CamerasModel
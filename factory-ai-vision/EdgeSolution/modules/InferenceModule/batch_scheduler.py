@@ -0,0 +1,152 @@
+"""Batch Scheduler.
+
+Frames submitted by every stream are collected until either BATCH_MAX_SIZE
+frames are waiting or BATCH_MAX_LATENCY_MS has passed since the first one
+arrived, then handed to the model backend in one call. Each caller gets its
+own result back through a Future.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "1"))
+BATCH_MAX_LATENCY_MS = float(os.environ.get("BATCH_MAX_LATENCY_MS", "10"))
+BATCH_RESULT_TIMEOUT = 30  # seconds
+
+
+def is_batching_enabled():
+    return BATCH_MAX_SIZE > 1
+
+
+class BatchScheduler:
+    def __init__(self, name, predict_batch, max_batch_size=BATCH_MAX_SIZE,
+                 max_latency_ms=BATCH_MAX_LATENCY_MS):
+        """__init__.
+
+        Args:
+            name: name used in logs and metrics, usually the endpoint.
+            predict_batch: callable taking a list of frames and returning
+                a list of results in the same order.
+            max_batch_size (int): max frames sent in one call.
+            max_latency_ms (float): max time the first frame of a batch waits
+                for others to join.
+        """
+        self.name = name
+        self.predict_batch = predict_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency_ms / 1000
+
+        self.queue = queue.Queue()
+        self.mutex = threading.Lock()
+
+        self.batch_count = 0
+        self.frame_count = 0
+        self.average_batch_size = 0
+        self.average_queue_time = 0
+        self.average_inference_time = 0
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, image):
+        future = Future()
+        self.queue.put((image, future, time.time()))
+        return future
+
+    def predict(self, image, timeout=BATCH_RESULT_TIMEOUT):
+        return self.submit(image).result(timeout)
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            images = [image for image, _, _ in batch]
+
+            s = time.time()
+            try:
+                results = self.predict_batch(images)
+                if len(results) != len(batch):
+                    raise ValueError(
+                        "Backend returned {} results for {} frames".format(
+                            len(results), len(batch)))
+            except Exception as e:
+                logger.warning("Batch %s failed: %s", self.name, e)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            inf_time = time.time() - s
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            queue_time = s - min(submitted for _, _, submitted in batch)
+            self._update_metrics(len(batch), queue_time, inf_time)
+
+    def _update_metrics(self, batch_size, queue_time, inf_time):
+        # moving avg, same weights as Stream.average_inference_time
+        with self.mutex:
+            self.batch_count += 1
+            self.frame_count += batch_size
+            self.average_batch_size = (1 / 16 * batch_size +
+                                       15 / 16 * self.average_batch_size)
+            self.average_queue_time = (1 / 16 * queue_time * 1000 +
+                                       15 / 16 * self.average_queue_time)
+            self.average_inference_time = (
+                1 / 16 * inf_time * 1000 +
+                15 / 16 * self.average_inference_time)
+
+    def get_metrics(self):
+        with self.mutex:
+            return {
+                "name": self.name,
+                "max_batch_size": self.max_batch_size,
+                "max_latency_ms": self.max_latency * 1000,
+                "batch_count": self.batch_count,
+                "frame_count": self.frame_count,
+                "queue_size": self.queue.qsize(),
+                "average_batch_size": self.average_batch_size,
+                "average_queue_time": self.average_queue_time,
+                "average_inference_time": self.average_inference_time,
+            }
+
+
+_schedulers = {}
+_schedulers_mutex = threading.Lock()
+
+
+def get_batch_scheduler(key, predict_batch):
+    """get_batch_scheduler.
+
+    Return the scheduler shared by every stream using the same backend,
+    creating it on first use.
+    """
+    with _schedulers_mutex:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            logger.info("Creating batch scheduler for %s", key)
+            scheduler = BatchScheduler(str(key), predict_batch)
+            _schedulers[key] = scheduler
+        return scheduler
+
+
+def get_batch_metrics():
+    with _schedulers_mutex:
+        schedulers = list(_schedulers.values())
+    return [scheduler.get_metrics() for scheduler in schedulers]
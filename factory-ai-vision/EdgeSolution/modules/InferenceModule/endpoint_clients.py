@@ -0,0 +1,165 @@
+"""Endpoint Clients.
+
+Connections to model endpoints are shared by every stream: one keep-alive
+requests.Session per HTTP endpoint and one gRPC channel per OVMS address,
+so frames do not pay for a new TCP connection each time.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import grpc
+import requests
+from requests.adapters import HTTPAdapter
+from tensorflow_serving.apis import prediction_service_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_TIMEOUT = float(os.environ.get("ENDPOINT_TIMEOUT", "10"))  # seconds
+ENDPOINT_POOL_SIZE = int(os.environ.get("ENDPOINT_POOL_SIZE", "16"))
+RECONNECT_BACKOFF_MIN = 1  # seconds
+RECONNECT_BACKOFF_MAX = 30  # seconds
+GRPC_MAX_MESSAGE_LENGTH = 1024 * 1024 * 1024
+
+
+class EndpointUnavailable(Exception):
+    pass
+
+
+class HttpEndpointClient:
+    def __init__(self, endpoint, pool_size=ENDPOINT_POOL_SIZE):
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.mutex = threading.Lock()
+        self.backoff = 0
+        self.retry_at = 0
+        self.last_error = None
+
+    def post(self, url=None, timeout=ENDPOINT_TIMEOUT, **kwargs):
+        """post.
+
+        Raise EndpointUnavailable without connecting while the endpoint is
+        backing off after a connection error.
+        """
+        if time.time() < self.retry_at:
+            raise EndpointUnavailable("{} unavailable: {}".format(
+                self.endpoint, self.last_error))
+        try:
+            res = self.session.post(url or self.endpoint,
+                                    timeout=timeout,
+                                    **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self._on_error(e)
+            raise
+        self._on_success()
+        return res
+
+    def _on_error(self, e):
+        with self.mutex:
+            self.backoff = min(
+                max(RECONNECT_BACKOFF_MIN, self.backoff * 2),
+                RECONNECT_BACKOFF_MAX)
+            self.retry_at = time.time() + self.backoff
+            self.last_error = str(e)
+        logger.warning("Endpoint %s failed, retry in %s sec: %s",
+                       self.endpoint, self.backoff, e)
+
+    def _on_success(self):
+        if self.backoff:
+            with self.mutex:
+                self.backoff = 0
+                self.retry_at = 0
+                self.last_error = None
+
+    def is_healthy(self):
+        return time.time() >= self.retry_at
+
+    def get_status(self):
+        return {
+            "type": "http",
+            "healthy": self.is_healthy(),
+            "backoff": self.backoff,
+            "last_error": self.last_error,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class GrpcEndpointClient:
+    def __init__(self, address):
+        self.address = address
+        # grpc reconnects by itself with exponential backoff
+        self.channel = grpc.insecure_channel(
+            address,
+            options=[
+                ('grpc.max_send_message_length', GRPC_MAX_MESSAGE_LENGTH),
+                ('grpc.max_receive_message_length', GRPC_MAX_MESSAGE_LENGTH),
+                ('grpc.keepalive_time_ms', 30000),
+                ('grpc.initial_reconnect_backoff_ms',
+                 RECONNECT_BACKOFF_MIN * 1000),
+                ('grpc.max_reconnect_backoff_ms',
+                 RECONNECT_BACKOFF_MAX * 1000),
+            ])
+        self.stub = prediction_service_pb2_grpc.PredictionServiceStub(
+            self.channel)
+
+    def is_healthy(self, timeout=1):
+        try:
+            grpc.channel_ready_future(self.channel).result(timeout=timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            return False
+
+    def get_status(self):
+        return {"type": "grpc", "healthy": self.is_healthy()}
+
+    def close(self):
+        self.channel.close()
+
+
+_clients = {}
+_clients_mutex = threading.Lock()
+
+
+def _get_client(key, factory):
+    with _clients_mutex:
+        client = _clients.get(key)
+        if client is None:
+            logger.info("Creating endpoint client for %s", key[1])
+            client = factory()
+            _clients[key] = client
+        return client
+
+
+def get_http_client(endpoint):
+    """get_http_client.
+
+    Return the client shared by every stream using the endpoint.
+    """
+    return _get_client(("http", endpoint),
+                       lambda: HttpEndpointClient(endpoint))
+
+
+def get_grpc_client(address):
+    """get_grpc_client.
+
+    Return the channel shared by every stream using the address, the
+    address can be given with a http:// prefix.
+    """
+    address = address.lower()
+    if address.startswith("http://"):
+        address = address[7:]
+    return _get_client(("grpc", address), lambda: GrpcEndpointClient(address))
+
+
+def get_endpoint_status():
+    with _clients_mutex:
+        clients = list(_clients.items())
+    return {key[1]: client.get_status() for key, client in clients}
@@ -0,0 +1,143 @@
+"""Geometry.
+
+Zones and AOIs compiled once into NumPy edge arrays, so testing the boxes
+of a frame against every zone is one vectorized call instead of building
+shapely polygons per detection.
+
+A box intersects a polygon (boundaries included, as shapely intersects)
+when one polygon edge touches the box, or when the box lies inside the
+polygon.
+"""
+
+import numpy as np
+from shapely.geometry import Polygon
+
+
+def to_boxes(boxes):
+    """to_boxes.
+
+    Returns an (N, 4) float array of x1, y1, x2, y2 with x1 <= x2, y1 <= y2.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    return np.concatenate([
+        np.minimum(boxes[:, :2], boxes[:, 2:]),
+        np.maximum(boxes[:, :2], boxes[:, 2:]),
+    ], axis=1)
+
+
+class CompiledZones:
+    def __init__(self, polygons):
+        """__init__.
+
+        Args:
+            polygons: list of polygons, each a list of [x, y] points. Invalid
+                polygons never intersect anything, same as before.
+        """
+        self.size = len(polygons)
+        self.valid = np.zeros(self.size, dtype=bool)
+        self.bounds = np.zeros((self.size, 4))
+
+        edges = []
+        starts = []
+        for i, points in enumerate(polygons):
+            if len(points) < 3 or not Polygon(points).is_valid:
+                continue
+            points = np.asarray(points, dtype=float)
+            self.valid[i] = True
+            self.bounds[i] = [*points.min(axis=0), *points.max(axis=0)]
+            starts.append(i)
+            edges.append(
+                np.concatenate([points, np.roll(points, -1, axis=0)], axis=1))
+
+        # edges of every valid zone, contiguous per zone
+        self.zone_index = np.array(starts, dtype=int)
+        if edges:
+            self.edge_offsets = np.cumsum([0] + [len(e) for e in edges[:-1]])
+            self.edges = np.concatenate(edges)
+        else:
+            self.edge_offsets = np.zeros(0, dtype=int)
+            self.edges = np.zeros((0, 4))
+
+    def intersects(self, boxes):
+        """intersects.
+
+        Args:
+            boxes: (N, 4) boxes as x1, y1, x2, y2.
+        Returns:
+            (N, number of zones) bool array.
+        """
+        boxes = to_boxes(boxes)
+        result = np.zeros((len(boxes), self.size), dtype=bool)
+        if len(boxes) == 0 or len(self.edges) == 0:
+            return result
+
+        x1, y1, x2, y2 = (boxes[:, i:i + 1] for i in range(4))
+        ex0, ey0, ex1, ey1 = (self.edges[:, i] for i in range(4))
+
+        # edge / box clipping (Liang-Barsky), (N, E)
+        dx = ex1 - ex0
+        dy = ey1 - ey0
+        t0 = np.zeros((len(boxes), len(self.edges)))
+        t1 = np.ones((len(boxes), len(self.edges)))
+        hit = np.ones((len(boxes), len(self.edges)), dtype=bool)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for p, q in ((-dx, ex0 - x1), (dx, x2 - ex0), (-dy, ey0 - y1),
+                         (dy, y2 - ey0)):
+                p = np.broadcast_to(p, q.shape)
+                t = q / p
+                hit &= ~((p == 0) & (q < 0))
+                t0 = np.where(p < 0, np.maximum(t0, t), t0)
+                t1 = np.where(p > 0, np.minimum(t1, t), t1)
+        hit &= t0 <= t1
+        edge_hit = np.logical_or.reduceat(hit, self.edge_offsets, axis=1)
+
+        # box inside the polygon: its corner is inside (crossing number)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crosses = ((ey0 > y1) != (ey1 > y1)) & (
+                x1 < dx * (y1 - ey0) / dy + ex0)
+        inside = np.add.reduceat(crosses, self.edge_offsets, axis=1) % 2 == 1
+
+        # bounding box prefilter
+        b = self.bounds[self.zone_index]
+        overlap = ((x1 <= b[:, 2]) & (x2 >= b[:, 0]) & (y1 <= b[:, 3]) &
+                   (y2 >= b[:, 1]))
+
+        result[:, self.zone_index] = overlap & (edge_hit | inside)
+        return result
+
+
+class CompiledAoi:
+    def __init__(self, aoi_info):
+        """__init__.
+
+        Args:
+            aoi_info: AOIs as sent by WebModule, BBox or Polygon labels.
+        """
+        rects = []
+        polygons = []
+        for aoi_area in aoi_info or []:
+            label = aoi_area["label"]
+            if aoi_area["type"] == "BBox":
+                rects.append([label["x1"], label["y1"], label["x2"],
+                              label["y2"]])
+            elif aoi_area["type"] == "Polygon":
+                polygons.append([[point["x"], point["y"]] for point in label])
+        self.rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        self.polygons = CompiledZones(polygons)
+
+    def is_inside(self, boxes):
+        """is_inside.
+
+        Returns an (N,) bool array, True for boxes inside any AOI.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        x1, y1, x2, y2 = (boxes[:, i:i + 1] for i in range(4))
+        r = self.rects
+        # BBox AOIs keep their original rule: a box corner coordinate falls
+        # in the AOI range on both axes
+        in_x = ((r[:, 0] <= x1) & (x1 <= r[:, 2])) | ((r[:, 0] <= x2) &
+                                                     (x2 <= r[:, 2]))
+        in_y = ((r[:, 1] <= y1) & (y1 <= r[:, 3])) | ((r[:, 1] <= y2) &
+                                                     (y2 <= r[:, 3]))
+        return (in_x & in_y).any(axis=1) | self.polygons.intersects(
+            boxes).any(axis=1)
@@ -4,6 +4,8 @@
 import logging
 import sys
 
+from endpoint_clients import EndpointUnavailable
+
 logger = logging.getLogger(__name__)
 
 
@@ -29,6 +31,9 @@ class HttpInferenceEngine:
             else:
                 predictions = []
             #logger.info("Predictions %s", predictions)
+        except EndpointUnavailable as e:
+            # already logged when the endpoint went down
+            logger.debug(e)
         except:
             logger.error("Unexpected error: %s", sys.exc_info())
 
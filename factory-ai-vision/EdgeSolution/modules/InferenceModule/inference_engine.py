@@ -1,9 +1,8 @@
+import functools
 import logging
 import multiprocessing as mp
 import os
-import sys
 import threading
-import time
 from enum import Enum
 
 import cv2
@@ -13,7 +12,6 @@ import numpy as np
 import extension_pb2
 import extension_pb2_grpc
 from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2_grpc
 import inferencing_pb2
 import media_pb2
 from exception_handler import PrintGetExceptionDetails
@@ -24,6 +22,8 @@ from shared_memory import SharedMemoryManager
 # DEBUG = os.getenv('DEBUG')
 DEBUG_OUTPUT_FOLDER = "/lvaextensiondebug"
 
+DEFAULT_IMAGE_SHAPE = (540, 960, 3)
+
 
 class TransferType(Enum):
     BYTES = 1  # Embedded Content
@@ -72,7 +72,6 @@ class InferenceEngine(extension_pb2_grpc.MediaGraphExtensionServicer):
         # self._tYoloV3 = model
         self.stream_manager = stream_manager
         self.ovms = True
-        self.stub = None
 
     # Debug method for dumping received images with analysis results
 
@@ -279,7 +278,9 @@ class InferenceEngine(extension_pb2_grpc.MediaGraphExtensionServicer):
         )
         yield mediaStreamMessage
 
-        total_time = []
+        # Decoding, inference, scenario and drawing run on the stream pipeline,
+        # the response is sent right away with the latest predictions so
+        # acks do not wait for inference.
         # Process rest of the MediaStream message sequence
         for mediaStreamMessageRequest in requestIterator:
             # Increment response counter, will be sent to client
@@ -288,80 +289,43 @@ class InferenceEngine(extension_pb2_grpc.MediaGraphExtensionServicer):
             # Read request id, sent by client
             requestSeqNum = mediaStreamMessageRequest.sequence_number
 
-            logging.warning("[Received] SeqNum: {:07d}".format(requestSeqNum))
-            s1 = time.time()
-            # Get media content bytes. (bytes sent over shared memory buffer, segment or inline to message)
-            cvImage = self.GetCvImageFromRawBytes(
-                clientState, mediaStreamMessageRequest.media_sample)
-            e1 = time.time() - s1
-            logging.info("GetCvImageFromRawBytes time: {}".format(e1))
-
-            if cvImage is None:
-                message = "Can't decode received bytes."
-                logging.info(message)
-                context.set_details(message)
-                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-                return
-
-            # if list(cvImage.shape[:2]) != self._tYoloV3.image_shape:
-            #     message = "Received an image of size {0}, but expected one of size {1}".format(
-            #         cvImage.shape[:2], self._tYoloV3.image_shape)
-            #     context.set_details(message)
-            #     logging.info(message)
-            #     context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-            #     return
-
-            # instance_name = mediaStreamMessageRequest.graph_identifier.graph_instance_name
-            # logging.info('req: {0}'.format(mediaStreamMessageRequest))
-
-            # run inference
-            # logging.info(self._tYoloV3)
-            # out = self._tYoloV3.Score(cvImage)
-            # logging.info(out)
-            # predictions = self._tYoloV3.Score(cvImage, instance_id)
+            logging.debug("[Received] SeqNum: {:07d}".format(requestSeqNum))
+
+            imgShape = DEFAULT_IMAGE_SHAPE
             predictions = None
             if not stream:
                 stream = self.stream_manager.get_stream_by_id(instance_id)
                 predictions = []
                 print("[INFO] Stream not ready yet", flush=True)
-            elif self.stub is None:
-                channel = grpc.insecure_channel('ovms-server:9010')
-                self.stub = prediction_service_pb2_grpc.PredictionServiceStub(
-                    channel)
+            elif clientState._contentTransferType == TransferType.REFERENCE:
+                # shared memory is given back to the client with the ack,
+                # decode it before answering
+                cvImage = self.GetCvImageFromRawBytes(
+                    clientState, mediaStreamMessageRequest.media_sample)
+
+                if cvImage is None:
+                    message = "Can't decode received bytes."
+                    logging.info(message)
+                    context.set_details(message)
+                    context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                    return
+
+                if not cvImage.flags.writeable:
+                    cvImage = cvImage.copy()
+                imgShape = cvImage.shape
+                stream.get_pipeline().submit(cvImage)
+                predictions = stream.last_prediction
             else:
-                try:
-                    if False:
-                        stream.predict_grpc(cvImage, self.stub)
-                        predictions = stream.last_prediction
-                    else:
-                        # s2 = time.time()
-                        stream.predict(cvImage)
-                        predictions = stream.last_prediction
-                        # e2 = time.time() - s2
-                        # logging.info('Inference time: {0}'.format(e2))
-                        # total_time.append(e2)
-                        # logging.info(
-                        #    '***** avg. Inference time *****: {0}'.format(np.mean(total_time)))
-                        # logging.info(
-                        #    '***** std. Inference time *****: {0}'.format(np.std(total_time)))
-                except:
-                    print("[ERROR] Unexpected error:",
-                          sys.exc_info(),
-                          flush=True)
-                    predictions = []
-            # stream_manager.update(cvImage, instance_id)
-            # logging.debug(
-            #     'Detected {0} inferences'.format(len(predictions)))
-
-            # if DEBUG is not None:
-            #     self.CreateDebugOutput(
-            #         requestSeqNum, cvImage, boxes, scores, indices)
+                stream.get_pipeline().submit_encoded(
+                    functools.partial(self.GetCvImageFromRawBytes, clientState,
+                                      mediaStreamMessageRequest.media_sample))
+                predictions = stream.last_prediction
 
             # Check client connection state
             if context.is_active():
                 # return inference result as MediaStreamMessage
                 mediaStreamMessage = self.GetMediaStreamMessageResponse(
-                    predictions, cvImage.shape)
+                    predictions, imgShape)
 
                 mediaStreamMessage.sequence_number = responseSeqNum
                 mediaStreamMessage.ack_sequence_number = requestSeqNum
@@ -369,10 +333,7 @@ class InferenceEngine(extension_pb2_grpc.MediaGraphExtensionServicer):
                     mediaStreamMessageRequest.media_sample.timestamp)
 
                 # yield response
-                ss = time.time()
                 yield mediaStreamMessage
-                ee = time.time() - ss
-                logging.info("^^^^^^^^^^ Yield time: {} ^^^^^^^^^^".format(ee))
             else:
                 break
 
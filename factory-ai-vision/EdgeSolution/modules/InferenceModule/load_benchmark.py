@@ -0,0 +1,478 @@
+"""Load Benchmark.
+
+Replays video files through StreamManager / Stream.predict for N synthetic
+cameras sending at a fixed frame rate. Frames arriving while the stream is
+still busy with the previous one are dropped, like with a real camera. Each
+run reports throughput, latency percentiles, CPU time per stage and dropped
+frames; the camera count is swept until the endpoint cannot keep up to fit
+its capacity, which ModelObject uses to recommend frame rates.
+
+Without --endpoint the frames are sent to a local stand-in of PredictModule,
+which sleeps --latency ms per frame or runs the ONNX model of --model-dir.
+
+Usage:
+    python load_benchmark.py --video sample_video/video.mp4 --fps 10
+    python load_benchmark.py --cameras 1 2 4 --endpoint http://predictmodule:7777/predict
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_FPS = float(os.environ.get("BENCHMARK_FPS", "10"))  # per camera
+BENCHMARK_DURATION = float(os.environ.get("BENCHMARK_DURATION",
+                                          "5"))  # seconds per run
+BENCHMARK_MAX_CAMERAS = int(os.environ.get("BENCHMARK_MAX_CAMERAS", "16"))
+# p90 latency (ms) above which the camera count is not sustainable
+BENCHMARK_MAX_LATENCY = float(os.environ.get("BENCHMARK_MAX_LATENCY",
+                                             "1000"))
+# share of the frames sent that must be processed
+BENCHMARK_MIN_DELIVERY = 0.9
+BENCHMARK_MAX_FRAMES = 60  # frames kept in memory per video
+BENCHMARK_IMAGE = "img.png"
+MAX_CAMERA_FPS = 30
+
+STAGES = ("infer", "update_scenario", "render")
+STAND_IN_PORT = 7777  # Stream.infer dispatches on ':7777/predict'
+
+
+def load_frames(path, max_frames=BENCHMARK_MAX_FRAMES):
+    """load_frames.
+
+    Decode the first frames of a video, resized like Stream.infer does, so
+    decoding does not count in the benchmark. Falls back to BENCHMARK_IMAGE
+    if the video cannot be read.
+    """
+    frames = []
+    cap = cv2.VideoCapture(path)
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(_resize(frame))
+    cap.release()
+    if not frames:
+        logger.warning("Cannot read %s, use %s", path, BENCHMARK_IMAGE)
+        frames.append(_resize(cv2.imread(BENCHMARK_IMAGE)))
+    return frames
+
+
+def _resize(frame, width=960, height=540):
+    ratio = min(width / frame.shape[1], height / frame.shape[0])
+    return cv2.resize(frame, (int(frame.shape[1] * ratio),
+                              int(frame.shape[0] * ratio)))
+
+
+class StandInModelServer:
+    def __init__(self, latency=20, model_dir=None, tags=("benchmark",),
+                 detections=1, port=STAND_IN_PORT):
+        """__init__.
+
+        Args:
+            latency (float): ms slept per frame without model_dir.
+            model_dir: directory with model.onnx and labels.txt to run.
+            tags: tag names of the synthetic detections.
+            detections (int): synthetic detections per frame.
+            port (int): local port of /predict and /predict_batch.
+        """
+        self.latency = latency
+        self.tags = list(tags)
+        self.detections = detections
+        # one frame at a time, like the single model session of PredictModule
+        self.mutex = threading.Lock()
+        self.detector = None
+        if model_dir:
+            from onnxruntime_predict import ONNXRuntimeObjectDetection
+            with open(os.path.join(model_dir, "labels.txt")) as f:
+                self.tags = [l.strip() for l in f.readlines()]
+            self.detector = ONNXRuntimeObjectDetection(
+                os.path.join(model_dir, "model.onnx"), self.tags)
+
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", port), functools.partial(_StandInHandler, self))
+        self.server.daemon_threads = True
+        self.endpoint = "http://127.0.0.1:{}/predict".format(port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def score(self, image):
+        """score.
+
+        Returns (lva_prediction, inf_time) like PredictModule.
+        """
+        with self.mutex:
+            start = time.time()
+            if self.detector:
+                predictions, _ = self.detector.predict_image(image)
+            else:
+                time.sleep(self.latency / 1000)
+            inf_time = time.time() - start
+        if not self.detector:
+            predictions = [{
+                "tagName": self.tags[i % len(self.tags)],
+                "probability": 0.9,
+                "boundingBox": {
+                    "left": 0.1 * (i % 8),
+                    "top": 0.1,
+                    "width": 0.1,
+                    "height": 0.2,
+                },
+            } for i in range(self.detections)]
+        inferences = [{
+            "type": "entity",
+            "entity": {
+                "tag": {
+                    "value": p["tagName"],
+                    "confidence": p["probability"]
+                },
+                "box": {
+                    "l": p["boundingBox"]["left"],
+                    "t": p["boundingBox"]["top"],
+                    "w": p["boundingBox"]["width"],
+                    "h": p["boundingBox"]["height"],
+                },
+            },
+        } for p in predictions]
+        return inferences, inf_time
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def __init__(self, model_server, *args, **kwargs):
+        self.model_server = model_server
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        nparr = np.frombuffer(data, np.uint8)
+        if url.path == "/predict":
+            edge = parse_qs(url.query).get("edge", ["960"])[0]
+            if edge == "960":
+                img = nparr.reshape(-1, 960, 3)
+            else:
+                img = nparr.reshape(540, -1, 3)
+            inferences, inf_time = self.model_server.score(img)
+        elif url.path == "/predict_batch":
+            inferences = []
+            inf_time = 0
+            offset = 0
+            for h, w in json.loads(self.headers["X-Frame-Shapes"]):
+                img = nparr[offset:offset + h * w * 3].reshape(h, w, 3)
+                offset += h * w * 3
+                frame_inferences, frame_time = self.model_server.score(img)
+                inferences.append(frame_inferences)
+                inf_time += frame_time
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps([
+            json.dumps({"inferences": inferences, "inf_time": inf_time}),
+            200
+        ]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RunStats:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.latencies = []
+        self.dropped = 0
+        self.errors = 0
+        self.stage_cpu = {stage: 0.0 for stage in STAGES}
+        self.stage_wall = {stage: 0.0 for stage in STAGES}
+
+    def add_stage(self, stage, cpu, wall):
+        with self.mutex:
+            self.stage_cpu[stage] += cpu
+            self.stage_wall[stage] += wall
+
+    def add_frame(self, latency, dropped):
+        with self.mutex:
+            self.latencies.append(latency)
+            self.dropped += dropped
+
+    def report(self, cameras, fps, duration, process_cpu):
+        processed = len(self.latencies)
+        offered = processed + self.dropped + self.errors
+        latencies = np.array(self.latencies or [0]) * 1000
+        p50, p90, p99 = (float(p)
+                         for p in np.percentile(latencies, [50, 90, 99]))
+        delivered = processed / offered if offered else 0
+        report = {
+            "cameras": cameras,
+            "fps": fps,
+            "duration": duration,
+            "offered": offered,
+            "processed": processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "throughput": processed / duration,
+            "delivered": delivered,
+            "latency_ms": {
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "max": float(latencies.max()),
+            },
+            "stage_cpu_ms": {
+                stage: cpu * 1000 / max(1, processed)
+                for stage, cpu in self.stage_cpu.items()
+            },
+            "stage_wall_ms": {
+                stage: wall * 1000 / max(1, processed)
+                for stage, wall in self.stage_wall.items()
+            },
+            "process_cpu": process_cpu / duration,
+        }
+        report["sustainable"] = (delivered >= BENCHMARK_MIN_DELIVERY and
+                                 p90 <= BENCHMARK_MAX_LATENCY)
+        return report
+
+
+def _instrument(stream, stats):
+    """_instrument.
+
+    Time the stages called by Stream.predict on this stream only.
+    """
+    def _timed(stage, func):
+        def _f(*args):
+            cpu = time.thread_time()
+            wall = time.time()
+            try:
+                return func(*args)
+            finally:
+                stats.add_stage(stage,
+                                time.thread_time() - cpu,
+                                time.time() - wall)
+        return _f
+
+    for stage in STAGES:
+        setattr(stream, stage, _timed(stage, getattr(stream, stage)))
+
+
+def _uninstrument(stream):
+    for stage in STAGES:
+        stream.__dict__.pop(stage, None)
+
+
+def _camera(stream, frames, fps, start, deadline, stats):
+    interval = 1 / fps
+    next_time = start
+    index = 0
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if now < next_time:
+            time.sleep(min(next_time, deadline) - now)
+            continue
+        # frames sent while the stream was busy are dropped
+        late = int((now - next_time) / interval)
+        sent_time = next_time + late * interval
+        index += late + 1
+        try:
+            stream.predict(frames[index % len(frames)])
+            stats.add_frame(time.time() - sent_time, late)
+        except Exception:
+            logger.exception("Benchmark stream %s failed", stream.cam_id)
+            with stats.mutex:
+                stats.errors += 1
+                stats.dropped += late
+        next_time = sent_time + interval
+
+
+def setup_streams(stream_manager, cameras, fps):
+    stream_ids = ["benchmark-{}".format(i) for i in range(cameras)]
+    stream_manager.update_streams(stream_ids)
+    streams = [stream_manager.get_stream_by_id(i) for i in stream_ids]
+    for stream in streams:
+        stream.set_is_benchmark(True)
+        stream.update_cam("video", stream.cam_id, fps, 60, stream.lva_mode,
+                          False, stream.cam_id, stream.cam_id, False, [])
+    return streams
+
+
+def run_load(stream_manager, videos, cameras, fps=BENCHMARK_FPS,
+             duration=BENCHMARK_DURATION):
+    """run_load.
+
+    Send fps frames per second from each of the cameras for duration
+    seconds. Camera i replays videos[i % len(videos)], a list of frames.
+    """
+    streams = setup_streams(stream_manager, cameras, fps)
+    stats = RunStats()
+    for stream in streams:
+        _instrument(stream, stats)
+
+    start = time.time()
+    deadline = start + duration
+    cpu = time.process_time()
+    threads = []
+    for i, stream in enumerate(streams):
+        # spread the cameras over one frame interval
+        threads.append(
+            threading.Thread(target=_camera,
+                             args=(stream, videos[i % len(videos)], fps,
+                                   start + i / cameras / fps, deadline,
+                                   stats)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    report = stats.report(cameras, fps, elapsed,
+                          time.process_time() - cpu)
+
+    for stream in streams:
+        _uninstrument(stream)
+    logger.info("Benchmark %s cameras: %s fps, p90 %s ms, %s dropped",
+                cameras, round(report["throughput"], 1),
+                round(report["latency_ms"]["p90"]), report["dropped"])
+    return report
+
+
+def fit_capacity(runs):
+    """fit_capacity.
+
+    Capacity model of the endpoint: the most frames per second processed
+    in any run, and the frame rate a single camera can reach since
+    Stream.predict handles its frames one at a time.
+    """
+    max_total_fps = max(run["throughput"] for run in runs)
+    smallest = min(runs, key=lambda run: run["cameras"])
+    service_ms = sum(smallest["stage_wall_ms"].values())
+    max_camera_fps = MAX_CAMERA_FPS
+    if service_ms > 0:
+        max_camera_fps = min(max_camera_fps, 1000 / service_ms)
+    return {
+        "max_total_fps": max_total_fps,
+        "max_camera_fps": min(max_camera_fps, max_total_fps),
+        "sustainable_cameras": max(
+            (run["cameras"] for run in runs if run["sustainable"]),
+            default=0),
+    }
+
+
+def benchmark(stream_manager, video_paths, cameras=None, fps=BENCHMARK_FPS,
+              duration=BENCHMARK_DURATION, max_cameras=BENCHMARK_MAX_CAMERAS):
+    """benchmark.
+
+    Run the given camera counts, or double the camera count until a run is
+    not sustainable and bisect between the last two. Returns the JSON report
+    with every run and the fitted capacity.
+    """
+    videos = [load_frames(path) for path in video_paths]
+
+    # first frames can be slow (model loading, vpu)
+    streams = setup_streams(stream_manager, 1, fps)
+    streams[0].predict(videos[0][0])
+
+    runs = {}
+
+    def _run(n):
+        if n not in runs:
+            runs[n] = run_load(stream_manager, videos, n, fps, duration)
+        return runs[n]["sustainable"]
+
+    try:
+        if cameras:
+            for n in cameras:
+                _run(n)
+        else:
+            good, bad = 0, None
+            n = 1
+            while n <= max_cameras:
+                if not _run(n):
+                    bad = n
+                    break
+                good = n
+                n *= 2
+            if bad is None and good < max_cameras:
+                if _run(max_cameras):
+                    good = max_cameras
+                else:
+                    bad = max_cameras
+            while bad is not None and bad - good > 1:
+                n = (good + bad) // 2
+                if _run(n):
+                    good = n
+                else:
+                    bad = n
+    finally:
+        stream_manager.update_streams([])
+
+    runs = [runs[n] for n in sorted(runs)]
+    return {
+        "endpoint": stream_manager.model.endpoint,
+        "videos": list(video_paths),
+        "runs": runs,
+        "capacity": fit_capacity(runs),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from model_object import ModelObject
+    from stream_manager import StreamManager
+
+    parser = argparse.ArgumentParser(description="Multi-stream benchmark")
+    parser.add_argument("--video", nargs="+", default=[BENCHMARK_IMAGE],
+                        help="videos replayed by the cameras in turn")
+    parser.add_argument("--cameras", type=int, nargs="+",
+                        help="camera counts to run instead of the sweep")
+    parser.add_argument("--max-cameras", type=int,
+                        default=BENCHMARK_MAX_CAMERAS)
+    parser.add_argument("--fps", type=float, default=BENCHMARK_FPS)
+    parser.add_argument("--duration", type=float, default=BENCHMARK_DURATION)
+    parser.add_argument("--endpoint", help="model endpoint to benchmark")
+    parser.add_argument("--model-dir", help="onnx model of the stand-in")
+    parser.add_argument("--latency", type=float, default=20,
+                        help="ms per frame of the stand-in")
+    parser.add_argument("--detections", type=int, default=1)
+    parser.add_argument("--output", help="write the report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model_server = None
+    model = ModelObject(device="cpu")
+    if args.endpoint:
+        model.endpoint = args.endpoint
+    else:
+        model_server = StandInModelServer(args.latency, args.model_dir,
+                                          detections=args.detections)
+        model.endpoint = model_server.endpoint
+        model.parts = model_server.tags
+
+    result = benchmark(StreamManager(model), args.video, args.cameras,
+                       args.fps, args.duration, args.max_cameras)
+    if model_server:
+        model_server.stop()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
@@ -14,6 +14,8 @@ IMG_HEIGHT = 540
 
 GPU_MAX_FRAME_RATE = 30
 CPU_MAX_FRAME_RATE = 10
+# upper bound of the benchmarked total frame rate
+MAX_TOTAL_FRAME_RATE = 30
 
 LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 
@@ -22,7 +24,7 @@ logger = logging.getLogger(__name__)
 
 class ModelObject():
 
-    def __init__(self):
+    def __init__(self, device=None):
         self.lock = threading.Lock()
         # self.model = self.load_model(
         #    model_dir, is_default_model=True, is_scenario_model=False
@@ -46,16 +48,19 @@ class ModelObject():
 
         # Part that we want to detect
         self.parts = []
+        self.part_detection_id = None
 
         self.scenario_gps = {}
 
         # self.is_gpu = onnxruntime.get_device() == "GPU"
-        self.is_gpu = self.get_device() == "gpu"
+        self.is_gpu = (device or self.get_device()) == "gpu"
 
         if self.is_gpu:
             self.max_total_frame_rate = GPU_MAX_FRAME_RATE
         else:
             self.max_total_frame_rate = CPU_MAX_FRAME_RATE
+        # capacity fitted by load_benchmark, see set_benchmark
+        self.benchmark = None
         self.update_frame_rate_by_number_of_streams(1)
 
     @property
@@ -96,6 +101,16 @@ class ModelObject():
         self.max_total_frame_rate = fps
         print("[INFO] set max total frame rate as", fps, flush=True)
 
+    def set_benchmark(self, benchmark):
+        """set_benchmark.
+
+        Recommend frame rates from the capacity fitted by load_benchmark.
+        """
+        self.set_max_total_frame_rate(
+            max(1, min(MAX_TOTAL_FRAME_RATE,
+                       benchmark["capacity"]["max_total_fps"])))
+        self.benchmark = benchmark
+
     def update_frame_rate_by_number_of_streams(self, number_of_streams):
         if number_of_streams > 0:
             self.frame_rate = max(
@@ -109,6 +124,10 @@ class ModelObject():
         return self.frame_rate
 
     def get_recommended_frame_rate(self, number_of_streams):
+        if number_of_streams > 0 and self.benchmark:
+            capacity = self.benchmark["capacity"]
+            return max(1, int(min(capacity["max_camera_fps"],
+                                  self.max_total_frame_rate / number_of_streams)))
         if number_of_streams > 0:
             return max(1, int(self.max_total_frame_rate / number_of_streams))
         else:
@@ -100,10 +100,16 @@ class ObjectDetection(object):
             print("Press Ctl+C to exit...")
 
     def _logistic(self, x):
-        return np.where(x > 0, 1 / (1 + np.exp(-x)), np.exp(x) / (1 + np.exp(x)))
+        # Same values as np.where(x > 0, 1 / (1 + exp(-x)), exp(x) / (1 + exp(x)))
+        # with a single exp, exp(-|x|) is exp(-x) or exp(x) on each side.
+        e = np.exp(-np.abs(x))
+        return np.where(x > 0, 1 / (1 + e), e / (1 + e))
 
     def _non_maximum_suppression(self, boxes, class_probs, max_detections):
         """Remove overlapping bouding boxes
+
+        The right / bottom edges and the areas are computed once, each
+        selected box then takes one vectorized IoU row against every box.
         """
         assert len(boxes) == len(class_probs)
 
@@ -112,6 +118,8 @@ class ObjectDetection(object):
         max_classes = np.argmax(class_probs, axis=1)
 
         areas = boxes[:, 2] * boxes[:, 3]
+        rights = boxes[:, 0] + boxes[:, 2]
+        bottoms = boxes[:, 1] + boxes[:, 3]
 
         selected_boxes = []
         selected_classes = []
@@ -128,30 +136,21 @@ class ObjectDetection(object):
             selected_classes.append(max_classes[i])
             selected_probs.append(max_probs[i])
 
-            box = boxes[i]
-            other_indices = np.concatenate(
-                (np.arange(i), np.arange(i + 1, len(boxes))))
-            other_boxes = boxes[other_indices]
-
-            # Get overlap between the 'box' and 'other_boxes'
-            x1 = np.maximum(box[0], other_boxes[:, 0])
-            y1 = np.maximum(box[1], other_boxes[:, 1])
-            x2 = np.minimum(box[0] + box[2],
-                            other_boxes[:, 0] + other_boxes[:, 2])
-            y2 = np.minimum(box[1] + box[3],
-                            other_boxes[:, 1] + other_boxes[:, 3])
-            w = np.maximum(0, x2 - x1)
-            h = np.maximum(0, y2 - y1)
+            # Get overlap between the 'box' and all boxes
+            w = np.maximum(0, np.minimum(rights[i], rights) -
+                           np.maximum(boxes[i, 0], boxes[:, 0]))
+            h = np.maximum(0, np.minimum(bottoms[i], bottoms) -
+                           np.maximum(boxes[i, 1], boxes[:, 1]))
 
             # Calculate Intersection Over Union (IOU)
             overlap_area = w * h
-            iou = overlap_area / \
-                (areas[i] + areas[other_indices] - overlap_area)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                iou = overlap_area / (areas[i] + areas - overlap_area)
 
-            # Find the overlapping predictions
-            overlapping_indices = other_indices[np.where(
-                iou > self.iou_threshold)[0]]
-            overlapping_indices = np.append(overlapping_indices, i)
+            # Find the overlapping predictions, the box itself included
+            is_overlapping = iou > self.iou_threshold
+            is_overlapping[i] = True
+            overlapping_indices = np.flatnonzero(is_overlapping)
 
             # Set the probability of overlapping predictions to zero, and udpate max_probs and max_classes.
             class_probs[overlapping_indices, max_classes[i]] = 0
@@ -164,7 +163,19 @@ class ObjectDetection(object):
             selected_boxes) == len(selected_probs)
         return selected_boxes, selected_classes, selected_probs
 
-    def _extract_bb(self, prediction_output, anchors):
+    def _extract_bb(self, prediction_output, anchors, min_objectness=None):
+        """Decode the boxes and class probabilities of the output cells
+
+        Args:
+            prediction_output: Output from the object detection model. (H x W x C)
+            anchors: (num_anchor x 2) anchor sizes.
+            min_objectness (float): only decode the cells whose objectness is
+                above it. A class probability never exceeds the objectness,
+                so the cells skipped could not pass that threshold anyway.
+
+        Returns:
+            (boxes, class_probs) of the decoded cells, in grid order.
+        """
         assert len(prediction_output.shape) == 3
         num_anchor = anchors.shape[0]
         height, width, channels = prediction_output.shape
@@ -175,32 +186,36 @@ class ObjectDetection(object):
 
         outputs = prediction_output.reshape((height, width, num_anchor, -1))
 
+        # Get confidence for the bounding boxes.
+        objectness = self._logistic(outputs[..., 4])
+
+        # Keep the candidate cells, their grid / anchor offsets are their indices
+        if min_objectness is None:
+            cells = np.ones(objectness.shape, dtype=bool)
+        else:
+            cells = objectness > min_objectness
+        grid_y, grid_x, anchor_index = np.nonzero(cells)
+        outputs = outputs[cells]
+        objectness = objectness[cells]
+
         # Extract bouding box information
-        x = (self._logistic(outputs[..., 0]) +
-             np.arange(width)[np.newaxis, :, np.newaxis]) / width
-        y = (self._logistic(
-            outputs[..., 1]) + np.arange(height)[:, np.newaxis, np.newaxis]) / height
-        w = np.exp(outputs[..., 2]) * anchors[:,
-                                              0][np.newaxis, np.newaxis, :] / width
-        h = np.exp(outputs[..., 3]) * anchors[:,
-                                              1][np.newaxis, np.newaxis, :] / height
+        x = (self._logistic(outputs[:, 0]) + grid_x) / width
+        y = (self._logistic(outputs[:, 1]) + grid_y) / height
+        w = np.exp(outputs[:, 2]) * anchors[anchor_index, 0] / width
+        h = np.exp(outputs[:, 3]) * anchors[anchor_index, 1] / height
 
         # (x,y) in the network outputs is the center of the bounding box. Convert them to top-left.
         x = x - w / 2
         y = y - h / 2
-        boxes = np.stack((x, y, w, h), axis=-1).reshape(-1, 4)
-
-        # Get confidence for the bounding boxes.
-        objectness = self._logistic(outputs[..., 4])
+        boxes = np.stack((x, y, w, h), axis=-1)
 
         # Get class probabilities for the bounding boxes.
-        class_probs = outputs[..., 5:]
+        class_probs = outputs[:, 5:]
         class_probs = np.exp(
-            class_probs - np.amax(class_probs, axis=3)[..., np.newaxis])
+            class_probs - np.amax(class_probs, axis=1)[:, np.newaxis])
         class_probs = class_probs / \
-            np.sum(class_probs, axis=3)[...,
-                                        np.newaxis] * objectness[..., np.newaxis]
-        class_probs = class_probs.reshape(-1, num_class)
+            np.sum(class_probs, axis=1)[:, np.newaxis] * \
+            objectness[:, np.newaxis]
 
         assert len(boxes) == len(class_probs)
         return (boxes, class_probs)
@@ -258,7 +273,8 @@ class ObjectDetection(object):
             List of Prediction objects.
         """
         logging.info('post')
-        boxes, class_probs = self._extract_bb(prediction_outputs, self.anchors)
+        boxes, class_probs = self._extract_bb(
+            prediction_outputs, self.anchors, self.prob_threshold)
 
         # Remove bounding boxes whose confidence is lower than the threshold.
         max_probs = np.amax(class_probs, axis=1)
@@ -0,0 +1,284 @@
+"""Retrain Sampler.
+
+Streams offer their frames to a RetrainSampler, which keeps one candidate
+per RETRAIN_SAMPLE_INTERVAL: the least confident detection within the
+confidence band, on a frame that is not a near-duplicate (perceptual hash
+within RETRAIN_HASH_DISTANCE bits) of the recent samples of the camera.
+Samples wait in one bounded queue, the oldest is dropped when it is full.
+
+One uploader thread JPEG-encodes the samples and posts up to
+RETRAIN_BATCH_SIZE of them in one multipart request to the WebModule, to
+the part detection deployed when they were sampled, so the frame loop
+never waits for an upload. Connection errors and 5xx answers are retried
+with a backoff before the batch is dropped.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+RETRAIN_SAMPLE_INTERVAL = float(os.environ.get("RETRAIN_SAMPLE_INTERVAL",
+                                               "5"))  # seconds per camera
+RETRAIN_QUEUE_SIZE = int(os.environ.get("RETRAIN_QUEUE_SIZE", "32"))
+RETRAIN_BATCH_SIZE = int(os.environ.get("RETRAIN_BATCH_SIZE", "8"))
+RETRAIN_BATCH_WAIT = 2  # seconds to fill a batch
+RETRAIN_UPLOAD_TIMEOUT = 30  # seconds
+RETRAIN_UPLOAD_RETRIES = int(os.environ.get("RETRAIN_UPLOAD_RETRIES", "3"))
+RETRAIN_RETRY_DELAY = 1  # seconds, doubled after each retry
+# Frames whose hashes differ by fewer bits are near-duplicates
+RETRAIN_HASH_DISTANCE = 6
+RETRAIN_HASH_HISTORY = 32
+RETRAIN_UPLOAD_PATH = "/api/part_detections/{}/upload_relabel_images/"
+
+
+def dhash(img):
+    """dhash.
+
+    64-bit difference hash of a frame, robust to small shifts, noise and
+    lighting changes.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class RetrainSample:
+    def __init__(self, cam_id, part_detection_id, img, part_name, labels,
+                 confidence):
+        self.cam_id = cam_id
+        self.part_detection_id = part_detection_id
+        self.img = img
+        self.part_name = part_name
+        self.labels = labels
+        self.confidence = confidence
+
+    def metadata(self):
+        return {
+            "camera_id": self.cam_id,
+            "part_name": self.part_name,
+            "labels": self.labels,
+            "confidence": self.confidence,
+        }
+
+
+class RetrainUploader:
+    def __init__(self, url, queue_size=RETRAIN_QUEUE_SIZE,
+                 batch_size=RETRAIN_BATCH_SIZE,
+                 batch_wait=RETRAIN_BATCH_WAIT,
+                 retries=RETRAIN_UPLOAD_RETRIES,
+                 retry_delay=RETRAIN_RETRY_DELAY):
+        """__init__.
+
+        Args:
+            url (callable): returns the WebModule host:port.
+            queue_size (int): samples waiting for an upload.
+            batch_size (int): samples per request.
+            batch_wait (float): seconds to wait for a full batch.
+            retries (int): retries of a request failing transiently.
+            retry_delay (float): seconds before the first retry.
+        """
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.mutex = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.uploaded = 0
+        self.failed = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, sample):
+        """put.
+
+        Queue a sample, dropping the oldest one if the queue is full.
+        Never blocks.
+        """
+        while True:
+            try:
+                self.queue.put_nowait(sample)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    with self.mutex:
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+        with self.mutex:
+            self.queued += 1
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(
+                    self.queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.upload(batch)
+            except Exception:
+                logger.exception("Retrain upload failed")
+
+    def upload(self, batch):
+        """upload.
+
+        Post the samples, one request per part detection.
+        """
+        by_part_detection = {}
+        for sample in batch:
+            by_part_detection.setdefault(sample.part_detection_id,
+                                         []).append(sample)
+        for part_detection_id, samples in by_part_detection.items():
+            if self._post(part_detection_id, samples):
+                with self.mutex:
+                    self.uploaded += len(samples)
+            else:
+                with self.mutex:
+                    self.failed += len(samples)
+
+    def _post(self, part_detection_id, samples):
+        files = [("img", ("{}-{}.jpg".format(sample.cam_id, i),
+                          cv2.imencode(".jpg", sample.img)[1].tobytes(),
+                          "image/jpeg")) for i, sample in enumerate(samples)]
+        metadata = json.dumps([sample.metadata() for sample in samples])
+        logger.info("Uploading %s retrain images", len(samples))
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                res = requests.post(
+                    "http://" + self.url() +
+                    RETRAIN_UPLOAD_PATH.format(part_detection_id),
+                    data={"metadata": metadata},
+                    files=files,
+                    timeout=RETRAIN_UPLOAD_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logger.warning("Failed to upload retrain images: %s", e)
+                continue
+            if res.status_code < 500:
+                break
+            logger.warning("Failed to upload retrain images: %s",
+                           res.status_code)
+        else:
+            return False
+        if res.status_code >= 400:
+            # not worth retrying, e.g. the part detection is gone
+            logger.warning("Retrain images rejected: %s %s", res.status_code,
+                           res.text)
+            return False
+        return True
+
+    def get_metrics(self):
+        with self.mutex:
+            return {
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "uploaded": self.uploaded,
+                "failed": self.failed,
+                "queue_depth": self.queue.qsize(),
+            }
+
+
+class RetrainSampler:
+    def __init__(self, cam_id, uploader, interval=RETRAIN_SAMPLE_INTERVAL,
+                 hash_distance=RETRAIN_HASH_DISTANCE):
+        self.cam_id = cam_id
+        self.uploader = uploader
+        self.interval = interval
+        self.hash_distance = hash_distance
+        self.hashes = deque(maxlen=RETRAIN_HASH_HISTORY)
+        self.last_sample_time = 0
+
+    def offer(self, predictions, img, confidence_min, confidence_max,
+              get_labels, part_detection_id):
+        """offer.
+
+        Args:
+            predictions: detections of the frame.
+            img: the frame.
+            confidence_min (float): lower bound of the confidence band.
+            confidence_max (float): upper bound of the confidence band.
+            get_labels (callable): relabel labels of a prediction.
+            part_detection_id: deployed part detection, whose relabel
+                images the frame is uploaded to.
+
+        Returns:
+            bool: whether the frame was queued.
+        """
+        if self.last_sample_time + self.interval > time.time():
+            return False
+        candidates = [
+            p for p in predictions
+            if confidence_min <= p["probability"] <= confidence_max
+        ]
+        if not candidates:
+            return False
+        prediction = min(candidates, key=lambda p: p["probability"])
+
+        frame_hash = dhash(img)
+        if any(hamming(frame_hash, h) < self.hash_distance
+               for h in self.hashes):
+            return False
+        self.hashes.append(frame_hash)
+        self.last_sample_time = time.time()
+
+        self.uploader.put(
+            RetrainSample(self.cam_id, part_detection_id, img.copy(),
+                          prediction["tagName"],
+                          get_labels(prediction), prediction["probability"]))
+        return True
+
+
+_uploader = None
+_uploader_mutex = threading.Lock()
+
+
+def get_retrain_uploader(url):
+    """get_retrain_uploader.
+
+    Return the uploader shared by every stream, creating it on first use.
+    """
+    global _uploader
+    with _uploader_mutex:
+        if _uploader is None:
+            logger.info("Creating retrain uploader")
+            _uploader = RetrainUploader(url)
+        return _uploader
+
+
+def get_retrain_metrics():
+    with _uploader_mutex:
+        uploader = _uploader
+    if uploader is None:
+        return {}
+    return uploader.get_metrics()
@@ -8,6 +8,8 @@ from dateutil import parser
 from tracker import Line, Rect, Tracker, Polygon_obj
 from shapely.geometry import Polygon
 from tracker import bb_intersection_over_union as compute_iou
+from geometry import CompiledZones
+from track_store import TrackStore
 from utility import draw_label
 
 Detection = namedtuple("Detection", ["tag", "x1", "y1", "x2", "y2", "score"])
@@ -26,6 +28,12 @@ class Scenario:
     def get_metrics(self):
         raise NotImplementedError
 
+    def get_track_state_metrics(self):
+        detected = getattr(self, "detected", None)
+        if isinstance(detected, TrackStore):
+            return detected.get_metrics()
+        return {}
+
 
 class PartDetection(Scenario):
     def __init__(self, threshold=0.3, max_age=5, min_hits=2, iou_threshold=0.3):
@@ -109,7 +117,7 @@ class PartCounter(Scenario):
         self.tracker = Tracker(
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
-        self.detected = {}
+        self.detected = TrackStore()
         self.counter = {}
         self.line = []
         self.max_people = 5
@@ -151,26 +159,27 @@ class PartCounter(Scenario):
             x1, y1, x2, y2, oid = obj
             xc, yc = compute_center(x1, y1, x2, y2)
             if oid in self.detected:
+                state = self.detected[oid]
                 for line in self.line:
-                    if line.id not in self.detected[oid]["expired"].keys():
-                        self.detected[oid]["expired"][line.id] = False
-                    if self.detected[oid]["expired"][line.id] is False:
+                    if line.id not in state.expired.keys():
+                        state.expired[line.id] = False
+                    if state.expired[line.id] is False:
                         if line and (
                             not line.is_same_side(
-                                xc, yc, self.detected[oid]["xc"], self.detected[oid]["yc"]
+                                xc, yc, state.xc, state.yc
                             )
                         ):
-                            self.detected[oid]["expired"][line.id] = True
+                            state.expired[line.id] = True
                             print("*** new object counted", flush=True)
                             print("*** id: ", oid, flush=True)
-                            print("***", self.detected[oid], flush=True)
                             print("*** (x, y)", xc, yc, flush=True)
                             self.counter[line.id] += 1
-                            counted.append(self.detected[oid])
-                self.detected[oid]["xc"] = xc
-                self.detected[oid]["yc"] = yc
+                            counted.append(state)
+                state.xc = xc
+                state.yc = yc
             else:
-                self.detected[oid] = {"xc": xc, "yc": yc, "expired": {}}
+                self.detected.add(oid, xc=xc, yc=yc, expired={})
+        self.detected.sync(objs, self.tracker.get_alive_ids())
 
         return [self.counter, objs, counted]
 
@@ -244,7 +253,7 @@ class DefeatDetection(Scenario):
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
         self.max_people = 5
-        self.detected = {}
+        self.detected = TrackStore()
         self.ok_counter = 0
         self.ng_counter = 0
         self.objs_with_labels = []
@@ -326,32 +335,29 @@ class DefeatDetection(Scenario):
             xc, yc = compute_center(x1, y1, x2, y2)
 
             if oid in self.detected:
-                self.detected[oid]["score"] = score
+                state = self.detected[oid]
+                state.score = score
                 if tag == self.ng_name:
-                    self.detected[oid]["tag"] = tag
-                if self.detected[oid]["expired"] is False:
+                    state.tag = tag
+                if state.expired is False:
                     if self.line and (
                         not self.line.is_same_side(
-                            xc, yc, self.detected[oid]["xc"], self.detected[oid]["yc"]
+                            xc, yc, state.xc, state.yc
                         )
                     ):
-                        self.detected[oid]["expired"] = True
-                        if self.detected[oid]["tag"] == self.ok_name:
+                        state.expired = True
+                        if state.tag == self.ok_name:
                             self.ok_counter += 1
-                        elif self.detected[oid]["tag"] == self.ng_name:
+                        elif state.tag == self.ng_name:
                             self.ng_counter += 1
-                        # counted.append(self.detected[oid])
+                        # counted.append(state)
                     else:
-                        self.detected[oid]["xc"] = xc
-                        self.detected[oid]["yc"] = yc
+                        state.xc = xc
+                        state.yc = yc
             else:
-                self.detected[oid] = {
-                    "xc": xc,
-                    "yc": yc,
-                    "expired": False,
-                    "tag": tag,
-                    "score": score,
-                }
+                self.detected.add(oid, xc=xc, yc=yc, expired=False, tag=tag,
+                                  score=score)
+        self.detected.sync(objs, self.tracker.get_alive_ids())
         return [{self.ok_name: self.ok_counter, self.ng_name: self.ng_counter}]
 
     def draw_counter(self, img):
@@ -410,7 +416,7 @@ class DefeatDetection(Scenario):
             rectangle_color = (255, 255, 255)
             text_color = (0, 0, 0)
 
-            tag = self.detected[oid]["tag"]
+            tag = self.detected[oid].tag
             if tag == "Bottle - NG":
                 rectangle_color = (0, 0, 255)
                 text_color = (255, 255, 255)
@@ -420,7 +426,7 @@ class DefeatDetection(Scenario):
                 #                  (0, 255, 255), thickness)
                 img = draw_label(img, str(oid), (x1, y1))
             if is_tag:
-                score = self.detected[oid]["score"]
+                score = self.detected[oid].score
                 text = tag + " ( " + str(int(1000 * score) / 10) + "% )"
                 img = draw_label(
                     img, text, (x1, max(y1, 15)), rectangle_color, text_color
@@ -439,10 +445,11 @@ class DangerZone(Scenario):
         self.tracker = Tracker(
             max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold
         )
-        self.detected = {}
+        self.detected = TrackStore()
         self.counter = {}
         self.current_counter = {}
         self.zones = []
+        self.compiled_zones = CompiledZones([])
         self.targets = []
         self.threshold = threshold
         self.has_new_event = False
@@ -502,14 +509,18 @@ class DangerZone(Scenario):
 
             self.counter[_zone.id] = {'current': 0, 'total': 0}
             self.zones.append(_zone)
+        self.compiled_zones = CompiledZones(
+            [zone.points for zone in self.zones])
 
     def is_inside_zones(self, x1, y1, x2, y2):
-        # obj_shape = Polygon([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
-        for zone in self.zones:
-            if zone.is_inside(x1, y1, x2, y2):
-                # if zone.is_valid and zone.intersects(obj_shape):
-                return True
-        return False
+        return bool(self.compiled_zones.intersects([[x1, y1, x2, y2]]).any())
+
+    def get_inside_zones(self, boxes):
+        """get_inside_zones.
+
+        Returns an (N boxes, N zones) bool array, columns follow self.zones.
+        """
+        return self.compiled_zones.intersects([box[:4] for box in boxes])
 
     def update(self, detections):
         detections = list(d for d in detections if d.score > self.threshold)
@@ -527,33 +538,30 @@ class DangerZone(Scenario):
         for zone in self.zones:
             self.counter[zone.id]['current'] = 0
 
-        for obj in objs:
+        inside_zones = self.get_inside_zones(objs)
+        for obj, inside in zip(objs, inside_zones):
             x1, y1, x2, y2, oid = obj
             if oid in self.detected:
-                for zone in self.zones:
-                    if zone.is_inside(x1, y1, x2, y2):
+                state = self.detected[oid]
+                for zone, is_inside in zip(self.zones, inside):
+                    if is_inside:
                         self.counter[zone.id]['current'] += 1
-                    if zone.id not in self.detected[oid]["expired"].keys():
-                        self.detected[oid]["expired"][zone.id] = False
-                    if self.detected[oid]["expired"][zone.id] is False:
-                        if zone.is_inside(x1, y1, x2, y2):
-                            self.detected[oid]["expired"][zone.id] = True
+                    if zone.id not in state.expired.keys():
+                        state.expired[zone.id] = False
+                    if state.expired[zone.id] is False:
+                        if is_inside:
+                            state.expired[zone.id] = True
                             print("*** new object counted", flush=True)
                             has_new_event = True
                             self.counter[zone.id]['total'] += 1
-                            # counted.append(self.detected[oid])
-                self.detected[oid]["x1"] = x1
-                self.detected[oid]["y1"] = y1
-                self.detected[oid]["x2"] = x2
-                self.detected[oid]["y2"] = y2
+                            # counted.append(state)
+                state.x1 = x1
+                state.y1 = y1
+                state.x2 = x2
+                state.y2 = y2
             else:
-                self.detected[oid] = {
-                    "x1": x1,
-                    "y1": y1,
-                    "x2": x2,
-                    "y2": y2,
-                    "expired": {},
-                }
+                self.detected.add(oid, x1=x1, y1=y1, x2=x2, y2=y2, expired={})
+        self.detected.sync(objs, self.tracker.get_alive_ids())
         self.has_new_event = has_new_event
 
         return [self.counter, objs, counted]
@@ -701,43 +709,39 @@ class CountingZone(DangerZone):
         for zone in self.zones:
             self.counter[zone.id]['current'] = 0
 
-        for detection in detections:
-            for zone in self.zones:
-                x1, y1, x2, y2, score = detection
-                if zone.is_inside(x1, y1, x2, y2):
+        for inside in self.get_inside_zones(detections):
+            for zone, is_inside in zip(self.zones, inside):
+                if is_inside:
                     self.counter[zone.id]['current'] += 1
 
-        for obj in objs:
+        inside_zones = self.get_inside_zones(objs)
+        for obj, inside in zip(objs, inside_zones):
             x1, y1, x2, y2, oid = obj
             if oid in self.detected:
-                for zone in self.zones:
+                state = self.detected[oid]
+                for zone, is_inside in zip(self.zones, inside):
                     # count current object according to original detections (above)
-                    # if zone.is_inside(x1, y1, x2, y2):
+                    # if is_inside:
                     #     self.counter[zone.id]['current'] += 1
-                    if zone.id not in self.detected[oid]["expired"].keys():
-                        self.detected[oid]["expired"][zone.id] = False
-                    if self.detected[oid]["expired"][zone.id] is False:
-                        if zone.is_inside(x1, y1, x2, y2):
-                            self.detected[oid]["expired"][zone.id] = True
+                    if zone.id not in state.expired.keys():
+                        state.expired[zone.id] = False
+                    if state.expired[zone.id] is False:
+                        if is_inside:
+                            state.expired[zone.id] = True
                             print("*** new object counted", flush=True)
                             # compare time with end_time
                             if datetime.datetime.utcnow() < self.counting_end_time:
                                 self.counter[zone.id]['total'] += 1
                             else:
                                 has_new_event = True
-                            # counted.append(self.detected[oid])
-                self.detected[oid]["x1"] = x1
-                self.detected[oid]["y1"] = y1
-                self.detected[oid]["x2"] = x2
-                self.detected[oid]["y2"] = y2
+                            # counted.append(state)
+                state.x1 = x1
+                state.y1 = y1
+                state.x2 = x2
+                state.y2 = y2
             else:
-                self.detected[oid] = {
-                    "x1": x1,
-                    "y1": y1,
-                    "x2": x2,
-                    "y2": y2,
-                    "expired": {},
-                }
+                self.detected.add(oid, x1=x1, y1=y1, x2=x2, y2=y2, expired={})
+        self.detected.sync(objs, self.tracker.get_alive_ids())
         self.has_new_event = has_new_event
 
         return [self.counter, objs, counted]
@@ -764,10 +768,9 @@ class QueueZone(DangerZone):
         for zone in self.zones:
             self.counter[zone.id]['current'] = 0
 
-        for detection in detections:
-            for zone in self.zones:
-                x1, y1, x2, y2, score = detection
-                if zone.is_inside(x1, y1, x2, y2):
+        for inside in self.get_inside_zones(detections):
+            for zone, is_inside in zip(self.zones, inside):
+                if is_inside:
                     self.counter[zone.id]['current'] += 1
 
         queue_total = 0
@@ -20,18 +20,22 @@ import numpy as np
 import uvicorn
 import zmq
 from fastapi import BackgroundTasks, FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 import extension_pb2_grpc
+import load_benchmark
 from api.models import (
     CamerasModel,
     PartDetectionModeEnum,
     PartsModel,
     StreamModel,
+    DeploymentModel,
     UploadModelBody,
     UpdateEndpointBody,
 )
 from arguments import ArgumentParser, ArgumentsType
+from batch_scheduler import get_batch_metrics
+from endpoint_clients import get_endpoint_status
 from exception_handler import PrintGetExceptionDetails
 from http_inference_engine import HttpInferenceEngine
 from inference_engine import InferenceEngine
@@ -39,7 +43,10 @@ from invoke import gm
 from logging_conf import logging_config
 # from model_wrapper import ONNXRuntimeModelDeploy
 from model_object import ModelObject
+from shared_frame import SharedFrameReader, is_valid_shm_name
+from retrain import get_retrain_metrics
 from stream_manager import StreamManager
+from telemetry import get_telemetry_metrics
 from utility import is_edge
 
 from cascade.voe_to_ovms import load_voe_config_from_json, voe_config_to_ovms_config
@@ -64,6 +71,7 @@ LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 IS_OPENCV = os.environ.get("IS_OPENCV", "false")
 
 NO_DISPLAY = os.environ.get("NO_DISPLAY", "false")
+GRPC_MAX_WORKERS = int(os.environ.get("GRPC_MAX_WORKERS", "32"))
 
 # Main thread
 
@@ -71,6 +79,10 @@ NO_DISPLAY = os.environ.get("NO_DISPLAY", "false")
 onnx = ModelObject()
 stream_manager = StreamManager(onnx)
 
+# last deployment applied by /apply
+deployment_mutex = threading.Lock()
+deployment_state = {}
+
 app = FastAPI(
     title="InferenceModule",
     description="Factory AI InferenceModule.",
@@ -150,6 +162,45 @@ async def predict_opencv(camera_id: str, edge: str, request: Request):
     return "", 204
 
 
+shm_readers = {}
+
+
+def get_shm_reader(shm_name):
+    reader = shm_readers.get(shm_name)
+    if reader is None or reader.is_stale():
+        if reader is not None:
+            reader.close()
+        reader = SharedFrameReader(shm_name)
+        shm_readers[shm_name] = reader
+    return reader
+
+
+@app.post("/predict_shm")
+def predict_shm(camera_id: str, shm_name: str, seq: int, offset: int,
+                height: int, width: int):
+    """predict.
+
+    Same as /predict_opencv but the frame is read from the shared memory
+    ring written by CVCaptureModule instead of the request body.
+    """
+    if not is_valid_shm_name(shm_name):
+        logger.warning("Invalid shared memory name %s", shm_name)
+        return "", 400
+    try:
+        img = get_shm_reader(shm_name).read(seq, offset, height, width)
+    except Exception:
+        logger.warning("Cannot open shared memory %s", shm_name)
+        return "", 404
+    if img is None:
+        logger.warning("Frame %s already overwritten in %s", seq, shm_name)
+        return "", 410
+
+    results = http_inference_engine.predict(camera_id, img)
+    if len(results) > 0:
+        return json.dumps({"inferences": results}), 200
+    return "", 204
+
+
 @app.get("/metrics")
 def metrics(cam_id: str):
     """metrics."""
@@ -161,6 +212,8 @@ def metrics(cam_id: str):
     last_prediction_count = {}
     is_gpu = onnx.is_gpu
     scenario_metrics = []
+    pipeline_metrics = {}
+    track_state_metrics = {}
     device = onnx.get_device()
 
     stream = stream_manager.get_stream_by_id_danger(cam_id)
@@ -172,6 +225,8 @@ def metrics(cam_id: str):
         average_inference_time = stream.average_inference_time
         last_prediction_count = stream.last_prediction_count
         scenario_metrics = stream.get_scenario_metrics()
+        pipeline_metrics = stream.get_pipeline_metrics()
+        track_state_metrics = stream.get_track_state_metrics()
         for tag in total.keys():
             if total[tag] == 0:
                 success_rate[tag] = 0
@@ -191,12 +246,55 @@ def metrics(cam_id: str):
         "average_inference_time": average_inference_time,
         "last_prediction_count": last_prediction_count,
         "scenario_metrics": scenario_metrics,
+        "pipeline_metrics": pipeline_metrics,
+        "track_state_metrics": track_state_metrics,
     }
 
 
+@app.get("/endpoint_status")
+def endpoint_status():
+    """endpoint_status.
+
+    Health of the pooled connections to model endpoints.
+    """
+    return get_endpoint_status()
+
+
+@app.get("/batch_metrics")
+def batch_metrics():
+    """batch_metrics.
+
+    Achieved batch size, queue wait and inference time of every backend
+    shared by the streams.
+    """
+    return {"schedulers": get_batch_metrics()}
+
+
+@app.get("/telemetry_metrics")
+def telemetry_metrics():
+    """telemetry_metrics.
+
+    Events aggregated, messages sent and spooled by the IoT Hub telemetry
+    dispatcher.
+    """
+    return get_telemetry_metrics()
+
+
+@app.get("/retrain_metrics")
+def retrain_metrics():
+    """retrain_metrics.
+
+    Frames sampled for retraining, dropped from the full queue, uploaded and
+    failed.
+    """
+    return get_retrain_metrics()
+
+
 @app.get("/update_part_detection_id")
 def update_part_detection_id(part_detection_id: int):
     """update_part_detection_id."""
+    onnx.part_detection_id = part_detection_id
+    _record_update(part_detection_id=part_detection_id)
     return "ok"
 
 
@@ -310,6 +408,63 @@ def update_model(request_body: UploadModelBody):
         return "ok"
 
 
+def _update_stream_cam(stream, cam, request_body, frame_rate, lva_mode):
+    """Apply the camera config of CamerasModel to its stream."""
+    cam_type = cam.type
+    cam_source = cam.source
+    cam_id = cam.id
+    cam_name = cam.name
+    # TODO: IF onnx.part_detection_mode == "PC" (PartCounting), use lines to count
+    line_info = cam.lines
+    zone_info = cam.zones
+
+    if cam.aoi:
+        aoi = json.loads(cam.aoi)
+        has_aoi = aoi["useAOI"]
+        aoi_info = aoi["AOIs"]
+        logger.info("aoi information")
+    else:
+        has_aoi = False
+        aoi_info = None
+
+    logger.info("Updating camera %s", cam_id)
+    # s.update_cam(cam_type, cam_source, cam_id, has_aoi, aoi_info, cam_lines)
+    # FIXME has_aoi
+    recording_duration = int(cam.recording_duration * 60)
+    stream.update_cam(
+        cam_type,
+        cam_source,
+        frame_rate,
+        recording_duration,
+        lva_mode,
+        request_body.ava_is_send,
+        cam_id,
+        cam_name,
+        has_aoi,
+        aoi_info,
+        onnx.detection_mode,
+        line_info,
+        zone_info,
+    )
+    stream.cascade_name = request_body.cascade_name
+    stream.send_video_to_cloud = cam.send_video_to_cloud
+    stream.send_video_to_cloud_parts = [
+        part.name for part in cam.send_video_to_cloud_parts
+    ]
+    stream.send_video_to_cloud_threshold = (
+        int(cam.send_video_to_cloud_threshold) * 0.01
+    )
+    stream.use_tracker = cam.enable_tracking
+
+    if stream.scenario:
+        logger.warning(stream.scenario)
+        if stream.model.detection_mode == 'TCC' and cam.counting_end_time != '':
+            stream.scenario.set_time(
+                cam.counting_start_time, cam.counting_end_time)
+    # recording_duration is set in topology, sould be handled in s.update_cam, not here
+    # stream.recording_duration = int(cam.recording_duration*60)
+
+
 @app.post("/update_cams")
 def update_cams(request_body: CamerasModel):
     """update_cams.
@@ -319,7 +474,6 @@ def update_cams(request_body: CamerasModel):
     """
     logger.info(request_body)
     frame_rate = request_body.fps
-    ava_is_send = request_body.ava_is_send
     stream_manager.update_streams([cam.id for cam in request_body.cameras])
     n = stream_manager.get_streams_num_danger()
     # frame_rate = onnx.update_frame_rate_by_number_of_streams(n)
@@ -336,60 +490,8 @@ def update_cams(request_body: CamerasModel):
         lva_mode = onnx.lva_mode
 
     for cam in request_body.cameras:
-        cam_type = cam.type
-        cam_source = cam.source
-        cam_id = cam.id
-        cam_name = cam.name
-        # TODO: IF onnx.part_detection_mode == "PC" (PartCounting), use lines to count
-        line_info = cam.lines
-        zone_info = cam.zones
-
-        if cam.aoi:
-            aoi = json.loads(cam.aoi)
-            has_aoi = aoi["useAOI"]
-            aoi_info = aoi["AOIs"]
-            logger.info("aoi information")
-        else:
-            has_aoi = False
-            aoi_info = None
-
-        logger.info("Updating camera %s", cam_id)
-        stream = stream_manager.get_stream_by_id(cam_id)
-        # s.update_cam(cam_type, cam_source, cam_id, has_aoi, aoi_info, cam_lines)
-        # FIXME has_aoi
-        recording_duration = int(cam.recording_duration * 60)
-        stream.update_cam(
-            cam_type,
-            cam_source,
-            frame_rate,
-            recording_duration,
-            lva_mode,
-            ava_is_send,
-            cam_id,
-            cam_name,
-            has_aoi,
-            aoi_info,
-            onnx.detection_mode,
-            line_info,
-            zone_info,
-        )
-        stream.cascade_name = request_body.cascade_name
-        stream.send_video_to_cloud = cam.send_video_to_cloud
-        stream.send_video_to_cloud_parts = [
-            part.name for part in cam.send_video_to_cloud_parts
-        ]
-        stream.send_video_to_cloud_threshold = (
-            int(cam.send_video_to_cloud_threshold) * 0.01
-        )
-        stream.use_tracker = cam.enable_tracking
-
-        if stream.scenario:
-            logger.warning(stream.scenario)
-            if stream.model.detection_mode == 'TCC' and cam.counting_end_time != '':
-                stream.scenario.set_time(
-                    cam.counting_start_time, cam.counting_end_time)
-        # recording_duration is set in topology, sould be handled in s.update_cam, not here
-        # stream.recording_duration = int(cam.recording_duration*60)
+        stream = stream_manager.get_stream_by_id(cam.id)
+        _update_stream_cam(stream, cam, request_body, frame_rate, lva_mode)
 
     logger.info("Streams %s", stream_manager.streams)
     return "ok"
@@ -422,6 +524,131 @@ def update_parts(parts: PartsModel):
     return "ok"
 
 
+def _update_stream_parameters(stream, request_body: DeploymentModel):
+    """Retrain, IoT Hub, threshold and max people of one stream."""
+    retrain = request_body.retrain
+    stream.update_retrain_parameters(
+        retrain.is_retrain,
+        retrain.confidence_min * 0.01,
+        retrain.confidence_max * 0.01,
+        retrain.max_images,
+    )
+    iothub = request_body.iothub
+    stream.update_iothub_parameters(iothub.is_send, iothub.threshold * 0.01,
+                                    iothub.fpm)
+    stream.threshold = request_body.prob_threshold * 0.01
+    stream.max_people = request_body.max_people
+    if stream.scenario:
+        stream.scenario.set_threshold(stream.threshold)
+        stream.scenario.set_max_people(stream.max_people)
+
+
+def _update_failed(result):
+    """Whether a setting endpoint answered with an error status."""
+    return isinstance(result, tuple) and result[1] >= 400
+
+
+def _apply_failed(version, section, result):
+    """Error response of /apply, the deployment stays unrecorded."""
+    logger.error("Deployment %s failed to update the %s: %s", version,
+                 section, result[0])
+    return JSONResponse(
+        {"status": "error", "version": version, "detail": result[0]},
+        status_code=result[1])
+
+
+def _record_update(**values):
+    """Keep the /apply state in sync with the single setting endpoints."""
+    with deployment_mutex:
+        deployment_state.pop("version", None)
+        deployment_state.update(values)
+
+
+@app.post("/apply")
+def apply(request_body: DeploymentModel):
+    """apply.
+
+    Apply a whole deployment in one call. The document is diffed against the
+    last applied one: only the changed sections are updated and only the
+    streams whose config changed are reset, the others keep running and
+    keep their metrics. Deployments are applied one at a time. The state is
+    only recorded once every step succeeded, a failed deployment returns the
+    error and is fully applied again by the next call.
+    """
+    global deployment_state
+
+    with deployment_mutex:
+        if request_body.version == deployment_state.get("version"):
+            logger.info("Deployment %s already applied", request_body.version)
+            return {"status": "unchanged", "version": request_body.version}
+
+        old = deployment_state
+        new = request_body.dict()
+        deployment_state = {}
+
+        def changed(key):
+            return new[key] != old.get(key)
+
+        logger.info("Applying deployment %s", request_body.version)
+        onnx.part_detection_id = request_body.part_detection_id
+        if changed("part_detection_mode"):
+            onnx.set_detection_mode(request_body.part_detection_mode.value)
+        if changed("endpoint") and request_body.endpoint:
+            result = update_endpoint(request_body.endpoint)
+            if _update_failed(result):
+                return _apply_failed(request_body.version, "endpoint", result)
+        if changed("model") and request_body.model:
+            model = request_body.model
+            if model.model_uri_fp16 and onnx.get_device() == "vpu":
+                model = UploadModelBody(model_uri=model.model_uri_fp16)
+            result = update_model(model)
+            if _update_failed(result):
+                return _apply_failed(request_body.version, "model", result)
+        if changed("parts"):
+            onnx.parts = [part.name for part in request_body.parts]
+            onnx.update_parts(onnx.parts)
+
+        # streams depending on a changed global setting are all updated
+        cameras = request_body.cameras
+        old_cameras = old.get("cameras") or {}
+        all_changed = (changed("part_detection_mode") or changed("parts") or
+                       any(new["cameras"][key] != old_cameras.get(key)
+                           for key in ("fps", "lva_mode", "ava_is_send",
+                                       "cascade_name")))
+        old_cams = {cam["id"]: cam for cam in old_cameras.get("cameras", [])}
+        changed_ids = {
+            cam.id for cam in cameras.cameras
+            if all_changed or cam.dict() != old_cams.get(cam.id)
+        }
+        parameters_changed = any(
+            changed(key)
+            for key in ("retrain", "iothub", "prob_threshold", "max_people"))
+
+        stream_manager.update_streams([cam.id for cam in cameras.cameras],
+                                      reset_metrics=False)
+        onnx.set_frame_rate(cameras.fps)
+        onnx.set_lva_mode(cameras.lva_mode)
+        updated = 0
+        for cam in cameras.cameras:
+            stream = stream_manager.get_stream_by_id(cam.id)
+            if cam.id in changed_ids:
+                stream.reset_metrics()
+                _update_stream_cam(stream, cam, cameras, cameras.fps,
+                                   cameras.lva_mode)
+            elif parameters_changed:
+                stream.reset_metrics()
+                stream.use_tracker = cam.enable_tracking
+            else:
+                continue
+            _update_stream_parameters(stream, request_body)
+            updated += 1
+
+        deployment_state = new
+        logger.info("Deployment %s applied, %s of %s streams updated",
+                    request_body.version, updated, len(cameras.cameras))
+        return {"status": "ok", "version": request_body.version}
+
+
 @app.get("/update_iothub_parameters")
 def update_iothub_parameters(is_send: bool, threshold: int, fpm: int):
     """update_iothub_parameters."""
@@ -476,6 +703,7 @@ def update_prob_threshold(prob_threshold: int):
     logger.info("Updating prob_threshold to")
     logger.info("  prob_threshold: %s", prob_threshold)
 
+    _record_update(prob_threshold=prob_threshold)
     for stream in stream_manager.get_streams():
         stream.threshold = int(prob_threshold) * 0.01
         if stream.scenario:
@@ -497,6 +725,7 @@ def update_max_people(max_people: int):
     logger.info("Updating max_people to")
     logger.info("  max_people: %s", max_people)
 
+    _record_update(max_people=max_people)
     for stream in stream_manager.get_streams():
         stream.max_people = int(max_people)
         if stream.scenario:
@@ -531,6 +760,29 @@ def get_recommended_total_fps():
     return {"fps": onnx.get_recommended_total_frame_rate()}
 
 
+@app.get("/benchmark")
+def get_benchmark():
+    """get_benchmark.
+
+    Report of the startup benchmark, with the capacity the recommended
+    frame rates are computed from. None while it is still running.
+    """
+    return onnx.benchmark
+
+
+@app.get("/stream_load")
+def stream_load():
+    """stream_load.
+
+    Queue depth, dropped frames and average inference time (ms) of every
+    stream, CVCaptureModule adapts the frame rate of each camera to it.
+    """
+    return {
+        stream.cam_id: stream.get_load()
+        for stream in stream_manager.get_streams()
+    }
+
+
 @app.get("/recommended_fps")
 def recommended_fps():
     return {"fps": onnx.get_recommended_total_frame_rate()}
@@ -570,7 +822,7 @@ class DisplayManager:
 
 
 @app.get("/video_feed")
-async def video_feed(cam_id: str):
+async def video_feed(cam_id: str, fps: float = None):
     if NO_DISPLAY == "true":
         return "ok"
     stream = stream_manager.get_stream_by_id(cam_id)
@@ -578,7 +830,7 @@ async def video_feed(cam_id: str):
         print("[INFO] Preparing Video Feed for stream %s" % cam_id, flush=True)
         stream.last_display_keep_alive = time.time()
         return StreamingResponse(
-            stream.gen(), media_type="multipart/x-mixed-replace; boundary=frame"
+            stream.gen(fps), media_type="multipart/x-mixed-replace; boundary=frame"
         )
     else:
         print("[Warning] Cannot find stream %s" % cam_id, flush=True)
@@ -661,77 +913,38 @@ def local_main():
 
 
 def benchmark():
-    """benchmark."""
-    # app.run(host='0.0.0.0', debug=False)
-    # s.update_cam(cam_type, cam_source, frame_rate, cam_id, has_aoi, aoi_info,
+    """benchmark.
+
+    Replay the sample video from a growing number of cameras against
+    PredictModule to fit its capacity, see load_benchmark. Runs in the
+    background on its own streams, the default frame rates are recommended
+    until it is done.
+    """
     SAMPLE_VIDEO = "./sample_video/video.mp4"
     SCENARIO1_MODEL = "scenario_models/1"
 
-    n_threads = 3
-    n_images = 15
     logger.info("============= BenchMarking (Begin) ==================")
-    logger.info("--- Settings ----")
-    logger.info("%s threads", n_threads)
-    logger.info("%s images", n_images)
-
-    stream_ids = list(str(i + 10000) for i in range(n_threads))
-    stream_manager.update_streams(stream_ids)
-    onnx.set_is_scenario(True)
-    r = requests.post(
-        "http://" + predict_module_url() + "/update_model",
-        json={"model_dir": SCENARIO1_MODEL}
-    )
-    # onnx.update_model(SCENARIO1_MODEL)
-    for s in stream_manager.get_streams():
-        s.set_is_benchmark(True)
-        s.update_cam("video", SAMPLE_VIDEO, 30,
-                     s.cam_id, False, False, None, "PC", [], [])
-
-    # vpu's first image take long time
-    img = cv2.imread("img.png")
-    s.predict(img)
-
-    def _f():
-        logger.info("--- Thread %s started---", threading.current_thread())
-        t0_t = time.time()
-        img = cv2.imread("img.png")
-        for i in range(n_images):
-            s.predict(img)
-        t1_t = time.time()
-        print("---- Thread", threading.current_thread(), "----", flush=True)
-        print("Processing", n_images, "images in",
-              t1_t - t0_t, "seconds", flush=True)
-        print("  Avg:", (t1_t - t0_t) / n_images *
-              1000, "ms per image", flush=True)
-
-    threads = []
-    for i in range(n_threads):
-        threads.append(threading.Thread(target=_f))
-    t0 = time.time()
-    for i in range(n_threads):
-        threads[i].start()
-    for i in range(n_threads):
-        threads[i].join()
-    t1 = time.time()
-    # print(t1-t0)
-    stream_manager.update_streams([])
-
-    discount = 0.75
-    max_total_frame_rate = discount * (n_images * n_threads) / (t1 - t0)
-
-    logger.info("---- Overall ----")
-    logger.info("Processing %s images in %s seconds",
-                n_images * n_threads, t1 - t0)
-    logger.info("  Avg: %s ms per image", (t1 - t0) /
-                (n_images * n_threads) * 1000)
-    logger.info("  Recommended Total FPS: %s", max_total_frame_rate)
+    with deployment_mutex:
+        # a deployment may have come first, keep its model
+        if not deployment_state and onnx.model_uri is None:
+            onnx.set_is_scenario(True)
+            r = requests.post(
+                "http://" + predict_module_url() + "/update_model",
+                json={"model_dir": SCENARIO1_MODEL}
+            )
+    benchmark_streams = StreamManager(onnx, sender=stream_manager.sender)
+    try:
+        result = load_benchmark.benchmark(benchmark_streams, [SAMPLE_VIDEO])
+    except Exception:
+        logger.exception("Benchmark failed, keep the default frame rates")
+        return
+    capacity = result["capacity"]
+    logger.info("  Max Total FPS: %s", capacity["max_total_fps"])
+    logger.info("  Max Camera FPS: %s", capacity["max_camera_fps"])
+    logger.info("  Sustainable Cameras at %s FPS: %s",
+                load_benchmark.BENCHMARK_FPS, capacity["sustainable_cameras"])
     logger.info("============= BenchMarking (End) ==================")
-
-    stream_manager.update_streams([])
-
-    max_total_frame_rate = max(1, max_total_frame_rate)
-    max_total_frame_rate = min(30, max_total_frame_rate)
-    onnx.set_max_total_frame_rate(max_total_frame_rate)
+    onnx.set_benchmark(result)
 
 
 def cvcapture_url():
@@ -821,7 +1034,10 @@ def main():
                 counter += 1
 
             # create gRPC server and start running
-            server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+            # each LVA stream keeps one worker for the lifetime of the call,
+            # the work itself runs on the stream pipeline
+            server = grpc.server(
+                futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS))
             extension_pb2_grpc.add_MediaGraphExtensionServicer_to_server(
                 InferenceEngine(stream_manager), server
             )
@@ -850,9 +1066,7 @@ if __name__ == "__main__":
     logger.info("is_edge: %s", is_edge())
 
     if is_edge():
-        print('==== Benchmark start ====', flush=True)
-        benchmark()
-        print('==== Benchmark  end  ====', flush=True)
+        threading.Thread(target=benchmark, daemon=True).start()
         main()
     else:
         logger.info("Assume running at local development.")
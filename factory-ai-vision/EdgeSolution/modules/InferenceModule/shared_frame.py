@@ -0,0 +1,158 @@
+"""Shared Frame.
+
+Ring of frame slots in /dev/shm shared by CVCaptureModule (writer) and
+InferenceModule (reader). The capture side copies each frame into a slot
+once and only sends (shm_name, seq, offset, height, width) to the inference
+side, which maps the ring read-only instead of receiving the frame over
+HTTP.
+
+Every slot starts with a (seq, height, width) header, zeroed by the writer
+while it fills the slot. The reader copies the frame out of the slot and
+checks the header against the announced values before and after the copy,
+so a slot recycled by the writer meanwhile is dropped instead of being
+read torn.
+
+Ring names come from requests, only [A-Za-z0-9_-] names are opened so a
+name cannot point outside /dev/shm.
+
+This file is shared by CVCaptureModule and InferenceModule, keep both
+copies in sync.
+"""
+
+import logging
+import mmap
+import os
+import re
+import struct
+
+import numpy as np
+
+from shared_memory import SharedMemoryManager
+
+logger = logging.getLogger(__name__)
+
+SHM_SLOT_COUNT = int(os.environ.get("SHM_SLOT_COUNT", "8"))
+SHM_MAX_FRAME_SIZE = 960 * 960 * 3  # Bytes, frames are resized to 960/540 edge
+
+HEADER_FORMAT = "<QII"  # seq, height, width
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SHM_DIR = "/dev/shm"
+SHM_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+
+def get_shm_name(cam_id):
+    return "cvcapture_" + re.sub(r"[^A-Za-z0-9_-]", "_", str(cam_id))
+
+
+def is_valid_shm_name(name):
+    return SHM_NAME_PATTERN.fullmatch(name) is not None
+
+
+class SharedFrameWriter:
+    def __init__(self, name, slot_count=SHM_SLOT_COUNT,
+                 frame_size=SHM_MAX_FRAME_SIZE):
+        self.name = name
+        self.slot_count = slot_count
+        self.slot_size = HEADER_SIZE + frame_size
+        self.seq = 0
+        # SharedMemoryManager.GetEmptySlot never reuses offset 0 once it is
+        # freed, keep one spare slot so the ring always fits
+        self.manager = SharedMemoryManager(
+            shmFlags=os.O_RDWR | os.O_CREAT,
+            name=name,
+            size=(slot_count + 1) * self.slot_size,
+        )
+
+    def write(self, img):
+        """write.
+
+        Copy the frame into the next slot, recycling the oldest one.
+        Returns the slot description to send to the reader, or None if the
+        frame does not fit.
+        """
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[0], img.shape[1]
+        if img.nbytes + HEADER_SIZE > self.slot_size:
+            logger.warning("Frame of %s bytes too large for %s", img.nbytes,
+                           self.name)
+            return None
+
+        self.seq += 1
+        self.manager.DeleteSlot(self.seq - self.slot_count)
+        address = self.manager.GetEmptySlot(self.seq, self.slot_size)
+        if address is None:
+            logger.warning("No empty slot in %s", self.name)
+            return None
+
+        begin = address[0]
+        offset = begin + HEADER_SIZE
+        shm = self.manager._shm
+        # invalidate the header while the frame is being written
+        shm[begin:offset] = struct.pack(HEADER_FORMAT, 0, 0, 0)
+        shm[offset:offset + img.nbytes] = img.tobytes()
+        shm[begin:offset] = struct.pack(HEADER_FORMAT, self.seq, height,
+                                        width)
+        return {
+            "shm_name": self.name,
+            "seq": self.seq,
+            "offset": offset,
+            "height": height,
+            "width": width,
+        }
+
+    def close(self):
+        try:
+            os.unlink(self.manager._shmFileFullPath)
+        except OSError:
+            pass
+
+
+class SharedFrameReader:
+    def __init__(self, name):
+        if not is_valid_shm_name(name):
+            raise ValueError("Invalid shared memory name {}".format(name))
+        self.name = name
+        self.path = os.path.join(SHM_DIR, name)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            self.inode = stat.st_ino
+            self.shm = mmap.mmap(fd, stat.st_size, mmap.MAP_SHARED,
+                                 mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+    def is_stale(self):
+        """is_stale.
+
+        True when the writer re-created the ring (stream restarted).
+        """
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def _header(self, offset):
+        return struct.unpack_from(HEADER_FORMAT, self.shm,
+                                  offset - HEADER_SIZE)
+
+    def read(self, seq, offset, height, width):
+        """read.
+
+        Returns a copy of the frame, or None if the slot was recycled by the
+        writer before or while it was copied.
+        """
+        size = height * width * 3
+        if offset < HEADER_SIZE or offset + size > len(self.shm):
+            return None
+        if self._header(offset) != (seq, height, width):
+            return None
+        img = np.frombuffer(self.shm, dtype=np.uint8, count=size,
+                            offset=offset).reshape(height, width, 3).copy()
+        if self._header(offset) != (seq, height, width):
+            return None
+        return img
+
+    def close(self):
+        self.shm.close()
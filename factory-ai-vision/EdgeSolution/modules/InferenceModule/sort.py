@@ -28,39 +28,41 @@ from skimage import io
 import glob
 import time
 import argparse
-from filterpy.kalman import KalmanFilter
 
 np.random.seed(0)
 
+try:
+  import lap
+except ImportError:
+  lap = None
+  from scipy.optimize import linear_sum_assignment
+
 
 def linear_assignment(cost_matrix):
-  try:
-    import lap
+  if lap is not None:
     _, x, y = lap.lapjv(cost_matrix, extend_cost=True)
     return np.array([[y[i],i] for i in x if i >= 0]) #
-  except ImportError:
-    from scipy.optimize import linear_sum_assignment
-    x, y = linear_sum_assignment(cost_matrix)
-    return np.array(list(zip(x, y)))
-
-
-def iou_batch(bb_test, bb_gt):                                                                                                   
-  """                                                                                                                      
-  From SORT: Computes IUO between two bboxes in the form [l,t,w,h]                                                         
-  """                                                                                                                      
-  bb_gt = np.expand_dims(bb_gt, 0)                                                                                         
-  bb_test = np.expand_dims(bb_test, 1)                                                                                     
-                                                                                                                           
-  xx1 = np.maximum(bb_test[..., 0], bb_gt[..., 0])                                                                         
-  yy1 = np.maximum(bb_test[..., 1], bb_gt[..., 1])                                                                         
-  xx2 = np.minimum(bb_test[..., 2], bb_gt[..., 2])                                                                         
-  yy2 = np.minimum(bb_test[..., 3], bb_gt[..., 3])                                                                         
-  w = np.maximum(0., xx2 - xx1)                                                                                            
-  h = np.maximum(0., yy2 - yy1)                                                                                            
-  wh = w * h                                                                                                               
-  o = wh / ((bb_test[..., 2] - bb_test[..., 0]) * (bb_test[..., 3] - bb_test[..., 1])                                      
-    + (bb_gt[..., 2] - bb_gt[..., 0]) * (bb_gt[..., 3] - bb_gt[..., 1]) - wh)                                              
-  return(o)  
+  x, y = linear_sum_assignment(cost_matrix)
+  return np.array(list(zip(x, y)))
+
+
+def iou_batch(bb_test, bb_gt):
+  """
+  From SORT: Computes IUO between two bboxes in the form [l,t,w,h]
+  """
+  bb_gt = np.expand_dims(bb_gt, 0)
+  bb_test = np.expand_dims(bb_test, 1)
+
+  xx1 = np.maximum(bb_test[..., 0], bb_gt[..., 0])
+  yy1 = np.maximum(bb_test[..., 1], bb_gt[..., 1])
+  xx2 = np.minimum(bb_test[..., 2], bb_gt[..., 2])
+  yy2 = np.minimum(bb_test[..., 3], bb_gt[..., 3])
+  w = np.maximum(0., xx2 - xx1)
+  h = np.maximum(0., yy2 - yy1)
+  wh = w * h
+  o = wh / ((bb_test[..., 2] - bb_test[..., 0]) * (bb_test[..., 3] - bb_test[..., 1])
+    + (bb_gt[..., 2] - bb_gt[..., 0]) * (bb_gt[..., 3] - bb_gt[..., 1]) - wh)
+  return(o)
 
 
 def convert_bbox_to_z(bbox):
@@ -69,13 +71,20 @@ def convert_bbox_to_z(bbox):
     [x,y,s,r] where x,y is the centre of the box and s is the scale/area and r is
     the aspect ratio
   """
-  w = bbox[2] - bbox[0]
-  h = bbox[3] - bbox[1]
-  x = bbox[0] + w/2.
-  y = bbox[1] + h/2.
+  return convert_bboxes_to_z(np.asarray(bbox, dtype=float)[None, :4]).reshape((4, 1))
+
+
+def convert_bboxes_to_z(bboxes):
+  """
+  Same as convert_bbox_to_z for an (n,4+) array, returns an (n,4) array
+  """
+  w = bboxes[:, 2] - bboxes[:, 0]
+  h = bboxes[:, 3] - bboxes[:, 1]
+  x = bboxes[:, 0] + w/2.
+  y = bboxes[:, 1] + h/2.
   s = w * h    #scale is just area
-  r = w / float(h)
-  return np.array([x, y, s, r]).reshape((4, 1))
+  r = w / h.astype(float)
+  return np.stack([x, y, s, r], axis=1)
 
 
 def convert_x_to_bbox(x,score=None):
@@ -91,64 +100,26 @@ def convert_x_to_bbox(x,score=None):
     return np.array([x[0]-w/2.,x[1]-h/2.,x[0]+w/2.,x[1]+h/2.,score]).reshape((1,5))
 
 
-class KalmanBoxTracker(object):
+def convert_xs_to_bboxes(xs):
   """
-  This class represents the internal state of individual tracked objects observed as bbox.
+  Same as convert_x_to_bbox for an (n,4+) array of states, returns an (n,4) array
   """
-  count = 0
-  def __init__(self,bbox):
-    """
-    Initialises a tracker using initial bounding box.
-    """
-    #define constant velocity model
-    self.kf = KalmanFilter(dim_x=7, dim_z=4) 
-    self.kf.F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]])
-    self.kf.H = np.array([[1,0,0,0,0,0,0],[0,1,0,0,0,0,0],[0,0,1,0,0,0,0],[0,0,0,1,0,0,0]])
-
-    self.kf.R[2:,2:] *= 10.
-    self.kf.P[4:,4:] *= 1000. #give high uncertainty to the unobservable initial velocities
-    self.kf.P *= 10.
-    self.kf.Q[-1,-1] *= 0.01
-    self.kf.Q[4:,4:] *= 0.01
-
-    self.kf.x[:4] = convert_bbox_to_z(bbox)
-    self.time_since_update = 0
-    self.id = KalmanBoxTracker.count
-    KalmanBoxTracker.count += 1
-    self.history = []
-    self.hits = 0
-    self.hit_streak = 0
-    self.age = 0
-
-  def update(self,bbox):
-    """
-    Updates the state vector with observed bbox.
-    """
-    self.time_since_update = 0
-    self.history = []
-    self.hits += 1
-    self.hit_streak += 1
-    self.kf.update(convert_bbox_to_z(bbox))
+  w = np.sqrt(xs[:, 2] * xs[:, 3])
+  h = xs[:, 2] / w
+  return np.stack([xs[:, 0]-w/2., xs[:, 1]-h/2., xs[:, 0]+w/2., xs[:, 1]+h/2.], axis=1)
 
-  def predict(self):
-    """
-    Advances the state vector and returns the predicted bounding box estimate.
-    """
-    if((self.kf.x[6]+self.kf.x[2])<=0):
-      self.kf.x[6] *= 0.0
-    self.kf.predict()
-    self.age += 1
-    if(self.time_since_update>0):
-      self.hit_streak = 0
-    self.time_since_update += 1
-    self.history.append(convert_x_to_bbox(self.kf.x))
-    return self.history[-1]
 
-  def get_state(self):
-    """
-    Returns the current bounding box estimate.
-    """
-    return convert_x_to_bbox(self.kf.x)
+#constant velocity model, same parameters the per-object filterpy tracker used
+KF_F = np.array([[1,0,0,0,1,0,0],[0,1,0,0,0,1,0],[0,0,1,0,0,0,1],[0,0,0,1,0,0,0],  [0,0,0,0,1,0,0],[0,0,0,0,0,1,0],[0,0,0,0,0,0,1]], dtype=float)
+KF_H = np.array([[1,0,0,0,0,0,0],[0,1,0,0,0,0,0],[0,0,1,0,0,0,0],[0,0,0,1,0,0,0]], dtype=float)
+KF_R = np.eye(4)
+KF_R[2:,2:] *= 10.
+KF_P0 = np.eye(7)
+KF_P0[4:,4:] *= 1000. #give high uncertainty to the unobservable initial velocities
+KF_P0 *= 10.
+KF_Q = np.eye(7)
+KF_Q[-1,-1] *= 0.01
+KF_Q[4:,4:] *= 0.01
 
 
 def associate_detections_to_trackers(detections,trackers,iou_threshold = 0.3):
@@ -170,43 +141,100 @@ def associate_detections_to_trackers(detections,trackers,iou_threshold = 0.3):
       matched_indices = linear_assignment(-iou_matrix)
   else:
     matched_indices = np.empty(shape=(0,2))
+  matched_indices = matched_indices.astype(int).reshape(-1, 2)
 
-  unmatched_detections = []
-  for d, det in enumerate(detections):
-    if(d not in matched_indices[:,0]):
-      unmatched_detections.append(d)
-  unmatched_trackers = []
-  for t, trk in enumerate(trackers):
-    if(t not in matched_indices[:,1]):
-      unmatched_trackers.append(t)
-
-  #filter out matched with low IOU
-  matches = []
-  for m in matched_indices:
-    if(iou_matrix[m[0], m[1]]<iou_threshold):
-      unmatched_detections.append(m[0])
-      unmatched_trackers.append(m[1])
-    else:
-      matches.append(m.reshape(1,2))
-  if(len(matches)==0):
-    matches = np.empty((0,2),dtype=int)
-  else:
-    matches = np.concatenate(matches,axis=0)
+  unmatched_detections = np.ones(len(detections), dtype=bool)
+  unmatched_detections[matched_indices[:,0]] = False
+  unmatched_trackers = np.ones(len(trackers), dtype=bool)
+  unmatched_trackers[matched_indices[:,1]] = False
+
+  #filter out matched with low IOU, they go after the unassigned ones
+  is_match = iou_matrix[matched_indices[:,0], matched_indices[:,1]] >= iou_threshold
+  matches = matched_indices[is_match]
+  unmatched_detections = np.concatenate([np.flatnonzero(unmatched_detections), matched_indices[~is_match, 0]])
+  unmatched_trackers = np.concatenate([np.flatnonzero(unmatched_trackers), matched_indices[~is_match, 1]])
 
-  return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+  return matches, unmatched_detections, unmatched_trackers
 
 
 class Sort(object):
+  #shared by every instance so ids are unique in the process
+  count = 0
+
   def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
     """
     Sets key parameters for SORT
+
+    Every track lives in a row of the state arrays so predict/update run
+    as one set of matrix ops for all tracks.
     """
     self.max_age = max_age
     self.min_hits = min_hits
     self.iou_threshold = iou_threshold
-    self.trackers = []
     self.frame_count = 0
 
+    self.x = np.empty((0, 7))          #states
+    self.P = np.empty((0, 7, 7))       #covariances
+    self.ids = np.empty(0, dtype=int)
+    self.time_since_update = np.empty(0, dtype=int)
+    self.hits = np.empty(0, dtype=int)
+    self.hit_streak = np.empty(0, dtype=int)
+    self.age = np.empty(0, dtype=int)
+
+  def _keep(self, mask):
+    self.x = self.x[mask]
+    self.P = self.P[mask]
+    self.ids = self.ids[mask]
+    self.time_since_update = self.time_since_update[mask]
+    self.hits = self.hits[mask]
+    self.hit_streak = self.hit_streak[mask]
+    self.age = self.age[mask]
+
+  def _predict(self):
+    """
+    Advances every state and returns the predicted bounding boxes
+    """
+    self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] = 0.
+    self.x = self.x @ KF_F.T
+    self.P = KF_F @ self.P @ KF_F.T + KF_Q
+    self.age += 1
+    self.hit_streak[self.time_since_update > 0] = 0
+    self.time_since_update += 1
+    return convert_xs_to_bboxes(self.x)
+
+  def _update(self, t, bboxes):
+    """
+    Updates the states of tracks t with observed bboxes
+    """
+    self.time_since_update[t] = 0
+    self.hits[t] += 1
+    self.hit_streak[t] += 1
+
+    x = self.x[t]
+    P = self.P[t]
+    y = convert_bboxes_to_z(bboxes) - x[:, :4]
+    PHT = P[:, :, :4]
+    S = P[:, :4, :4] + KF_R
+    K = PHT @ np.linalg.inv(S)
+    self.x[t] = x + (K @ y[:, :, None])[:, :, 0]
+    #Joseph form, as filterpy does
+    I_KH = np.eye(7) - K @ KF_H
+    self.P[t] = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ KF_R @ K.transpose(0, 2, 1)
+
+  def _create(self, bboxes):
+    n = len(bboxes)
+    x = np.zeros((n, 7))
+    x[:, :4] = convert_bboxes_to_z(bboxes)
+    self.x = np.concatenate([self.x, x])
+    self.P = np.concatenate([self.P, np.broadcast_to(KF_P0, (n, 7, 7))])
+    self.ids = np.concatenate([self.ids, np.arange(Sort.count, Sort.count + n)])
+    Sort.count += n
+    zeros = np.zeros(n, dtype=int)
+    self.time_since_update = np.concatenate([self.time_since_update, zeros])
+    self.hits = np.concatenate([self.hits, zeros])
+    self.hit_streak = np.concatenate([self.hit_streak, zeros])
+    self.age = np.concatenate([self.age, zeros])
+
   def update(self, dets=np.empty((0, 5))):
     """
     Params:
@@ -217,41 +245,38 @@ class Sort(object):
     NOTE: The number of objects returned may differ from the number of detections provided.
     """
     self.frame_count += 1
+    dets = np.asarray(dets, dtype=float)
+    if len(dets) == 0:
+      dets = np.empty((0, 5))
     # get predicted locations from existing trackers.
-    trks = np.zeros((len(self.trackers), 5))
-    to_del = []
-    ret = []
-    for t, trk in enumerate(trks):
-      pos = self.trackers[t].predict()[0]
-      trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-      if np.any(np.isnan(pos)):
-        to_del.append(t)
-    trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-    for t in reversed(to_del):
-      self.trackers.pop(t)
+    trks = self._predict()
+    valid = ~np.any(np.isnan(trks), axis=1)
+    if not valid.all():
+      self._keep(valid)
+      trks = trks[valid]
     matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets,trks, self.iou_threshold)
 
     # update matched trackers with assigned detections
-    for m in matched:
-      self.trackers[m[1]].update(dets[m[0], :])
+    if len(matched) > 0:
+      self._update(matched[:, 1], dets[matched[:, 0]])
 
     # create and initialise new trackers for unmatched detections
-    for i in unmatched_dets:
-        trk = KalmanBoxTracker(dets[i,:])
-        self.trackers.append(trk)
-    i = len(self.trackers)
-    for trk in reversed(self.trackers):
-        d = trk.get_state()[0]
-        if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
-          ret.append(np.concatenate((d,[trk.id+1])).reshape(1,-1)) # +1 as MOT benchmark requires positive
-        i -= 1
-        # remove dead tracklet
-        if(trk.time_since_update > self.max_age):
-          self.trackers.pop(i)
+    if len(unmatched_dets) > 0:
+      self._create(dets[unmatched_dets])
+
+    # reported newest first, as the per-object version did
+    order = np.arange(len(self.ids))[::-1]
+    show = (self.time_since_update < 1) & ((self.hit_streak >= self.min_hits) | (self.frame_count <= self.min_hits))
+    show = order[show[order]]
+    ret = np.concatenate([convert_xs_to_bboxes(self.x[show]), (self.ids[show] + 1)[:, None]], axis=1) # +1 as MOT benchmark requires positive
+
+    # remove dead tracklet
+    self._keep(self.time_since_update <= self.max_age)
     if(len(ret)>0):
-      return np.concatenate(ret)
+      return ret
     return np.empty((0,5))
 
+
 def parse_args():
     """Parse input arguments."""
     parser = argparse.ArgumentParser(description='SORT demo')
@@ -265,12 +290,46 @@ def parse_args():
                         help="Minimum number of associated detections before track is initialised.", 
                         type=int, default=3)
     parser.add_argument("--iou_threshold", help="Minimum IOU for match.", type=float, default=0.3)
+    parser.add_argument("--benchmark",
+                        help="Track this many synthetic people instead of reading MOT detections.",
+                        type=int, default=0)
+    parser.add_argument("--frames", help="Number of frames for --benchmark.", type=int, default=300)
     args = parser.parse_args()
     return args
 
+
+def benchmark(num_people, num_frames, max_age=1, min_hits=3, iou_threshold=0.3):
+  """
+  Crowded scene (QueueZone / CountingZone) benchmark: people walk with a
+  constant velocity on a 960x540 frame, 10% of the detections are missed
+  and a few false positives appear every frame.
+  """
+  rng = np.random.RandomState(0)
+  pos = rng.uniform(0, [900, 480], (num_people, 2))
+  vel = rng.normal(0, 2, (num_people, 2))
+  size = rng.uniform([20, 40], [40, 80], (num_people, 2))
+  frames = []
+  for _ in range(num_frames):
+    pos += vel
+    dets = np.concatenate([pos, pos + size, rng.uniform(0.3, 1, (num_people, 1))], axis=1)
+    dets = dets[rng.uniform(size=num_people) > 0.1]
+    noise = rng.uniform(0, [900, 480], (rng.randint(0, 5), 2))
+    noise = np.concatenate([noise, noise + 30, np.full((len(noise), 1), 0.3)], axis=1)
+    frames.append(np.concatenate([dets, noise]))
+
+  mot_tracker = Sort(max_age=max_age, min_hits=min_hits, iou_threshold=iou_threshold)
+  start_time = time.time()
+  for dets in frames:
+    mot_tracker.update(dets)
+  total_time = time.time() - start_time
+  print("Tracking %d people took: %.3f seconds for %d frames or %.1f FPS" % (num_people, total_time, num_frames, num_frames / total_time))
+
 if __name__ == '__main__':
   # all train
   args = parse_args()
+  if args.benchmark > 0:
+    benchmark(args.benchmark, args.frames, args.max_age, args.min_hits, args.iou_threshold)
+    exit()
   display = args.display
   phase = args.phase
   total_time = 0.0
@@ -10,13 +10,21 @@ logger = logging.getLogger(__name__)
 
 
 class StreamManager(object):
-    def __init__(self, model):
+    def __init__(self, model, sender=None):
+        """__init__.
+
+        Args:
+            model: ModelObject shared by the streams.
+            sender: zmq PUB socket of another manager to share, a new one
+                is bound on :5558 otherwise.
+        """
         self.streams = {}
         self.mutex = threading.Lock()
         self.model = model
         self.context = None
-        self.sender = None
-        self._init_zmq()
+        self.sender = sender
+        if sender is None:
+            self._init_zmq()
 
     def _init_zmq(self):
 
@@ -53,11 +61,12 @@ class StreamManager(object):
         streams = list(self.streams.values())
         return streams
 
-    def update_streams(self, stream_ids):
+    def update_streams(self, stream_ids, reset_metrics=True):
         self.mutex.acquire()
 
-        for stream in self.streams.values():
-            stream.reset_metrics()
+        if reset_metrics:
+            for stream in self.streams.values():
+                stream.reset_metrics()
 
         origin_stream_ids = list([stream_id for stream_id in self.streams])
 
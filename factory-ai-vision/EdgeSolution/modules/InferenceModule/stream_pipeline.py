@@ -0,0 +1,178 @@
+"""Stream Pipeline.
+
+Runs the work of one stream as decode -> infer -> scenario -> render stages.
+Each stage has its own worker threads and a small bounded queue. When a
+stage falls behind, the oldest waiting frame is dropped (latest frame wins)
+so the caller never blocks on inference.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+PIPELINE_INFER_WORKERS = int(os.environ.get("PIPELINE_INFER_WORKERS", "1"))
+
+
+class LatestFrameQueue:
+    def __init__(self, maxsize=PIPELINE_QUEUE_SIZE):
+        self.maxsize = max(1, maxsize)
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """get.
+
+        Returns None if nothing arrived before timeout.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout):
+                return None
+            return self.items.popleft()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+
+class PipelineStage:
+    def __init__(self, name, handler, workers=1, maxsize=PIPELINE_QUEUE_SIZE,
+                 next_stage=None, ordered=False):
+        """__init__.
+
+        Args:
+            name: stage name used in logs and metrics.
+            handler: callable taking the item of the previous stage. Its
+                return value is passed to next_stage, None stops the frame.
+            workers (int): number of worker threads.
+            maxsize (int): frames waiting before the oldest is dropped.
+            next_stage (PipelineStage): stage fed with handler results.
+            ordered (bool): drop frames older than the last one handled,
+                needed after a stage with several workers.
+        """
+        self.name = name
+        self.handler = handler
+        self.next_stage = next_stage
+        self.ordered = ordered
+        self.queue = LatestFrameQueue(maxsize)
+        self.is_alive = True
+
+        self.mutex = threading.Lock()
+        self.last_seq = 0
+        self.processed = 0
+        self.stale = 0
+        self.errors = 0
+        self.average_time = 0
+
+        for _ in range(max(1, workers)):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, seq, item):
+        self.queue.put((seq, item))
+
+    def stop(self):
+        self.is_alive = False
+
+    def _run(self):
+        while self.is_alive:
+            entry = self.queue.get(timeout=1)
+            if entry is None:
+                continue
+            seq, item = entry
+            if self.ordered:
+                with self.mutex:
+                    if seq <= self.last_seq:
+                        self.stale += 1
+                        continue
+                    self.last_seq = seq
+
+            s = time.time()
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                logger.warning("Pipeline stage %s failed: %s", self.name, e)
+                with self.mutex:
+                    self.errors += 1
+                continue
+            self._update_metrics(time.time() - s)
+
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(seq, result)
+
+    def _update_metrics(self, elapsed):
+        # moving avg, same weights as Stream.average_inference_time
+        with self.mutex:
+            self.processed += 1
+            self.average_time = (1 / 16 * elapsed * 1000 +
+                                 15 / 16 * self.average_time)
+
+    def get_metrics(self):
+        with self.mutex:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "dropped": self.queue.dropped + self.stale,
+                "processed": self.processed,
+                "errors": self.errors,
+                "average_time": self.average_time,
+            }
+
+
+class StreamPipeline:
+    def __init__(self, stream, infer_workers=PIPELINE_INFER_WORKERS):
+        self.seq = itertools.count(1)
+        self.render_stage = PipelineStage(
+            "render", lambda frame: stream.render(*frame))
+        self.scenario_stage = PipelineStage(
+            "scenario",
+            lambda frame: stream.update_scenario(*frame),
+            next_stage=self.render_stage,
+            ordered=True)
+        self.infer_stage = PipelineStage("infer",
+                                         stream.infer,
+                                         workers=infer_workers,
+                                         next_stage=self.scenario_stage)
+        self.decode_stage = PipelineStage("decode",
+                                          lambda decode: decode(),
+                                          next_stage=self.infer_stage)
+        self.stages = [
+            self.decode_stage,
+            self.infer_stage,
+            self.scenario_stage,
+            self.render_stage,
+        ]
+
+    def submit(self, image):
+        """submit.
+
+        Queue an already decoded frame.
+        """
+        self.infer_stage.put(next(self.seq), image)
+
+    def submit_encoded(self, decode):
+        """submit_encoded.
+
+        Queue a frame to be decoded by the decode stage, decode is a
+        callable returning the image.
+        """
+        self.decode_stage.put(next(self.seq), decode)
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def get_metrics(self):
+        return {stage.name: stage.get_metrics() for stage in self.stages}
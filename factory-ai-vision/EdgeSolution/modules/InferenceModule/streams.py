@@ -1,5 +1,6 @@
 import asyncio
-import base64
+import copy
+import functools
 import json
 import logging
 import os
@@ -12,13 +13,18 @@ import numpy as np
 import requests
 from io import BytesIO, BufferedReader
 from azure.iot.device import IoTHubModuleClient, Message
-from shapely.geometry import Polygon
 
 from api.models import StreamModel
+from batch_scheduler import get_batch_scheduler, is_batching_enabled
+from geometry import CompiledAoi
+from endpoint_clients import ENDPOINT_TIMEOUT, get_grpc_client, get_http_client
 from exception_handler import PrintGetExceptionDetails
 from invoke import gm
 
 # from tracker import Tracker
+from stream_pipeline import StreamPipeline
+from retrain import RetrainSampler, get_retrain_uploader
+from telemetry import get_telemetry_dispatcher
 from scenarios import DangerZone, DefeatDetection, Detection, PartCounter, PartDetection, ShelfZone, CountingZone, QueueZone
 from utility import draw_label, get_file_zip, is_edge, normalize_rtsp
 
@@ -27,7 +33,6 @@ import grpc
 import datetime
 from tensorflow import make_tensor_proto, make_ndarray
 from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2_grpc
 from ovms_utils import load_classes, postprocess
 from yolo_utils import yolo_eval
 
@@ -36,9 +41,6 @@ DETECTION_TYPE_SUCCESS = "success"
 DETECTION_TYPE_UNIDENTIFIED = "unidentified"
 DETECTION_BUFFER_SIZE = 10000
 
-# for Retraining
-UPLOAD_INTERVAL = 5
-
 LVA_MODE = os.environ.get("LVA_MODE", "grpc")
 IS_OPENCV = os.environ.get("IS_OPENCV", "false")
 IS_K8S = os.environ.get("IS_K8S", "false")
@@ -47,6 +49,9 @@ IOTEDGE_DEVICE_CONNECTION_STRING = os.environ.get(
 
 DISPLAY_KEEP_ALIVE_THRESHOLD = 10  # seconds
 
+# K8S sends telemetry directly to IoT Hub, edge through the module output
+IOTHUB_OUTPUT = None if IS_K8S == "true" else "metrics"
+
 try:
     if IS_K8S == "true":
         iot = IoTHubModuleClient.create_from_connection_string(
@@ -77,9 +82,11 @@ class Stream:
         self.send_video_to_cloud_parts = []
         self.recording_duration = 60
 
-        self.render = False
+        self.render_enabled = False
 
         self.mutex = threading.Lock()
+        # scenario is updated and drawn from different pipeline stages
+        self.scenario_mutex = threading.Lock()
 
         self.cam_type = cam_type
         self.cam_source = None
@@ -99,6 +106,10 @@ class Stream:
         self.last_recv_img = None
         # self.last_edge_img = None
         self.last_drawn_img = None
+        # jpg of last_drawn_img, only encoded while /video_feed is watched
+        self.jpg_mutex = threading.Lock()
+        self.last_jpg = None
+        self.last_jpg_update = 0
         self.last_prediction = []
         self.last_prediction_lva = []
         self.last_prediction_count = {}
@@ -107,7 +118,7 @@ class Stream:
         self.confidence_min = 30 * 0.01
         self.confidence_max = 80 * 0.01
         self.max_images = 10
-        self.last_upload_time = 0
+        self.retrain_sampler = None
         # self.is_upload_image = False
         # self.current_uploaded_images = {}
         self.edge = '960'
@@ -122,11 +133,15 @@ class Stream:
 
         self.has_aoi = False
         self.aoi_info = None
+        self.compiled_aoi = CompiledAoi([])
         # Part that we want to detect
         self.parts = []
 
         # self.is_gpu = (onnxruntime.get_device() == 'GPU')
         self.average_inference_time = 0
+        # frames being predicted synchronously (http), see get_load
+        self.pending_predictions = 0
+        self.pending_mutex = threading.Lock()
         self.counter = {}
 
         # IoT Hub
@@ -134,7 +149,6 @@ class Stream:
         self.iothub_ava_is_send = False
         self.iothub_threshold = 0.5
         self.iothub_fpm = 0
-        self.iothub_last_send_time = time.time()
         self.iothub_interval = 99999999
 
         # lva signal
@@ -155,6 +169,7 @@ class Stream:
         self.use_tracker = False
         self.stub = None
         self.cascade_name = None
+        self.pipeline = None
 
     def set_is_benchmark(self, is_benchmark):
         self.is_benchmark = is_benchmark
@@ -190,7 +205,7 @@ class Stream:
             cnt = 0
             while self.cam_is_alive:
 
-                if self.last_send == self.last_update:
+                if self.last_send == self.last_update or not self.display_is_alive():
                     time.sleep(0.03)
                     continue
                 cnt += 1
@@ -201,7 +216,7 @@ class Stream:
                 # FIXME may find a better way to deal with encoding
                 self.zmq_sender.send_multipart([
                     bytes(self.cam_id, "utf-8"),
-                    cv2.imencode(".jpg", self.last_drawn_img)[1].tobytes(),
+                    self.get_jpg()[0],
                 ])
                 self.last_send = self.last_update
                 # self.mutex.release()
@@ -215,6 +230,11 @@ class Stream:
             return self.scenario.get_metrics()
         return []
 
+    def get_track_state_metrics(self):
+        if self.scenario:
+            return self.scenario.get_track_state_metrics()
+        return {}
+
     def restart_cam(self):
 
         logger.warning("[INFO] Restarting Cam")
@@ -259,7 +279,7 @@ class Stream:
             self.lva_mode = lva_mode
             self.iothub_ava_is_send = ava_is_send
             self.recording_duration = recording_duration
-            if IS_OPENCV == "true":
+            if IS_OPENCV == "true" and not self.is_benchmark:
                 logger.info("post to CVModule")
                 data = {
                     "stream_id": self.cam_id,
@@ -276,6 +296,7 @@ class Stream:
         self.name = cam_name
         self.has_aoi = has_aoi
         self.aoi_info = aoi_info
+        self.compiled_aoi = CompiledAoi(aoi_info)
 
         detection_mode = self.model.get_detection_mode()
         if detection_mode == "PD":
@@ -458,7 +479,6 @@ class Stream:
         self.iothub_is_send = is_send
         self.iothub_threshold = threshold
         self.iothub_fpm = fpm
-        self.iothub_last_send_time = time.time()
         if fpm == 0:
             self.iothub_is_send = False
             self.iothub_interval = 99999999
@@ -475,10 +495,48 @@ class Stream:
             self._start()
             logger.info("Change lva_mode to {}".format(lva_mode))
 
+    def get_pipeline(self):
+        """get_pipeline.
+
+        Return the asynchronous pipeline of the stream, starting it on first
+        use.
+        """
+        with self.mutex:
+            if self.pipeline is None:
+                self.pipeline = StreamPipeline(self)
+            return self.pipeline
+
+    def get_pipeline_metrics(self):
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.get_metrics()
+
+    def get_load(self):
+        """get_load.
+
+        Back-pressure of the stream, polled by CVCaptureModule to adapt
+        the frame rate of the camera.
+        """
+        queue_depth = self.pending_predictions
+        dropped = 0
+        for metrics in self.get_pipeline_metrics().values():
+            queue_depth += metrics["queue_depth"]
+            dropped += metrics["dropped"]
+        return {
+            "queue_depth": queue_depth,
+            "dropped": dropped,
+            "average_inference_time": self.average_inference_time,
+        }
+
     def delete(self):
         # self.mutex.acquire()
         self.cam_is_alive = False
         # self.mutex.release()
+        if self.pipeline:
+            self.pipeline.stop()
+
+        if self.is_benchmark:
+            return
 
         if IS_OPENCV == "true":
             logger.info("get CVModule")
@@ -489,7 +547,28 @@ class Stream:
         logger.info("Deactivate stream {}".format(self.cam_id))
 
     def predict(self, image):
+        """predict.
 
+        Run every stage on the calling thread, see StreamPipeline for the
+        asynchronous version.
+        """
+        with self.pending_mutex:
+            self.pending_predictions += 1
+        try:
+            frame = self.infer(image)
+            if frame is None:
+                return
+            self.render(*self.update_scenario(*frame))
+        finally:
+            with self.pending_mutex:
+                self.pending_predictions -= 1
+
+    def infer(self, image):
+        """infer.
+
+        Returns (image, predictions, inf_time, width, height), or None if the
+        endpoint already updated the stream by itself (OVMS).
+        """
         width = self.IMG_WIDTH
         ratio = self.IMG_WIDTH / image.shape[1]
         height = int(image.shape[0] * ratio + 0.000001)
@@ -502,11 +581,19 @@ class Stream:
         # prediction
         # self.mutex.acquire()
         # predictions, inf_time = self.model.Score(image)
-        if ':7777/predict' in self.model.endpoint.lower():
+        if ':7777/predict' in self.model.endpoint.lower() and is_batching_enabled():
+            image = cv2.resize(image, (width, height))
+            scheduler = get_batch_scheduler(
+                self.model.endpoint,
+                functools.partial(predict_module_batch, self.model.endpoint))
+            lva_prediction, inf_time = scheduler.predict(image)
+            predictions = lva_to_customvision_format(lva_prediction)
+        elif ':7777/predict' in self.model.endpoint.lower():
             image = cv2.resize(image, (width, height))
             data = image.tobytes()
             endpoint = self.model.endpoint + "?edge=" + self.edge
-            res = requests.post(endpoint, data=data)
+            res = get_http_client(self.model.endpoint).post(endpoint,
+                                                            data=data)
             # logger.warning(res.json())
             if res.json()[1] == 200:
                 lva_prediction = json.loads(res.json()[0])['inferences']
@@ -522,7 +609,7 @@ class Stream:
             f4 = BytesIO(str_encode)
             f5 = BufferedReader(f4)
             s = time.time()
-            res = requests.post(self.model.endpoint, data=f5)
+            res = get_http_client(self.model.endpoint).post(data=f5)
             inf_time = time.time() - s
             # logger.warning(res.json())
             if res.status_code == 200:
@@ -543,20 +630,9 @@ class Stream:
             args["image_input_path"] = "./img/images-6.jpg"
             args["input_image_layout"] = "NHWC"
 
-            if not self.stub:
-                address = "{}:{}".format(args['grpc_address'],
-                                         args['grpc_port'])
-                MAX_MESSAGE_LENGTH = 1024 * 1024 * 1024
-                channel = grpc.insecure_channel(
-                    address,
-                    options=[
-                        ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
-                        ('grpc.max_receive_message_length',
-                         MAX_MESSAGE_LENGTH),
-                    ])
-
-                self.stub = prediction_service_pb2_grpc.PredictionServiceStub(
-                    channel)
+            address = "{}:{}".format(args['grpc_address'],
+                                     args['grpc_port'])
+            self.stub = get_grpc_client(address).stub
             request = predict_pb2.PredictRequest()
             request.model_spec.name = args['pipeline_name']
 
@@ -621,21 +697,7 @@ class Stream:
             self.last_update = time.time()
             return
         elif "ovmsserver" in self.model.endpoint.lower():
-            if not self.stub:
-                address = self.model.endpoint.lower()
-                if 'http://' in address:
-                    address = address[7:]
-                MAX_MESSAGE_LENGTH = 1024 * 1024 * 1024
-                channel = grpc.insecure_channel(
-                    address,
-                    options=[
-                        ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
-                        ('grpc.max_receive_message_length',
-                         MAX_MESSAGE_LENGTH),
-                    ])
-
-                self.stub = prediction_service_pb2_grpc.PredictionServiceStub(
-                    channel)
+            self.stub = get_grpc_client(self.model.endpoint).stub
             resized_image = cv2.resize(image, (416, 416))
             resized_image = resized_image
             self.predict_grpc(image, self.stub)
@@ -651,7 +713,7 @@ class Stream:
             f4 = BytesIO(str_encode)
             f5 = BufferedReader(f4)
             s = time.time()
-            res = requests.post(self.model.endpoint, data=f5)
+            res = get_http_client(self.model.endpoint).post(data=f5)
             inf_time = time.time() - s
             logger.warning(res.json())
             if res.status_code == 200:
@@ -663,19 +725,27 @@ class Stream:
             logger.warning('request prediction time: {}'.format(inf_time))
         # logger.warning('predictions', predictions )
         # self.mutex.release()
+        return image, predictions, inf_time, width, height
+
+    def update_scenario(self, image, predictions, inf_time, width, height):
+        """update_scenario.
 
+        Filter the predictions and update detection status, tracker and
+        scenario. Returns (image, predictions, has_new_event) for render.
+        """
         # check whether it's the tag we want
         predictions = list(p for p in predictions
                            if p["tagName"] in self.model.parts)
 
         # check whether it's inside aoi (if has)
         if self.has_aoi:
-            _predictions = []
+            boxes = []
             for p in predictions:
                 (x1, y1), (x2, y2) = parse_bbox(p, width, height)
-                if is_inside_aoi(x1, y1, x2, y2, self.aoi_info):
-                    _predictions.append(p)
-            predictions = _predictions
+                boxes.append([x1, y1, x2, y2])
+            is_inside = self.compiled_aoi.is_inside(boxes)
+            predictions = list(p for p, inside in zip(predictions, is_inside)
+                               if inside)
 
         # update detection status before filter out by threshold
         self.update_detection_status(predictions)
@@ -699,6 +769,9 @@ class Stream:
 
         # update the buffer
         # no need to copy since resize already did it
+        if not image.flags.writeable:
+            # frame mapped from shared memory, the slot will be recycled
+            image = image.copy()
         self.last_img = image
         self.last_prediction = np.array(predictions).tolist()
 
@@ -711,44 +784,44 @@ class Stream:
             (x1, y1), (x2, y2) = parse_bbox(prediction, width, height)
             _detections.append(
                 Detection(tag, x1, y1, x2, y2, prediction["probability"]))
-        if self.scenario:
-            update_ret = self.scenario.update(_detections)
-            if self.get_mode() in ['ES', 'DD', 'PC', 'TCC', 'CQA']:
-                self.counter = update_ret[0]
+        has_new_event = False
+        with self.scenario_mutex:
+            scenario = self.scenario
+            if scenario:
+                update_ret = scenario.update(_detections)
+                if self.get_mode() in ['ES', 'DD', 'PC', 'TCC', 'CQA']:
+                    self.counter = update_ret[0]
+                has_new_event = getattr(scenario, "has_new_event", False)
 
-        self.draw_img()
+        # update avg inference time (moving avg)
+        inf_time_ms = inf_time * 1000
+        self.average_inference_time = (1 / 16 * inf_time_ms +
+                                       15 / 16 * self.average_inference_time)
+        return image, predictions, has_new_event
 
-        if self.scenario:
-            if (self.get_mode() in ["ES", "TCC", "CQA"] and self.use_zone
-                    == True) or (self.get_mode() in ['DD', 'PD', 'PC']
-                                 and self.use_line == True):
-                self.scenario.draw_counter(self.last_drawn_img)
-            if self.get_mode() == "ESA":
-                self.scenario.draw_counter(self.last_drawn_img)
-            if self.get_mode() == "DD":
-                self.scenario.draw_objs(self.last_drawn_img)
-            if self.get_mode() == 'PD' and self.use_tracker is True:
-                self.scenario.draw_objs(self.last_drawn_img)
+    def render(self, image, predictions, has_new_event):
+        """render.
+
+        Draw the frame for /video_feed and publish events to IoT Hub / LVA.
+        Drawing is skipped while nobody watches /video_feed.
+        """
+        if self.display_is_alive():
+            self.draw_frame(image, predictions)
 
         if self.iothub_is_send:
             if self.get_mode() in ["ES", "ESA", "TCC", "CQA"]:
-                if self.scenario.has_new_event:
+                if has_new_event:
                     self.process_send_message_to_iothub(predictions)
             else:
                 self.process_send_message_to_iothub(predictions)
 
         if self.send_video_to_cloud:
             if self.get_mode() in ["ES", "ESA", "TCC", "CQA"]:
-                if self.scenario.has_new_event:
+                if has_new_event:
                     self.precess_send_signal_to_lva()
             else:
                 self.precess_send_signal_to_lva()
 
-        # update avg inference time (moving avg)
-        inf_time_ms = inf_time * 1000
-        self.average_inference_time = (1 / 16 * inf_time_ms +
-                                       15 / 16 * self.average_inference_time)
-
     def predict_grpc(self, image, stub):
 
         # width = self.IMG_WIDTH
@@ -760,7 +833,13 @@ class Stream:
         #     width = int(image.shape[1] * ratio + 0.000001)
 
         s = time.time()
-        detectedObjects = self.ovms_score(stub, image)
+        if is_batching_enabled():
+            scheduler = get_batch_scheduler(
+                (self.model.endpoint, self.cascade_name),
+                functools.partial(ovms_score_batch, stub, self.cascade_name))
+            detectedObjects = scheduler.predict(image)
+        else:
+            detectedObjects = self.ovms_score(stub, image)
         inf_time = time.time() - s
 
         img, predictions = process_response(
@@ -790,20 +869,7 @@ class Stream:
         print("Start processing:")
         print(f"\tModel name: {model_name}")
 
-        image = np.array(image, dtype=np.float32)
-        image = cv2.resize(image, (416, 416))
-        image = image.reshape((1, 416, 416, 3))
-
-        request = predict_pb2.PredictRequest()
-        request.model_spec.name = model_name
-        request.inputs[input_layer].CopyFrom(
-            make_tensor_proto(image, shape=(image.shape)))
-
-        # result includes a dictionary with all model outputs
-        try:
-            result = stub.Predict(request, 10.0)
-        except:
-            result = None
+        result = ovms_predict(stub, model_name, [image], input_layer)
 
         # yolo_outputs = [[], [], []]
         # for output_layer in output_layers:
@@ -824,53 +890,47 @@ class Stream:
         return result
 
     def process_retrain_image(self, predictions, img):
-        for prediction in predictions:
-            if self.last_upload_time + UPLOAD_INTERVAL < time.time():
-                confidence = prediction["probability"]
-                logger.warning("comparing... {} {} {}".format(self.confidence_min, confidence,
-                               self.confidence_max))
-                if self.confidence_min <= confidence <= self.confidence_max:
-                    logger.warning("preparing...")
-                    # prepare the data to send
-                    tag = prediction["tagName"]
-                    height, width = img.shape[0], img.shape[1]
-                    (x1, y1), (x2, y2) = parse_bbox(prediction, width, height)
-                    labels = json.dumps([{
-                        "x1": x1,
-                        "x2": x2,
-                        "y1": y1,
-                        "y2": y2
-                    }])
-                    jpg = cv2.imencode(".jpg", img)[1].tobytes()
+        """process_retrain_image.
+
+        Offer the frame to the retrain sampler, the selected frames are
+        uploaded in batches by a background worker.
+        """
+        part_detection_id = self.model.part_detection_id
+        if part_detection_id is None:
+            # nothing deployed yet, no part detection to upload to
+            return
+        if self.retrain_sampler is None:
+            self.retrain_sampler = RetrainSampler(
+                self.cam_id, get_retrain_uploader(web_module_url))
+        height, width = img.shape[0], img.shape[1]
 
-                    send_retrain_image_to_webmodule(jpg, tag, labels,
-                                                    confidence, self.cam_id)
+        def get_labels(prediction):
+            (x1, y1), (x2, y2) = parse_bbox(prediction, width, height)
+            return json.dumps([{"x1": x1, "x2": x2, "y1": y1, "y2": y2}])
 
-                    self.last_upload_time = time.time()
-                    break
+        self.retrain_sampler.offer(predictions, img, self.confidence_min,
+                                   self.confidence_max, get_labels,
+                                   part_detection_id)
 
     def process_send_message_to_iothub(self, predictions):
-        if self.iothub_last_send_time + self.iothub_interval < time.time():
-            if "ovmsserver" in self.model.endpoint.lower():
-                if len(predictions) > 0:
-                    message_body = {
-                        'camera_name': self.name,
-                        'inferences': predictions
-                    }
-                    send_message_to_iothub(message_body)
-                    self.iothub_last_send_time = time.time()
-            else:
-                predictions = list(p for p in predictions
-                                if p["probability"] >= self.threshold)
-                if len(predictions) > 0:
-                    message_body = {
-                        'camera_name': self.name,
-                        'inferences': predictions
-                    }
-                    if self.get_mode() in ['ES', 'DD', 'PC', 'TCC', 'CQA']:
-                        message_body['count'] = self.counter
-                    send_message_to_iothub(message_body)
-                    self.iothub_last_send_time = time.time()
+        """process_send_message_to_iothub.
+
+        Hand the detections to the telemetry dispatcher, which aggregates
+        them over iothub_interval and sends them in batches.
+        """
+        if not iot:
+            return
+        if "ovmsserver" not in self.model.endpoint.lower():
+            predictions = list(p for p in predictions
+                               if p["probability"] >= self.threshold)
+        if len(predictions) == 0:
+            return
+        count = None
+        if self.get_mode() in ['ES', 'DD', 'PC', 'TCC', 'CQA']:
+            # the scenario keeps updating its counter
+            count = copy.copy(self.counter)
+        get_telemetry_dispatcher(iot, IOTHUB_OUTPUT).put(
+            self.cam_id, self.name, predictions, self.iothub_interval, count)
 
     def precess_send_signal_to_lva(self):
         if self.lva_last_send_time + self.lva_interval < time.time():
@@ -894,12 +954,31 @@ class Stream:
                 self.lva_last_send_time = time.time()
                 self.lva_interval = 80
 
-    def draw_img(self):
+    def draw_frame(self, image, predictions):
+        img = self.draw_img(image, predictions)
+
+        with self.scenario_mutex:
+            scenario = self.scenario
+            if scenario:
+                if (self.get_mode() in ["ES", "TCC", "CQA"] and self.use_zone
+                        == True) or (self.get_mode() in ['DD', 'PD', 'PC']
+                                     and self.use_line == True):
+                    scenario.draw_counter(img)
+                if self.get_mode() == "ESA":
+                    scenario.draw_counter(img)
+                if self.get_mode() == "DD":
+                    scenario.draw_objs(img)
+                if self.get_mode() == 'PD' and self.use_tracker is True:
+                    scenario.draw_objs(img)
+
+        self.last_drawn_img = img
+        self.last_update = time.time()
+
+    def draw_img(self, image, predictions):
 
-        img = self.last_img.copy()
+        img = image.copy()
 
         height, width = img.shape[0], img.shape[1]
-        predictions = self.last_prediction
 
         if self.has_aoi:
             draw_aoi(img, self.aoi_info)
@@ -918,8 +997,7 @@ class Stream:
                                   (255, 255, 255), 1)
                     draw_confidence_level(img, prediction)
 
-        self.last_drawn_img = img
-        self.last_update = time.time()
+        return img
 
     def to_api_model(self):
         return StreamModel(
@@ -933,21 +1011,41 @@ class Stream:
         self.last_display_keep_alive = time.time()
 
     def display_is_alive(self):
+        if self.last_display_keep_alive is None:
+            return False
         return self.last_display_keep_alive + DISPLAY_KEEP_ALIVE_THRESHOLD > time.time(
         )
 
-    def gen(self):
+    def get_jpg(self):
+        """get_jpg.
+
+        Encode last_drawn_img once per new frame, the bytes are shared by
+        every /video_feed client. Returns (jpg, last_update).
+        """
+        with self.jpg_mutex:
+            last_update = self.last_update
+            if self.last_drawn_img is not None and last_update > self.last_jpg_update:
+                self.last_jpg = cv2.imencode(".jpg",
+                                             self.last_drawn_img)[1].tobytes()
+                self.last_jpg_update = last_update
+            return self.last_jpg, self.last_jpg_update
+
+    async def gen(self, fps=None):
+        """gen.
+
+        MJPEG stream of the drawn frames, at most fps frames per second.
+        """
+        fps = fps or self.frameRate
+        loop = asyncio.get_event_loop()
+        last_sent = 0
         while self.cam_is_alive and self.display_is_alive():
-            if self.last_drawn_img is not None and self.last_update > self.last_send:
-                self.last_send = self.last_update
-                jpg = cv2.imencode(".jpg", self.last_drawn_img)[1].tobytes()
-                logger.warning('===== sneding jpg to browser, size: {}'.format(
-                    len(jpg)))
+            if self.last_drawn_img is not None and self.last_update > last_sent:
+                jpg, last_sent = await loop.run_in_executor(None, self.get_jpg)
                 yield (b"--frame\r\n"
                        b"Content-Type: image/jpeg\r\n\r\n" + jpg + b"\r\n")
-                time.sleep(1 / self.frameRate)
+                await asyncio.sleep(1 / fps)
             else:
-                time.sleep(0.04)
+                await asyncio.sleep(0.04)
 
 
 def predict_module_url():
@@ -991,29 +1089,7 @@ def draw_aoi(img, aoi_info):
 
 
 def is_inside_aoi(x1, y1, x2, y2, aoi_info):
-
-    obj_shape = Polygon([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
-
-    for aoi_area in aoi_info:
-        aoi_type = aoi_area["type"]
-        label = aoi_area["label"]
-
-        if aoi_area["type"] == "BBox":
-            if ((label["x1"] <= x1 <= label["x2"]) or
-                (label["x1"] <= x2 <= label["x2"])) and (
-                    (label["y1"] <= y1 <= label["y2"]) or
-                    (label["y1"] <= y2 <= label["y2"])):
-                return True
-
-        elif aoi_area["type"] == "Polygon":
-            points = []
-            for point in label:
-                points.append([point["x"], point["y"]])
-            aoi_shape = Polygon(points)
-            if aoi_shape.is_valid and aoi_shape.intersects(obj_shape):
-                return True
-
-    return False
+    return bool(CompiledAoi(aoi_info).is_inside([[x1, y1, x2, y2]])[0])
 
 
 def parse_bbox(prediction, width, height):
@@ -1046,25 +1122,6 @@ def draw_confidence_level(img, prediction):
     return img
 
 
-def send_message_to_iothub(predictions):
-    global iot
-    if iot:
-        try:
-            if IS_K8S == "true":
-                # re-open connection to avodi connection failure
-                iot = IoTHubModuleClient.create_from_connection_string(
-                    IOTEDGE_DEVICE_CONNECTION_STRING)
-                iot.send_message(json.dumps(predictions))
-            else:
-                iot.send_message_to_output(json.dumps(predictions), "metrics")
-        except:
-            logger.warning("[ERROR] Failed to send message to iothub")
-        logger.warning("[INFO] sending metrics to iothub")
-    else:
-        # logger.warning('[METRICS]', json.dumps(predictions_to_send))
-        pass
-
-
 def send_message_to_lva(cam_id):
     if iot:
         try:
@@ -1080,26 +1137,6 @@ def send_message_to_lva(cam_id):
         pass
 
 
-def send_retrain_image_to_webmodule(jpg, tag, labels, confidence, cam_id):
-    logger.warning("[INFO] Sending Image to relabeling {}".format(tag))
-    try:
-        # requests.post('http://'+web_module_url()+'/api/relabel', data={
-        res = requests.post(
-            "http://" + web_module_url() +
-            "/api/part_detections/1/upload_relabel_image/",
-            data={
-                "confidence": confidence,
-                "labels": labels,
-                "part_name": tag,
-                "is_relabel": True,
-                "img": base64.b64encode(jpg),
-                "camera_id": cam_id,
-            },
-        )
-    except:
-        logger.warning("[ERROR] Failed to update image for relabeling")
-
-
 def lva_to_customvision_format(predictions):
     results = []
     for prediction in predictions:
@@ -1168,6 +1205,110 @@ def update_people_coordinate(output_nd, people):
     return people
 
 
+def predict_module_batch(endpoint, images):
+    """predict_module_batch.
+
+    Send frames from several streams to PredictModule in one request.
+    Returns one (lva_prediction, inf_time) per frame.
+    """
+    shapes = [list(image.shape[:2]) for image in images]
+    data = b"".join(np.ascontiguousarray(image).tobytes() for image in images)
+    res = get_http_client(endpoint).post(
+        endpoint + "_batch",
+        data=data,
+        headers={"X-Frame-Shapes": json.dumps(shapes)})
+    if res.json()[1] == 200:
+        result = json.loads(res.json()[0])
+        return [(inferences, result['inf_time'])
+                for inferences in result['inferences']]
+    logger.warning('No inference result')
+    return [([], 0) for _ in images]
+
+
+def ovms_predict(stub, model_name, images, input_layer="image",
+                 raise_errors=False):
+    """ovms_predict.
+
+    Resize the frames to the model input and send them as one NHWC tensor.
+    Errors give None, unless raise_errors.
+    """
+    batch = np.stack([
+        cv2.resize(np.array(image, dtype=np.float32), (416, 416))
+        for image in images
+    ])
+
+    request = predict_pb2.PredictRequest()
+    request.model_spec.name = model_name
+    request.inputs[input_layer].CopyFrom(
+        make_tensor_proto(batch, shape=(batch.shape)))
+
+    # result includes a dictionary with all model outputs
+    try:
+        result = stub.Predict(request, ENDPOINT_TIMEOUT)
+    except:
+        if raise_errors:
+            raise
+        result = None
+    return result
+
+
+class OvmsBatchItem:
+    """One frame's share of a batched PredictResponse.
+
+    Exposes the same `outputs` mapping process_response reads.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+
+# models which rejected a batched request
+_ovms_unbatched_models = set()
+
+
+def ovms_score_batch(stub, model_name, images):
+    """ovms_score_batch.
+
+    Score the frames with one PredictRequest and split the outputs back per
+    frame. The cascade outputs are (detections x batch x ...), the frame
+    index is on axis 1. Models rejecting the batch dimension are sent one
+    request per frame from then on, other failures only for this batch.
+    """
+    if len(images) > 1 and model_name not in _ovms_unbatched_models:
+        try:
+            result = ovms_predict(stub, model_name, images, raise_errors=True)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+                logger.warning("Model %s does not support batching: %s",
+                               model_name, e)
+                _ovms_unbatched_models.add(model_name)
+            else:
+                logger.warning("Batched predict of %s failed: %s", model_name,
+                               e)
+            result = None
+        except Exception as e:
+            logger.warning("Batched predict of %s failed: %s", model_name, e)
+            result = None
+        if result is not None:
+            outputs = {
+                name: make_ndarray(result.outputs[name])
+                for name in result.outputs
+            }
+            if all(output.ndim >= 2 and output.shape[1] == len(images)
+                   for output in outputs.values()):
+                return [
+                    OvmsBatchItem({
+                        name: make_tensor_proto(output[:, i:i + 1])
+                        for name, output in outputs.items()
+                    }) for i in range(len(images))
+                ]
+            logger.warning(
+                "Outputs of %s are not batched on axis 1: %s", model_name,
+                {name: output.shape for name, output in outputs.items()})
+
+    return [ovms_predict(stub, model_name, [image]) for image in images]
+
+
 def process_response(response, img, metadatas):
     predictions = []
     # if response is not None:
@@ -0,0 +1,304 @@
+"""Telemetry Dispatcher.
+
+Streams hand their IoT Hub events to put(), which never blocks the frame
+loop. One worker thread aggregates the events of each camera over its send
+interval (60 / fpm): frames with detections, detections and max confidence
+per tag, plus the latest inferences and counter. Every TELEMETRY_FLUSH_INTERVAL
+the windows that ended are packed into as few messages as the IoT Hub size
+limit allows and sent with one long-lived client. Messages that cannot be
+sent are spooled to TELEMETRY_SPOOL_DIR and resent, oldest first, once the
+hub is reachable again.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_QUEUE_SIZE = int(os.environ.get("TELEMETRY_QUEUE_SIZE", "1000"))
+TELEMETRY_FLUSH_INTERVAL = float(os.environ.get("TELEMETRY_FLUSH_INTERVAL",
+                                                "1"))  # seconds
+TELEMETRY_RETRY_INTERVAL = float(os.environ.get("TELEMETRY_RETRY_INTERVAL",
+                                                "30"))  # seconds
+TELEMETRY_SPOOL_DIR = os.environ.get("TELEMETRY_SPOOL_DIR",
+                                     "/tmp/telemetry_spool")
+TELEMETRY_SPOOL_MAX_FILES = int(os.environ.get("TELEMETRY_SPOOL_MAX_FILES",
+                                               "1000"))
+# IoT Hub rejects device-to-cloud messages larger than 256 KB
+IOTHUB_MAX_MESSAGE_SIZE = 256 * 1024 - 1024
+
+
+class CameraWindow:
+    def __init__(self, cam_id, start):
+        self.cam_id = cam_id
+        self.start = start
+        self.camera_name = ""
+        self.interval = 0
+        self.frames = 0
+        self.detections = {}
+        self.max_confidence = {}
+        self.inferences = []
+        self.count = None
+
+    def add(self, event):
+        self.camera_name = event["camera_name"]
+        self.interval = event["interval"]
+        self.frames += 1
+        for p in event["inferences"]:
+            tag = p["tagName"]
+            self.detections[tag] = self.detections.get(tag, 0) + 1
+            self.max_confidence[tag] = max(self.max_confidence.get(tag, 0),
+                                           p["probability"])
+        self.inferences = event["inferences"]
+        if event.get("count") is not None:
+            self.count = event["count"]
+
+    def is_due(self, now):
+        return now >= self.start + self.interval
+
+    def summary(self, end):
+        """summary.
+
+        Keeps the camera_name / inferences / count of the former
+        per-frame messages, with the latest frame of the window.
+        """
+        summary = {
+            "camera_id": self.cam_id,
+            "camera_name": self.camera_name,
+            "window_start": self.start,
+            "window_end": end,
+            "frames": self.frames,
+            "detections": self.detections,
+            "max_confidence": self.max_confidence,
+            "inferences": self.inferences,
+        }
+        if self.count is not None:
+            summary["count"] = self.count
+        return summary
+
+
+def pack_messages(summaries, max_size=IOTHUB_MAX_MESSAGE_SIZE):
+    """pack_messages.
+
+    Join summaries into JSON arrays of at most max_size bytes. A summary too
+    large by itself is sent without its inferences.
+    """
+    messages = []
+    items = []
+    size = 2
+    for summary in summaries:
+        item = json.dumps(summary)
+        if len(item) + 2 > max_size:
+            summary = dict(summary, inferences=[], inferences_truncated=True)
+            item = json.dumps(summary)
+        if items and size + len(item) + 1 > max_size:
+            messages.append("[" + ",".join(items) + "]")
+            items = []
+            size = 2
+        items.append(item)
+        size += len(item) + 1
+    if items:
+        messages.append("[" + ",".join(items) + "]")
+    return messages
+
+
+class MessageSpool:
+    def __init__(self, path=TELEMETRY_SPOOL_DIR,
+                 max_files=TELEMETRY_SPOOL_MAX_FILES):
+        self.path = path
+        self.max_files = max_files
+        self.seq = 0
+        os.makedirs(path, exist_ok=True)
+
+    def files(self):
+        return sorted(f for f in os.listdir(self.path) if f.endswith(".json"))
+
+    def push(self, message):
+        self.seq += 1
+        name = "{:020d}-{:06d}.json".format(time.time_ns(), self.seq)
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(message)
+        files = self.files()
+        for name in files[:max(0, len(files) - self.max_files)]:
+            logger.warning("Telemetry spool full, drop %s", name)
+            os.remove(os.path.join(self.path, name))
+
+    def __len__(self):
+        return len(self.files())
+
+
+class TelemetryDispatcher:
+    def __init__(self, client, output="metrics", spool=None,
+                 flush_interval=TELEMETRY_FLUSH_INTERVAL,
+                 retry_interval=TELEMETRY_RETRY_INTERVAL,
+                 max_message_size=IOTHUB_MAX_MESSAGE_SIZE):
+        """__init__.
+
+        Args:
+            client: IoTHubModuleClient, kept for the lifetime of the
+                dispatcher.
+            output: module output of the messages, None to send them
+                directly to IoT Hub (K8S).
+            spool (MessageSpool): where unsent messages wait.
+            flush_interval (float): seconds between two flushes.
+            retry_interval (float): seconds before resending after a
+                failure.
+            max_message_size (int): bytes per message.
+        """
+        self.client = client
+        self.output = output
+        self.spool = spool if spool is not None else MessageSpool()
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_message_size = max_message_size
+
+        self.queue = queue.Queue(maxsize=TELEMETRY_QUEUE_SIZE)
+        self.windows = {}
+        self.retry_at = 0
+
+        self.mutex = threading.Lock()
+        self.events = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        self.is_alive = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, cam_id, camera_name, inferences, interval, count=None):
+        """put.
+
+        Queue one frame with detections. Never blocks: the event is dropped
+        if the dispatcher is behind.
+        """
+        event = {
+            "cam_id": cam_id,
+            "camera_name": camera_name,
+            "inferences": inferences,
+            "interval": interval,
+            "count": count,
+            "time": time.time(),
+        }
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self.mutex:
+                self.dropped += 1
+
+    def stop(self):
+        self.is_alive = False
+        self.thread.join()
+
+    def _run(self):
+        next_flush = time.time() + self.flush_interval
+        while self.is_alive:
+            try:
+                event = self.queue.get(
+                    timeout=max(0, next_flush - time.time()))
+                self._add(event)
+            except queue.Empty:
+                pass
+            if time.time() >= next_flush:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Telemetry flush failed")
+                next_flush = time.time() + self.flush_interval
+        # send what is left
+        while not self.queue.empty():
+            self._add(self.queue.get_nowait())
+        self.flush(force=True)
+
+    def _add(self, event):
+        window = self.windows.get(event["cam_id"])
+        if window is None:
+            window = CameraWindow(event["cam_id"], event["time"])
+            self.windows[event["cam_id"]] = window
+        window.add(event)
+        with self.mutex:
+            self.events += 1
+
+    def flush(self, force=False):
+        """flush.
+
+        Send the windows that ended, or every window if force.
+        """
+        now = time.time()
+        summaries = []
+        for cam_id, window in list(self.windows.items()):
+            if force or window.is_due(now):
+                summaries.append(window.summary(now))
+                del self.windows[cam_id]
+
+        messages = pack_messages(summaries, self.max_message_size)
+        if now >= self.retry_at:
+            self._resend_spool()
+        for message in messages:
+            if now < self.retry_at or not self._send(message):
+                self.spool.push(message)
+
+    def _send(self, message):
+        try:
+            if self.output:
+                self.client.send_message_to_output(message, self.output)
+            else:
+                self.client.send_message(message)
+        except Exception as e:
+            logger.warning("Failed to send telemetry to iothub: %s", e)
+            self.retry_at = time.time() + self.retry_interval
+            with self.mutex:
+                self.failed += 1
+            return False
+        with self.mutex:
+            self.sent += 1
+        return True
+
+    def _resend_spool(self):
+        for name in self.spool.files():
+            path = os.path.join(self.spool.path, name)
+            with open(path) as f:
+                message = f.read()
+            if not self._send(message):
+                return
+            os.remove(path)
+
+    def get_metrics(self):
+        with self.mutex:
+            return {
+                "events": self.events,
+                "dropped": self.dropped,
+                "sent": self.sent,
+                "failed": self.failed,
+                "spooled": len(self.spool),
+                "queue_depth": self.queue.qsize(),
+            }
+
+
+_dispatcher = None
+_dispatcher_mutex = threading.Lock()
+
+
+def get_telemetry_dispatcher(client, output="metrics"):
+    """get_telemetry_dispatcher.
+
+    Return the dispatcher shared by every stream, creating it on first use.
+    """
+    global _dispatcher
+    with _dispatcher_mutex:
+        if _dispatcher is None:
+            logger.info("Creating telemetry dispatcher")
+            _dispatcher = TelemetryDispatcher(client, output)
+        return _dispatcher
+
+
+def get_telemetry_metrics():
+    with _dispatcher_mutex:
+        dispatcher = _dispatcher
+    if dispatcher is None:
+        return {}
+    return dispatcher.get_metrics()
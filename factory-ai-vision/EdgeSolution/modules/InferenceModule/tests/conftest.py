@@ -0,0 +1,9 @@
+"""InferenceModule test configuration.
+
+Modules are imported as the service runs them, from the module directory.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
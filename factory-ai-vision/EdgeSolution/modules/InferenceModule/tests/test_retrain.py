@@ -0,0 +1,70 @@
+"""Retrain uploader tests.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import requests
+
+import retrain
+from retrain import RetrainSample, RetrainUploader
+
+
+class FakeWebModule:
+    """Answers the relabel uploads with the given status codes."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.urls = []
+
+    def post(self, url, data, files, timeout):
+        self.urls.append(url)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return SimpleNamespace(status_code=answer, text="")
+
+
+@pytest.fixture
+def uploader():
+    return RetrainUploader(lambda: "webmodule:8000", retries=2, retry_delay=0)
+
+
+def sample(part_detection_id):
+    return RetrainSample("cam", part_detection_id,
+                         np.zeros((8, 8, 3), dtype=np.uint8), "bolt", "[]",
+                         0.5)
+
+
+def test_upload_to_deployed_part_detection(uploader, monkeypatch):
+    """Samples go to the part detection deployed when they were taken."""
+    web_module = FakeWebModule([200, 200])
+    monkeypatch.setattr(retrain.requests, "post", web_module.post)
+    uploader.upload([sample(3), sample(5), sample(3)])
+    assert web_module.urls == [
+        "http://webmodule:8000/api/part_detections/3/upload_relabel_images/",
+        "http://webmodule:8000/api/part_detections/5/upload_relabel_images/",
+    ]
+    assert uploader.get_metrics()["uploaded"] == 3
+
+
+def test_upload_retries_transient_failures(uploader, monkeypatch):
+    """Connection errors and 5xx are retried, the batch is kept."""
+    web_module = FakeWebModule([requests.ConnectionError(), 503, 200])
+    monkeypatch.setattr(retrain.requests, "post", web_module.post)
+    uploader.upload([sample(1)])
+    assert len(web_module.urls) == 3
+    assert uploader.get_metrics()["uploaded"] == 1
+    assert uploader.get_metrics()["failed"] == 0
+
+
+def test_upload_drops_rejected_batch(uploader, monkeypatch):
+    """4xx answers are not retried, neither is a failure after every retry."""
+    web_module = FakeWebModule([404, 500, 500, 500])
+    monkeypatch.setattr(retrain.requests, "post", web_module.post)
+    uploader.upload([sample(1)])
+    assert len(web_module.urls) == 1
+    uploader.upload([sample(1)])
+    assert len(web_module.urls) == 4
+    assert uploader.get_metrics()["failed"] == 2
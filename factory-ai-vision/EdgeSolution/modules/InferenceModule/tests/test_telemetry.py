@@ -0,0 +1,133 @@
+"""Telemetry dispatcher tests.
+"""
+
+import json
+import time
+
+import pytest
+
+import telemetry
+from telemetry import MessageSpool, TelemetryDispatcher, pack_messages
+
+
+class FakeHub:
+    """Local stand-in of IoTHubModuleClient recording sent messages."""
+
+    def __init__(self):
+        self.messages = []
+        self.is_online = True
+
+    def send_message(self, message):
+        if not self.is_online:
+            raise ConnectionError("IoT Hub unreachable")
+        self.messages.append(json.loads(message))
+
+    def send_message_to_output(self, message, output_name):
+        self.send_message(message)
+
+    def summaries(self):
+        return [summary for message in self.messages for summary in message]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            pytest.fail("condition not met in {}s".format(timeout))
+        time.sleep(0.01)
+
+
+def inference(tag, probability):
+    return {"tagName": tag, "probability": probability}
+
+
+@pytest.fixture
+def hub():
+    return FakeHub()
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return MessageSpool(str(tmp_path / "spool"))
+
+
+def test_dispatcher_aggregates_camera_windows(hub, spool):
+    """Events of a camera are summarized once its send interval ended."""
+    dispatcher = TelemetryDispatcher(hub, spool=spool, flush_interval=0.02)
+    dispatcher.put("1", "cam 1", [inference("a", 0.5), inference("b", 0.7)], 0.2)
+    dispatcher.put("1", "cam 1", [inference("a", 0.9)], 0.2, count=3)
+    dispatcher.put("2", "cam 2", [inference("a", 0.6)], 60)
+
+    wait_for(lambda: hub.messages)
+    assert len(hub.messages) == 1
+    [summary] = hub.messages[0]
+    assert summary["camera_id"] == "1"
+    assert summary["camera_name"] == "cam 1"
+    assert summary["frames"] == 2
+    assert summary["detections"] == {"a": 2, "b": 1}
+    assert summary["max_confidence"] == {"a": 0.9, "b": 0.7}
+    assert summary["inferences"] == [inference("a", 0.9)]
+    assert summary["count"] == 3
+    assert summary["window_end"] >= summary["window_start"] + 0.2
+
+    # the window of camera 2 is still open, stop sends it
+    dispatcher.stop()
+    assert [s["camera_id"] for s in hub.summaries()] == ["1", "2"]
+    assert dispatcher.get_metrics()["events"] == 3
+    assert dispatcher.get_metrics()["sent"] == 2
+
+
+def test_dispatcher_flush_packs_windows(hub, spool):
+    """A forced flush sends every open window, packed by message size."""
+    dispatcher = TelemetryDispatcher(hub, spool=spool, flush_interval=0.02,
+                                     max_message_size=400)
+    dispatcher.stop()
+    for i in range(4):
+        dispatcher._add({"cam_id": str(i), "camera_name": "cam", "interval": 60,
+                         "inferences": [inference("a", 0.5)], "count": None,
+                         "time": time.time()})
+
+    dispatcher.flush()
+    assert not hub.messages
+    dispatcher.flush(force=True)
+    assert len(hub.messages) > 1
+    assert sorted(s["camera_id"] for s in hub.summaries()) == ["0", "1", "2", "3"]
+    assert not dispatcher.windows
+
+
+def test_dispatcher_drops_events_when_behind(hub, spool, monkeypatch):
+    """put never blocks, events beyond the queue size are dropped."""
+    monkeypatch.setattr(telemetry, "TELEMETRY_QUEUE_SIZE", 2)
+    dispatcher = TelemetryDispatcher(hub, spool=spool, flush_interval=0.02)
+    dispatcher.stop()
+    for _ in range(5):
+        dispatcher.put("1", "cam 1", [inference("a", 0.5)], 60)
+    metrics = dispatcher.get_metrics()
+    assert metrics["dropped"] == 3
+    assert metrics["queue_depth"] == 2
+
+
+def test_dispatcher_spools_while_offline(hub, spool):
+    """Unsent messages are spooled and resent, oldest first."""
+    hub.is_online = False
+    dispatcher = TelemetryDispatcher(hub, spool=spool, flush_interval=0.02,
+                                     retry_interval=0)
+    dispatcher.put("1", "cam 1", [inference("a", 0.5)], 0)
+    wait_for(lambda: len(spool) == 1)
+    dispatcher.put("2", "cam 2", [inference("a", 0.5)], 0)
+    wait_for(lambda: len(spool) == 2)
+
+    hub.is_online = True
+    wait_for(lambda: len(spool) == 0)
+    dispatcher.stop()
+    assert [s["camera_id"] for s in hub.summaries()] == ["1", "2"]
+    assert dispatcher.get_metrics()["failed"] >= 2
+
+
+def test_pack_messages_truncates_large_summary():
+    """A summary over the size limit is sent without its inferences."""
+    summary = {"camera_id": "1", "inferences": [inference("a" * 500, 0.5)]}
+    [message] = pack_messages([summary], max_size=200)
+    assert json.loads(message) == [
+        {"camera_id": "1", "inferences": [], "inferences_truncated": True}
+    ]
@@ -0,0 +1,90 @@
+"""Track Store.
+
+Per-scenario state of tracked objects. Entries are evicted once the SORT
+tracker drops the track (its id never comes back), or when the track has
+not been reported for TRACK_STATE_TTL seconds, so memory stays flat on
+cameras running for weeks.
+"""
+
+import os
+import sys
+import time
+
+TRACK_STATE_TTL = float(os.environ.get("TRACK_STATE_TTL", "600"))  # seconds
+
+
+class TrackState:
+    __slots__ = ("x1", "y1", "x2", "y2", "xc", "yc", "expired", "tag",
+                 "score", "last_seen")
+
+    def __init__(self, x1=None, y1=None, x2=None, y2=None, xc=None, yc=None,
+                 expired=None, tag=None, score=None):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.xc = xc
+        self.yc = yc
+        # bool, or dict of line / zone id -> bool
+        self.expired = expired
+        self.tag = tag
+        self.score = score
+        self.last_seen = time.time()
+
+
+class TrackStore:
+    def __init__(self, ttl=TRACK_STATE_TTL):
+        self.states = {}
+        self.ttl = ttl
+        self.evicted = 0
+
+    def __contains__(self, oid):
+        return oid in self.states
+
+    def __getitem__(self, oid):
+        return self.states[oid]
+
+    def __len__(self):
+        return len(self.states)
+
+    def add(self, oid, **kwargs):
+        state = TrackState(**kwargs)
+        self.states[oid] = state
+        return state
+
+    def sync(self, objs, alive_ids):
+        """sync.
+
+        Call once per frame after the tracker update.
+
+        Args:
+            objs: tracker.get_objs(), the tracks reported in this frame.
+            alive_ids: tracker.get_alive_ids(), every track SORT still keeps.
+        """
+        now = time.time()
+        for obj in objs:
+            state = self.states.get(obj[4])
+            if state is not None:
+                state.last_seen = now
+
+        alive_ids = set(alive_ids)
+        expire_before = now - self.ttl
+        dead = [
+            oid for oid, state in self.states.items()
+            if oid not in alive_ids or state.last_seen < expire_before
+        ]
+        for oid in dead:
+            del self.states[oid]
+        self.evicted += len(dead)
+
+    def clear(self):
+        self.states = {}
+
+    def get_metrics(self):
+        return {
+            "size": len(self.states),
+            "evicted": self.evicted,
+            # states and the dict holding them, not the expired dicts
+            "memory": sys.getsizeof(self.states) +
+                      len(self.states) * sys.getsizeof(TrackState()),
+        }
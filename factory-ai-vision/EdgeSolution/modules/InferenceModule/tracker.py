@@ -2,6 +2,7 @@ from collections import namedtuple
 import numpy as np
 import cv2
 from shapely.geometry import Polygon
+from geometry import CompiledZones
 from sort import *
 
 #_m = (170 - 1487) / (680 - 815)
@@ -28,6 +29,10 @@ class Tracker():
     def get_objs(self):
         return self.objs
 
+    def get_alive_ids(self):
+        # same +1 offset as the ids in get_objs
+        return (self.tracker.ids + 1).tolist()
+
 
 class Line():
     def __init__(self, x1, y1, x2, y2):
@@ -97,14 +102,12 @@ class Rect():
 class Polygon_obj():
     def __init__(self, obj):
         self.id = None
+        self.points = obj
         self.polygon = Polygon(obj)
+        self.compiled = CompiledZones([obj])
 
     def is_inside(self, x1, y1, x2, y2):
-        obj_shape = Polygon([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
-        if self.polygon.is_valid and self.polygon.intersects(obj_shape):
-            return True
-        else:
-            return False
+        return bool(self.compiled.intersects([[x1, y1, x2, y2]])[0, 0])
 
 
 def draw_counter(img, counter):
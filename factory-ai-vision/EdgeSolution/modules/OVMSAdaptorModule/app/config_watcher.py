@@ -0,0 +1,129 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+# inotify events of the watched directory, editors and `mv` replace the file
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+# polling fallback, also a safety check when inotify is quiet
+POLL_INTERVAL = 3 # seconds
+SAFETY_CHECK_INTERVAL = 60 # seconds
+
+
+def _inotify_watch(dirpath):
+    """Return an inotify fd watching dirpath, None if inotify is not available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        wd = libc.inotify_add_watch(fd, dirpath.encode(),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class ConfigWatcher():
+    """Call on_change(content) each time the content of the file changes.
+
+    Changes are picked up through inotify, or by polling the file stat when
+    inotify is not available. The callback only runs when the content hash
+    differs from the last one loaded.
+    """
+    def __init__(self, path, on_change, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.digest = None
+        self.stat = None
+
+        self.reloads = 0
+        self.last_reload_latency = 0
+
+        self.th = threading.Thread(target=self._run, daemon=True)
+        self.th.start()
+
+    def _run(self):
+        fd = _inotify_watch(os.path.dirname(self.path) or '.')
+        if fd is None:
+            logging.info('inotify not available, polling {} every {}s'.format(self.path, self.poll_interval))
+        self.check()
+        while True:
+            if fd is None:
+                time.sleep(self.poll_interval)
+                self.check(use_stat=True)
+                continue
+
+            r, _, _ = select.select([fd], [], [], SAFETY_CHECK_INTERVAL)
+            if not r:
+                self.check(use_stat=True)
+                continue
+            if self._is_file_event(os.read(fd, 4096)):
+                self.check()
+
+    def _is_file_event(self, data):
+        name = os.path.basename(self.path)
+        offset = 0
+        found = False
+        while offset + IN_EVENT_HEADER.size <= len(data):
+            _, _, _, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            event_name = data[offset:offset + length].rstrip(b'\0').decode(errors='ignore')
+            offset += length
+            found = found or event_name == name
+        return found
+
+    def check(self, use_stat=False):
+        """Reload the file if its content changed.
+
+        With use_stat, the file is only read when its stat changed.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if use_stat and stat == self.stat:
+            return
+        self.stat = stat
+
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest == self.digest:
+            return
+
+        try:
+            self.on_change(content.decode())
+        except Exception as e:
+            logging.warning('Cannot load {}: {}'.format(self.path, e))
+            return
+        is_reload = self.digest is not None
+        self.digest = digest
+        if not is_reload:
+            logging.info('Loaded {}'.format(self.path))
+            return
+        self.reloads += 1
+        # from the file write to the new config in use
+        self.last_reload_latency = max(0, time.time() - st.st_mtime) * 1000 # ms
+        logging.info('Reloaded {} in {:.1f} ms'.format(self.path, self.last_reload_latency))
+
+    def get_metrics(self):
+        return {
+            'reloads': self.reloads,
+            'last_reload_latency': self.last_reload_latency,
+        }
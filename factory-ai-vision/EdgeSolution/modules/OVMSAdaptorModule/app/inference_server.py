@@ -49,8 +49,9 @@ class State:
 
 class InferenceServer(extension_pb2_grpc.MediaGraphExtensionServicer):
     def __init__(self, batchSize):
-        self.processor = OVMSBatchImageProcessor()
         self.batchSize = batchSize
+        # frames of every stream are batched together by the processor
+        self.processor = OVMSBatchImageProcessor(batchSize)
         return
 
     def process_media_sample(self, mediaStreamMessage, imageDetails):
@@ -131,8 +132,6 @@ class InferenceServer(extension_pb2_grpc.MediaGraphExtensionServicer):
         height = clientState._mediaStreamDescriptor.media_descriptor.video_frame_sample_format.dimensions.height
  
         # Process rest of the MediaStream message sequence
-        messageCount = 0
-        imageBatch = []
         for mediaStreamMessageRequest in requestIterator:
             try:
                 # Read request id, sent by client
@@ -145,37 +144,21 @@ class InferenceServer(extension_pb2_grpc.MediaGraphExtensionServicer):
                 # Increment request sequence number
                 responseSeqNum += 1
 
-                if(messageCount < self.batchSize):
-                    # Add images to batch and create acknowledge message
-                    logging.info('Adding image #{0} to batch.'.format(messageCount+1))
-                    mediaStreamMessage = extension_pb2.MediaStreamMessage(
-                                            sequence_number = responseSeqNum,
-                                            ack_sequence_number = requestSeqNum
-                                            )
-                    imageBatch.append(imageDetails)    
-                    messageCount += 1
+                # Blocks until the batch holding this frame has been inferred
+                mediaStreamMessage = extension_pb2.MediaStreamMessage()
+                mediaStreamMessage = self.process_media_sample(mediaStreamMessage, imageDetails)
+
+                if(mediaStreamMessage is None):
+                    # Respond with message without inferencing
+                    mediaStreamMessage = extension_pb2.MediaStreamMessage()     
+                    responseStatusMessage = "empty message for request seq = " + str(mediaStreamMessage.ack_sequence_number) + " response seq = " + str(responseSeqNum)
                 else:
-                    # Process batch
-                    logging.info('Processing batch ({0}).'.format(messageCount))
-                    mediaStreamMessage = extension_pb2.MediaStreamMessage()
-                    for image in imageBatch:
-                        mediaStreamMessage = self.process_media_sample(mediaStreamMessage, image)
-
-                    if(mediaStreamMessage is None):
-                        # Respond with message without inferencing
-                        mediaStreamMessage = extension_pb2.MediaStreamMessage()     
-                        responseStatusMessage = "empty message for request seq = " + str(mediaStreamMessage.ack_sequence_number) + " response seq = " + str(responseSeqNum)
-                    else:
-                        responseStatusMessage = "responding for message with request seq = " + str(mediaStreamMessage.ack_sequence_number) + " response seq = " + str(responseSeqNum)
-
-                    logging.info(responseStatusMessage)
-                    mediaStreamMessage.sequence_number = responseSeqNum
-                    mediaStreamMessage.ack_sequence_number = mediaStreamMessageRequest.sequence_number
-                    mediaStreamMessage.media_sample.timestamp = mediaStreamMessageRequest.media_sample.timestamp
-
-                    # Clear batch
-                    imageBatch.clear()
-                    messageCount = 0
+                    responseStatusMessage = "responding for message with request seq = " + str(mediaStreamMessage.ack_sequence_number) + " response seq = " + str(responseSeqNum)
+
+                logging.info(responseStatusMessage)
+                mediaStreamMessage.sequence_number = responseSeqNum
+                mediaStreamMessage.ack_sequence_number = requestSeqNum
+                mediaStreamMessage.media_sample.timestamp = timestamp
 
                 if context.is_active():
                     # yield response                        
@@ -15,7 +15,7 @@ def Main():
         parser = argparse.ArgumentParser()
         parser.add_argument('-p', nargs=1, metavar=('grpc_server_port'),
                                         help='Port number to serve gRPC server.', default=5001)
-        parser.add_argument('-b', nargs=1, metavar=('batch_size'),
+        parser.add_argument('-b', type=int, metavar=('batch_size'),
                                         help='Batch size.', default=1)
     
         _arguments = parser.parse_args()
@@ -25,6 +25,12 @@ def Main():
 
         # Default batch size 1
         batchSize = _arguments.b
+
+        # Get batch size from environment variable (overrides argument)
+        envBatchSize = os.getenv('BATCH_SIZE')
+
+        if(envBatchSize is not None):
+            batchSize = int(envBatchSize)
         
         # Get port from environment variable (overrides argument)
         envPort = os.getenv('port')
@@ -1,5 +1,6 @@
+import grpc
 import logging
-from PIL import Image, ImageDraw
+from PIL import ImageDraw
 import io
 import numpy as np
 from tensorflow import make_tensor_proto, make_ndarray
@@ -9,40 +10,63 @@ import media_pb2
 import extension_pb2
 import os
 import ovms
+import queue
 import time
+from concurrent.futures import Future
 
 from cascade.voe_to_ovms import load_voe_config_from_json, voe_config_to_ovms_config
+from config_watcher import ConfigWatcher
 
 import threading
 
-def process_voe_config(processor):
-    while True:
-        if os.path.exists('/workspace/voe_config.json'):
-            metadatas_json = open('/workspace/voe_config.json').read()
-            if metadatas_json != processor.metadatas_json:
-                print('Updating Metadatas...')
-                voe_config = load_voe_config_from_json(metadatas_json)
-                _, metadatas = voe_config_to_ovms_config(voe_config)
+OVMS_ADDRESS = 'ovmsserver:9001'
+VOE_CONFIG_PATH = '/workspace/voe_config.json'
+INPUT_SIZE = 416
+# how long the first frame of a batch waits for frames of other streams
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', '10')) / 1000 # ms
+METRICS_INTERVAL = 60 # seconds
+# batched predicts are retried this long after a failure other than a rejected shape
+BATCH_RETRY_INTERVAL = float(os.environ.get('BATCH_RETRY_INTERVAL', '60')) # seconds
 
-                processor.metadatas = metadatas
-                processor.metadatas_json = metadatas_json
+def update_voe_config(processor, metadatas_json):
+    print('Updating Metadatas...')
+    voe_config = load_voe_config_from_json(metadatas_json)
+    _, metadatas = voe_config_to_ovms_config(voe_config)
 
-        time.sleep(3)
+    # swapped in one assignment, frames in flight keep the previous metadatas
+    processor.metadatas = metadatas
+    processor.metadatas_json = metadatas_json
 
-def process_response(response, img, metadatas):
+def split_outputs(response, batch_size):
+    """Output arrays of each image of the batch, None if nothing was found.
+
+    The cascade outputs are (detections x batch x ...), the image index is
+    on axis 1.
+    """
+    if response is None:
+        return [None] * batch_size
+    outputs = {k: make_ndarray(v) for k, v in response.outputs.items()}
+    if batch_size == 1:
+        return [outputs]
+    for k, ndarray in outputs.items():
+        if ndarray.ndim < 2 or ndarray.shape[1] != batch_size:
+            raise ValueError('Output {} of shape {} is not batched'.format(k, ndarray.shape))
+    return [{k: ndarray[:, i:i+1] for k, ndarray in outputs.items()} for i in range(batch_size)]
+
+def process_response(outputs, img, metadatas):
     predictions = []
-    if response is not None:
-        coordinates = make_ndarray(response.outputs['coordinates'])
-        confidences = make_ndarray(response.outputs['confidences'])
+    if outputs is not None:
+        coordinates = outputs['coordinates']
+        confidences = outputs['confidences']
         attributes = []
 
-        for k in response.outputs:
+        for k in outputs:
             if (metadatas is not None) and (k in metadatas):
                 #print(k)
                 #print(metadatas[k])
                 metadata = metadatas[k]
                 if metadata['type'] == 'classification':
-                    ndarray = make_ndarray(response.outputs[k])
+                    ndarray = outputs[k]
                     tag_indexes = np.argmax(ndarray, axis=2).flatten()
                     tags = list(metadata['labels'][tag_index]
                                 for tag_index in tag_indexes)
@@ -54,7 +78,7 @@ def process_response(response, img, metadatas):
                         'confidences': confidences
                     })
                 if metadata['type'] == 'regression':
-                    ndarray = make_ndarray(response.outputs[k])
+                    ndarray = outputs[k]
                     scores = ndarray
                     if 'scale' in metadata:
                         scores *= metadata['scale']
@@ -114,34 +138,131 @@ def process_response(response, img, metadatas):
     #                fontScale, color, thickness, cv2.LINE_AA)
     return img, predictions
 
-class OVMSBatchImageProcessor():
-    def __init__(self):
+class OVMSBatcher():
+    """Coalesce the frames of every stream into one OVMS predict.
+
+    A batch is sent once batch_size frames are waiting, or BATCH_TIMEOUT
+    after its first frame. Frames are resized into a preallocated batch
+    buffer, and the outputs are split back to each caller.
+    """
+    def __init__(self, batch_size, timeout=BATCH_TIMEOUT):
         self.stub = None
-        self.metadatas = None
-        self.metadatas_json = ''
-        self.th = threading.Thread(target=process_voe_config, args=(self,))
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        # BGR HWC, as the cascade expects
+        self.inputs = np.zeros((self.batch_size, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+        self.resized = np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8)
+        self.supports_batch = True
+        self.batch_retry_time = 0
+
+        self.mutex = threading.Lock()
+        self.batches = 0
+        self.frames = 0
+        self.queue_wait = 0
+        self.metrics_time = time.time()
+
+        self.th = threading.Thread(target=self._run, daemon=True)
         self.th.start()
-    
-    def process_images(self, mediaStreamMessage, rawBytes, size):
 
-        #FIXME
+    def predict(self, rawBytes, size):
+        """Wait for the output arrays of the frame (raw RGB bytes of size (w, h))."""
+        future = Future()
+        self.queue.put((time.time(), rawBytes, size, future))
+        return future.result()
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.time() + self.timeout
+        while len(items) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _preprocess(self, index, rawBytes, size):
+        width, height = size
+        img = np.frombuffer(rawBytes, dtype=np.uint8).reshape(height, width, 3)
+        cv2.resize(img, (INPUT_SIZE, INPUT_SIZE), dst=self.resized)
+        np.copyto(self.inputs[index], self.resized, casting='unsafe')
+
+    def _predict(self, n):
         if self.stub is None:
-            self.stub = ovms.connect_ovms('ovmsserver:9001')
+            self.stub = ovms.connect_ovms(OVMS_ADDRESS)
+
+        if n > 1 and self.supports_batch and time.time() >= self.batch_retry_time:
+            try:
+                return split_outputs(ovms.predict(self.stub, self.inputs[:n]), n)
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+                    # cascade with a fixed batch size of 1
+                    logging.warning('Batch shape rejected by OVMS, sending frames one by one: {}'.format(e))
+                    self.supports_batch = False
+                else:
+                    self._delay_batching(e)
+            except Exception as e:
+                self._delay_batching(e)
+        if n == 1:
+            return split_outputs(ovms.predict(self.stub, self.inputs[:1]), 1)
+        return [split_outputs(ovms.predict(self.stub, self.inputs[i:i+1]), 1)[0] for i in range(n)]
 
-        # Read image raw bytes
-        im = Image.frombytes('RGB', size, rawBytes.tobytes())
-        #predictions = OVMS.predict
+    def _delay_batching(self, e):
+        logging.warning('Batched predict failed, sending frames one by one for {}s: {}'.format(
+            BATCH_RETRY_INTERVAL, e))
+        self.batch_retry_time = time.time() + BATCH_RETRY_INTERVAL
 
-        img = np.asarray(im)
-        img = img.astype(np.float32)  # BGR color format, shape HWC
+    def _run(self):
+        while True:
+            items = self._collect()
+            start = time.time()
+            try:
+                for i, (_, rawBytes, size, _) in enumerate(items):
+                    self._preprocess(i, rawBytes, size)
+                outputs = self._predict(len(items))
+            except Exception as e:
+                for item in items:
+                    item[3].set_exception(e)
+                continue
+            for item, output in zip(items, outputs):
+                item[3].set_result(output)
+            self._update_metrics(len(items), sum(start - item[0] for item in items))
+
+    def _update_metrics(self, batch_size, queue_wait):
+        with self.mutex:
+            self.batches += 1
+            self.frames += batch_size
+            self.queue_wait += queue_wait
+            if time.time() - self.metrics_time < METRICS_INTERVAL:
+                return
+            self.metrics_time = time.time()
+        logging.info('Batching metrics: {}'.format(self.get_metrics()))
+
+    def get_metrics(self):
+        with self.mutex:
+            return {
+                'batches': self.batches,
+                'frames': self.frames,
+                'average_batch_size': self.frames / self.batches if self.batches else 0,
+                'average_queue_wait': self.queue_wait / self.frames * 1000 if self.frames else 0, # ms
+                'supports_batch': self.supports_batch,
+            }
 
-        img = cv2.resize(img, (416, 416))
-        img_tensor = img.reshape(1, 416, 416, 3)
+class OVMSBatchImageProcessor():
+    def __init__(self, batch_size=1):
+        self.batcher = OVMSBatcher(batch_size)
+        self.metadatas = None
+        self.metadatas_json = ''
+        self.config_watcher = ConfigWatcher(
+            VOE_CONFIG_PATH, lambda metadatas_json: update_voe_config(self, metadatas_json))
+    
+    def process_images(self, mediaStreamMessage, rawBytes, size):
 
-        #predictions = [{'tag': 'aa', 'confidence': 0.5}]
-        response = ovms.predict(self.stub, img_tensor)
-        #print('1', flush=True)
-        img, predictions = process_response(response, img, self.metadatas)
+        outputs = self.batcher.predict(rawBytes, size)
+        img, predictions = process_response(outputs, None, self.metadatas)
         #print('2', flush=True)
 
 
@@ -215,3 +215,12 @@ class ONNXRuntimeModelDeploy(ObjectDetection):
         # self.lock.release()
 
         return predictions, inf_time
+
+    def ScoreBatch(self, images):
+
+        if hasattr(self.model, "predict_images"):
+            return self.model.predict_images(images)
+
+        start = time.time()
+        predictions = [self.model.predict_image(image)[0] for image in images]
+        return predictions, time.time() - start
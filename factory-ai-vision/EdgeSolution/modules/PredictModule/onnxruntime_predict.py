@@ -3,38 +3,228 @@
 # 2. resize network input size to (w', h')
 # 3. pass the image to network and do inference
 # (4. if inference speed is too slow for you, try to make w' x h' smaller, which is defined with DEFAULT_INPUT_SIZE (in object_detection.py or ObjectDetection.cs))
+import collections
+import hashlib
+import logging
+import math
 import os
 import sys
+import threading
+import time
+import cv2
 import onnxruntime
 import onnx
 import numpy as np
 from PIL import Image, ImageDraw
 from object_detection2 import ObjectDetection
-import tempfile
 
 MODEL_FILENAME = 'model/model.onnx'
 LABELS_FILENAME = 'model/labels.txt'
 
+# Fixed-shape mode: one session per network input shape, fed through
+# IOBinding from a preallocated NCHW buffer filled straight from the BGR frame.
+ORT_FIXED_SHAPE = os.environ.get('ORT_FIXED_SHAPE', 'false') == 'true'
+ORT_MAX_FIXED_SESSIONS = int(os.environ.get('ORT_MAX_FIXED_SESSIONS', '4'))
+# batches are padded up to one of these sizes so a few sessions cover every
+# batch size, larger batches are split at the biggest one
+ORT_BATCH_BUCKETS = sorted(int(size) for size in os.environ.get('ORT_BATCH_BUCKETS', '1,2,4,8').split(','))
+# 0 keeps the ONNX Runtime default
+ORT_INTRA_OP_THREADS = int(os.environ.get('ORT_INTRA_OP_THREADS', '0'))
+ORT_INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', '0'))
+# disable, basic, extended or all
+ORT_GRAPH_OPTIMIZATION = os.environ.get('ORT_GRAPH_OPTIMIZATION', 'all')
+# optimized models are saved there and reused on the next load, empty disables
+ORT_MODEL_CACHE_DIR = os.environ.get('ORT_MODEL_CACHE_DIR', '')
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_session_options(optimize=True):
+    options = onnxruntime.SessionOptions()
+    if ORT_INTRA_OP_THREADS > 0:
+        options.intra_op_num_threads = ORT_INTRA_OP_THREADS
+    if ORT_INTER_OP_THREADS > 0:
+        # inter-op threads are only used by the parallel executor
+        options.inter_op_num_threads = ORT_INTER_OP_THREADS
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    if optimize:
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS.get(
+            ORT_GRAPH_OPTIMIZATION, onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    else:
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+    return options
+
+
+def create_session(model, cache_name):
+    """Create an InferenceSession for the onnx model.
+
+    With ORT_MODEL_CACHE_DIR set, the optimized graph is saved as cache_name
+    and loaded as is next time, skipping the graph optimizations.
+    """
+    if ORT_MODEL_CACHE_DIR:
+        cache_path = os.path.join(ORT_MODEL_CACHE_DIR, '{}_{}'.format(ORT_GRAPH_OPTIMIZATION, cache_name))
+        if os.path.exists(cache_path):
+            try:
+                return onnxruntime.InferenceSession(
+                    cache_path, sess_options=get_session_options(optimize=False))
+            except Exception:
+                logger.warning('Cannot load cached model %s, rebuilding it', cache_path)
+        os.makedirs(ORT_MODEL_CACHE_DIR, exist_ok=True)
+        options = get_session_options()
+        options.optimized_model_filepath = cache_path
+        return onnxruntime.InferenceSession(model.SerializeToString(), sess_options=options)
+    return onnxruntime.InferenceSession(model.SerializeToString(), sess_options=get_session_options())
+
+
+class FixedShapeSession(object):
+    """Session of the model with every input dim pinned to input_shape (N x C x H x W)
+
+    Inputs are written into a preallocated buffer bound to the session with
+    IOBinding, so running a frame does not allocate or re-plan the graph.
+    """
+    def __init__(self, model, input_shape, cache_name):
+        model = onnx.ModelProto.FromString(model.SerializeToString())
+        for dim, size in zip(model.graph.input[0].type.tensor_type.shape.dim, input_shape):
+            dim.dim_value = size
+        self.session = create_session(model, cache_name)
+        self.mutex = threading.Lock()
+
+        session_input = self.session.get_inputs()[0]
+        dtype = np.float16 if session_input.type == 'tensor(float16)' else np.float32
+        self.inputs = np.zeros(input_shape, dtype=dtype)
+        # resized frames, reused for every frame of the batch
+        self.frame = np.zeros((input_shape[2], input_shape[3], input_shape[1]), dtype=np.uint8)
+
+        self.binding = self.session.io_binding()
+        self.binding.bind_input(session_input.name, 'cpu', 0, dtype,
+                                self.inputs.shape, self.inputs.ctypes.data)
+        session_output = self.session.get_outputs()[0]
+        self.outputs = None
+        if all(isinstance(size, int) for size in session_output.shape):
+            output_dtype = np.float16 if session_output.type == 'tensor(float16)' else np.float32
+            self.outputs = np.zeros(session_output.shape, dtype=output_dtype)
+            self.binding.bind_output(session_output.name, 'cpu', 0, output_dtype,
+                                     self.outputs.shape, self.outputs.ctypes.data)
+        else:
+            self.binding.bind_output(session_output.name, 'cpu')
+
+    def run(self, images):
+        """Evaluate BGR frames, returns the (H x W x C) outputs and the inference time.
+
+        Resize, HWC -> CHW and the float conversion are done in one pass per frame.
+        There may be fewer frames than the session batch, the padding slots keep
+        whatever they held and their outputs are dropped.
+        """
+        height, width = self.frame.shape[:2]
+        with self.mutex:
+            for buffer, image in zip(self.inputs, images):
+                cv2.resize(image, (width, height), dst=self.frame)
+                np.copyto(buffer, self.frame.transpose((2, 0, 1)), casting='unsafe')
+
+            start = time.time()
+            self.session.run_with_iobinding(self.binding)
+            inference_time = time.time() - start
+
+            outputs = self.outputs if self.outputs is not None else self.binding.copy_outputs_to_cpu()[0]
+            return [output.transpose((1, 2, 0)).astype(np.float32)
+                    for output in outputs[:len(images)]], inference_time
+
+
 class ONNXRuntimeObjectDetection(ObjectDetection):
     """Object Detection class for ONNX Runtime"""
-    def __init__(self, model_filename, labels):
+    def __init__(self, model_filename, labels, fixed_shape=ORT_FIXED_SHAPE):
         super(ONNXRuntimeObjectDetection, self).__init__(labels)
         model = onnx.load(model_filename)
-        with tempfile.TemporaryDirectory() as dirpath:
-            temp = os.path.join(dirpath, os.path.basename(MODEL_FILENAME))
-            model.graph.input[0].type.tensor_type.shape.dim[-1].dim_param = 'dim1'
-            model.graph.input[0].type.tensor_type.shape.dim[-2].dim_param = 'dim2'
-            onnx.save(model, temp)
-            # depends on the vpu image we choose
-            # predictmodule not using vpu
-            # if onnxruntime.get_device() == 'CPU-OPENVINO_CPU_FP32':
-            #     self.session = onnxruntime.InferenceSession(temp,
-            #         providers=onnxruntime.get_available_providers())
-            #     self.session.set_providers(['OpenVINOExecutionProvider'], [{'device_type' : "VAD-M_FP16"}])
-            # else:
-            self.session = onnxruntime.InferenceSession(temp)
+        self.model_digest = hashlib.sha1(model.SerializeToString()).hexdigest()[:16]
+        self.fixed_shape = fixed_shape
+        # fixed-shape sessions are built from the original graph
+        self.fixed_model = model if fixed_shape else None
+        self.fixed_sessions = collections.OrderedDict()
+        self.fixed_sessions_mutex = threading.Lock()
+
+        if fixed_shape:
+            model = onnx.ModelProto.FromString(model.SerializeToString())
+        model.graph.input[0].type.tensor_type.shape.dim[-1].dim_param = 'dim1'
+        model.graph.input[0].type.tensor_type.shape.dim[-2].dim_param = 'dim2'
+        model.graph.input[0].type.tensor_type.shape.dim[0].dim_param = 'batch'
+        # depends on the vpu image we choose
+        # predictmodule not using vpu
+        # if onnxruntime.get_device() == 'CPU-OPENVINO_CPU_FP32':
+        #     self.session = onnxruntime.InferenceSession(temp,
+        #         providers=onnxruntime.get_available_providers())
+        #     self.session.set_providers(['OpenVINOExecutionProvider'], [{'device_type' : "VAD-M_FP16"}])
+        # else:
+        self.session = create_session(model, '{}_dynamic.onnx'.format(self.model_digest))
         self.input_name = self.session.get_inputs()[0].name
         self.is_fp16 = self.session.get_inputs()[0].type == 'tensor(float16)'
+        self.supports_batch = True
+
+    def get_input_size(self, width, height):
+        """Network input size of a frame, same rule as preprocess"""
+        ratio = math.sqrt(self.DEFAULT_INPUT_SIZE / width / height)
+        return 32 * math.ceil(int(width * ratio) / 32), 32 * math.ceil(int(height * ratio) / 32)
+
+    @staticmethod
+    def get_batch_bucket(batch):
+        """Smallest bucket holding batch frames, the biggest one for larger batches"""
+        for size in ORT_BATCH_BUCKETS:
+            if size >= batch:
+                return size
+        return ORT_BATCH_BUCKETS[-1]
+
+    def get_fixed_session(self, batch, width, height):
+        input_shape = (batch, 3, height, width)
+        with self.fixed_sessions_mutex:
+            session = self.fixed_sessions.get(input_shape)
+            if session is not None:
+                self.fixed_sessions.move_to_end(input_shape)
+                return session
+
+            logger.info('Creating fixed-shape session for input %s', input_shape)
+            session = FixedShapeSession(
+                self.fixed_model, input_shape,
+                '{}_{}x{}x{}.onnx'.format(self.model_digest, batch, height, width))
+            self.fixed_sessions[input_shape] = session
+            if len(self.fixed_sessions) > ORT_MAX_FIXED_SESSIONS:
+                self.fixed_sessions.popitem(last=False)
+            return session
+
+    def predict_image(self, image):
+        if not self.fixed_shape:
+            return super(ONNXRuntimeObjectDetection, self).predict_image(image)
+
+        predictions, inference_time = self.predict_images([image])
+        return predictions[0], inference_time
+
+    def predict_images(self, images):
+        if not self.fixed_shape:
+            return super(ONNXRuntimeObjectDetection, self).predict_images(images)
+
+        groups = {}
+        for i, image in enumerate(images):
+            height, width = image.shape[:2]
+            groups.setdefault(self.get_input_size(width, height), []).append(i)
+
+        inference_time = 0
+        prediction_outputs = [None] * len(images)
+        for (width, height), indices in groups.items():
+            while indices:
+                bucket = self.get_batch_bucket(len(indices))
+                chunk, indices = indices[:bucket], indices[bucket:]
+                session = self.get_fixed_session(bucket, width, height)
+                outputs, elapsed = session.run([images[i] for i in chunk])
+                inference_time += elapsed
+                for i, output in zip(chunk, outputs):
+                    prediction_outputs[i] = output
+
+        return [self.postprocess(output) for output in prediction_outputs], inference_time
 
     def predict(self, preprocessed_image):
         inputs = np.array(preprocessed_image, dtype=np.float32)[np.newaxis,:,:,(2,1,0)] # RGB -> BGR
@@ -46,6 +236,24 @@ class ONNXRuntimeObjectDetection(ObjectDetection):
         outputs = self.session.run(None, {self.input_name: inputs})
         return np.squeeze(outputs).transpose((1,2,0)).astype(np.float32)
 
+    def predict_batch(self, preprocessed_images):
+        if len(preprocessed_images) == 1 or not self.supports_batch:
+            return super(ONNXRuntimeObjectDetection, self).predict_batch(preprocessed_images)
+
+        inputs = np.stack([np.array(image, dtype=np.float32)[:,:,(2,1,0)] for image in preprocessed_images]) # RGB -> BGR
+        inputs = np.ascontiguousarray(np.rollaxis(inputs, 3, 1))
+
+        if self.is_fp16:
+            inputs = inputs.astype(np.float16)
+
+        try:
+            outputs = self.session.run(None, {self.input_name: inputs})
+        except Exception:
+            # model graph is fixed to batch size 1
+            self.supports_batch = False
+            return super(ONNXRuntimeObjectDetection, self).predict_batch(preprocessed_images)
+        return [output.transpose((1,2,0)).astype(np.float32) for output in outputs[0]]
+
 #def main(image_filename):
 #    # Load labels
 #    with open(LABELS_FILENAME, 'r') as f:
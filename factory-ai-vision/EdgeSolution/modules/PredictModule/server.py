@@ -91,6 +91,29 @@ async def predict(edge: str, request: Request):
     # return "", 204
 
 
+@app.post("/predict_batch")
+async def predict_batch(request: Request):
+    """predict_batch.
+
+    Frames from several cameras, concatenated as raw BGR bytes. Their
+    shapes are listed in the X-Frame-Shapes header as [[height, width], ...].
+    """
+    img_raw = await request.body()
+    shapes = json.loads(request.headers["X-Frame-Shapes"])
+    imgs = []
+    offset = 0
+    for height, width in shapes:
+        size = height * width * 3
+        nparr = np.frombuffer(img_raw, np.uint8, count=size, offset=offset)
+        imgs.append(nparr.reshape(height, width, 3))
+        offset += size
+    predictions_list, inf_time = onnx.ScoreBatch(imgs)
+    results = [customvision_to_lva_format(predictions)
+               for predictions in predictions_list]
+
+    return json.dumps({"inferences": results, "inf_time": inf_time}), 200
+
+
 @app.post("/predict2")
 async def predict2(request: Request):
     """predict2."""
@@ -1,6 +1,7 @@
 """App API serializers.
 """
 
+import json
 import logging
 
 from drf_extra_fields.fields import Base64ImageField
@@ -149,6 +150,40 @@ class UploadRelabelSerializer(serializers.Serializer):
     camera_id = serializers.IntegerField()
 
 
+class UploadRelabelBatchSerializer(serializers.Serializer):
+    """UploadRelabelBatchSerializer.
+
+    Multipart request, one img file per item of the metadata JSON list.
+    """
+
+    class Item(serializers.Serializer):
+        """Item."""
+
+        part_name = serializers.CharField()
+        labels = serializers.CharField()
+        confidence = serializers.FloatField()
+        camera_id = serializers.IntegerField()
+
+    img = serializers.ListField(child=serializers.ImageField())
+    metadata = serializers.CharField()
+
+    def validate_metadata(self, value):
+        """validate_metadata."""
+        try:
+            items = json.loads(value)
+        except ValueError as err:
+            raise serializers.ValidationError("metadata is not JSON") from err
+        item_serializer = self.Item(data=items, many=True)
+        item_serializer.is_valid(raise_exception=True)
+        return item_serializer.validated_data
+
+    def validate(self, attrs):
+        """validate."""
+        if len(attrs["img"]) != len(attrs["metadata"]):
+            raise serializers.ValidationError("One metadata item per img expected")
+        return attrs
+
+
 class UpdateCamBodySerializer(serializers.Serializer):
     """UploadRelabelSerializer."""
 
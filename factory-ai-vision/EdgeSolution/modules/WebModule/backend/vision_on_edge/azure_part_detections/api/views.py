@@ -39,11 +39,12 @@ from ..exceptions import (
     PdRelabelWithoutProject,
 )
 from ..models import PartDetection, PDScenario
-from ..utils import if_trained_then_deploy_helper
+from ..utils import if_trained_then_deploy_helper, save_relabel_images
 from .serializers import (
     ExportSerializer,
     PartDetectionSerializer,
     PDScenarioSerializer,
+    UploadRelabelBatchSerializer,
     UploadRelabelSerializer,
 )
 
@@ -278,7 +279,7 @@ class PartDetectionViewSet(FiltersMixin, viewsets.ModelViewSet):
         if (
             instance.maxImages
             > Image.objects.filter(
-                project=project_obj, part_ids__contains='"{}"'.format(str(part.id)), is_relabel=True
+                project=project_obj, parts=part, is_relabel=True
             ).count()
         ):
             img_io = serializer.validated_data["img"].file
@@ -326,8 +327,7 @@ class PartDetectionViewSet(FiltersMixin, viewsets.ModelViewSet):
             img_obj.save()
             # pop
             earliest_img = (
-                Image.objects.filter(project=project_obj, part_ids__contains='"{}"'.format(
-                    str(part.id)), is_relabel=True)
+                Image.objects.filter(project=project_obj, parts=part, is_relabel=True)
                 .order_by("timestamp")
                 .first()
             )
@@ -339,16 +339,50 @@ class PartDetectionViewSet(FiltersMixin, viewsets.ModelViewSet):
         # User is relabeling and exceed maxImages
         for _ in range(
             Image.objects.filter(
-                project=project_obj, part_ids__contains='"{}"'.format(str(part.id)), is_relabel=True
+                project=project_obj, parts=part, is_relabel=True
             ).count()
             - instance.maxImages
         ):
             Image.objects.filter(
-                project=project_obj, part_ids__contains='"{}"'.format(str(part.id)), is_relabel=True
+                project=project_obj, parts=part, is_relabel=True
             ).order_by("timestamp").last().delete()
         raise PdRelabelImageFull
 
 
+    @swagger_auto_schema(
+        operation_summary="Upload relabel images in one multipart request.",
+        request_body=UploadRelabelBatchSerializer(),
+    )
+    @action(detail=True, methods=["post"])
+    def upload_relabel_images(self, request, pk=None) -> Response:
+        """upload_relabel_images.
+
+        Args:
+            request:
+        """
+        queryset = self.get_queryset()
+        instance = drf_get_object_or_404(queryset, pk=pk)
+        serializer = UploadRelabelBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        project_obj = instance.project
+        if project_obj is None:
+            raise PdRelabelWithoutProject
+
+        if project_obj.is_demo:
+            raise PdRelabelDemoProjectError
+
+        samples = [
+            dict(item, img=img)
+            for item, img in zip(
+                serializer.validated_data["metadata"],
+                serializer.validated_data["img"],
+            )
+        ]
+        result = save_relabel_images(instance, samples)
+        return Response({"status": "ok", **result})
+
+
 class PDScenarioViewSet(viewsets.ReadOnlyModelViewSet):
     """PDScenario ModelViewSet"""
 
@@ -2,10 +2,16 @@
 """
 
 import json
+from datetime import timedelta
+from io import BytesIO
 
 import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+from PIL import Image as PILImage
 from rest_framework.test import APIRequestFactory
 
+from ...images.models import Image
 from ..api.serializers import PartDetectionSerializer
 from ..api.views import PartDetectionViewSet
 
@@ -76,3 +82,61 @@ def test_put_from_frontend_1(part_detection):
 
     response = pd_list_view(request, pk=part_detection.id).render()
     assert response.status_code == 200
+
+
+def upload_relabel_images(part_detection, metadata):
+    """Post one jpg per metadata item to upload_relabel_images."""
+    images = []
+    for i, _ in enumerate(metadata):
+        bytes_io = BytesIO()
+        PILImage.new("RGB", (64, 48)).save(bytes_io, format="JPEG")
+        images.append(SimpleUploadedFile(f"{i}.jpg", bytes_io.getvalue(), "image/jpeg"))
+    factory = APIRequestFactory()
+    view = PartDetectionViewSet.as_view({"post": "upload_relabel_images"})
+    request = factory.post(
+        "/fake-url/",
+        {"img": images, "metadata": json.dumps(metadata)},
+        format="multipart",
+    )
+    return view(request, pk=part_detection.id).render()
+
+
+def test_upload_relabel_images(part_detection, part, camera):
+    """One batch keeps the newest images of each part within maxImages."""
+    part_detection.parts.add(part)
+    part_detection.cameras.add(camera)
+    part_detection.maxImages = 2
+    part_detection.save()
+
+    item = {
+        "part_name": part.name,
+        "labels": json.dumps([{"x1": 1, "y1": 1, "x2": 10, "y2": 10}]),
+        "confidence": 0.5,
+        "camera_id": camera.id,
+    }
+    response = upload_relabel_images(
+        part_detection, [item, item, dict(item, confidence=0.99), item]
+    )
+    assert response.status_code == 200
+    body = json.loads(response.content.decode("utf-8"))
+    assert body["accepted"] == 2
+    assert [rejected["index"] for rejected in body["rejected"]] == [0, 2]
+    relabel_images = Image.objects.filter(
+        project=part_detection.project, is_relabel=True
+    )
+    assert relabel_images.count() == 2
+    oldest = relabel_images.order_by("timestamp").first()
+
+    # Newer images replace the oldest ones
+    response = upload_relabel_images(part_detection, [item])
+    assert json.loads(response.content.decode("utf-8"))["accepted"] == 1
+    assert relabel_images.count() == 2
+    assert not relabel_images.filter(id=oldest.id).exists()
+
+    # No image is replaced while someone is relabeling
+    part_detection.project.relabel_expired_time = timezone.now() + timedelta(hours=1)
+    part_detection.project.save()
+    response = upload_relabel_images(part_detection, [item])
+    body = json.loads(response.content.decode("utf-8"))
+    assert body["accepted"] == 0
+    assert body["rejected"] == [{"index": 0, "detail": "Relabel images full."}]
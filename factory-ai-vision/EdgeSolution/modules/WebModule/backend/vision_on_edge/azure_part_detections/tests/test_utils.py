@@ -0,0 +1,95 @@
+"""App utilities tests.
+"""
+
+from unittest import mock
+
+import pytest
+
+from .. import utils
+from ..models import PDScenario
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def deployed_part_detection(part_detection, camera_task, part):
+    """PartDetection with one camera and one part."""
+    camera_task.camera.area = ""
+    camera_task.camera.save()
+    part_detection.cameras.add(camera_task.camera)
+    part_detection.parts.add(part)
+    PDScenario.objects.create(inference_mode=part_detection.inference_mode)
+    return part_detection
+
+
+@pytest.fixture
+def mock_requests(monkeypatch):
+    post = mock.MagicMock()
+    post.return_value.status_code = 200
+    post.return_value.json.return_value = {"status": "ok"}
+    monkeypatch.setattr(utils.requests, "post", post)
+    get = mock.MagicMock()
+    monkeypatch.setattr(utils.requests, "get", get)
+    return post, get
+
+
+def test_get_deployment_version(deployed_part_detection):
+    """The version only changes with the content."""
+    deployment = utils.get_deployment(deployed_part_detection)
+    assert (
+        deployment["version"]
+        == utils.get_deployment(deployed_part_detection)["version"]
+    )
+    assert [cam["id"] for cam in deployment["cameras"]["cameras"]] == [
+        str(cam.id) for cam in deployed_part_detection.cameras.all()
+    ]
+    assert deployment["parts"] == [
+        {"id": part.id, "name": part.name}
+        for part in deployed_part_detection.parts.all()
+    ]
+
+    deployed_part_detection.fps = 5
+    deployed_part_detection.save()
+    assert (
+        utils.get_deployment(deployed_part_detection)["version"]
+        != deployment["version"]
+    )
+
+
+def test_deploy_worker_single_call(deployed_part_detection, mock_requests):
+    """The deployment is pushed with one /apply call."""
+    post, get = mock_requests
+    utils.deploy_worker(deployed_part_detection.id)
+
+    assert post.call_count == 1
+    url = post.call_args[0][0]
+    assert url.endswith("/apply")
+    assert post.call_args[1]["json"] == utils.get_deployment(deployed_part_detection)
+    get.assert_not_called()
+    assert PDScenario.objects.get().fps == deployed_part_detection.fps
+
+
+def test_deploy_worker_without_apply(
+    deployed_part_detection, mock_requests, monkeypatch
+):
+    """Inference modules without /apply get one call per setting."""
+    post, get = mock_requests
+    post.return_value.status_code = 404
+    monkeypatch.setattr(
+        "vision_on_edge.inference_modules.models.InferenceModule.is_vpu",
+        mock.MagicMock(return_value=False),
+    )
+    utils.deploy_worker(deployed_part_detection.id)
+
+    urls = [call[0][0] for call in post.call_args_list]
+    assert [url.rsplit("/", 1)[-1] for url in urls] == [
+        "apply",
+        "update_endpoint",
+        "update_model",
+        "update_parts",
+        "update_cams",
+    ]
+    assert post.call_args_list[2][1]["json"] == {
+        "model_uri": deployed_part_detection.project.download_uri
+    }
+    assert get.call_count == 6
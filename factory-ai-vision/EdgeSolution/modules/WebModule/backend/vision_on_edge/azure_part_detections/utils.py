@@ -1,24 +1,122 @@
 """App utilities.
 """
 
+import hashlib
+import json
 import logging
 import threading
 import time
 import traceback
 
 import requests
+from django.core.files.images import ImageFile
+from django.db import transaction
+from django.db.models import Count
 from django.utils import timezone
 
 from ..azure_pd_deploy_status import progress as deploy_progress
 from ..azure_pd_deploy_status.utils import upcreate_deploy_status
 from ..azure_training_status.models import TrainingStatus
+from ..images.models import Image
 from .api.serializers import UpdateCamBodySerializer
 from .models import PartDetection, PDScenario
 from ..azure_iot.utils import model_manager_module_url
+from ..inference_modules.status import inference_module_status
 
 logger = logging.getLogger(__name__)
 
 
+def save_relabel_images(instance: PartDetection, samples) -> dict:
+    """save_relabel_images.
+
+    Store relabel images sent by the inference module in one batch, with
+    one quota check for the whole batch. Per part, images are kept while
+    the part has fewer than maxImages. Beyond it, the newest images
+    replace the oldest ones, unless someone is relabeling.
+
+    Args:
+        instance (PartDetection): instance
+        samples: dicts with img, part_name, labels, confidence and camera_id
+
+    Returns:
+        dict: number of accepted images and the rejected ones.
+    """
+    project_obj = instance.project
+    parts = {part.name: part for part in instance.parts.all()}
+    camera_ids = set(instance.cameras.values_list("id", flat=True))
+    is_relabeling = project_obj.relabel_expired_time >= timezone.now()
+
+    rejected = []
+    samples_by_part = {}
+    for index, sample in enumerate(samples):
+        part = parts.get(sample["part_name"])
+        confidence = sample["confidence"] * 100
+        if part is None:
+            rejected.append({"index": index, "detail": "Part not found."})
+        elif sample["camera_id"] not in camera_ids:
+            rejected.append({"index": index, "detail": "Camera not found."})
+        elif not instance.accuracyRangeMin <= confidence <= instance.accuracyRangeMax:
+            logger.error("Inferenece confidence %s out of range", confidence)
+            rejected.append({"index": index, "detail": "Confidence out of range."})
+        else:
+            samples_by_part.setdefault(part, []).append((index, sample))
+
+    relabel_images = Image.objects.filter(project=project_obj, is_relabel=True)
+    counts = dict(
+        relabel_images.filter(parts__in=samples_by_part.keys())
+        .order_by()
+        .values("parts")
+        .annotate(count=Count("id"))
+        .values_list("parts", "count")
+    )
+
+    accepted = []
+    expired_ids = []
+    for part, part_samples in samples_by_part.items():
+        room = instance.maxImages - counts.get(part.id, 0)
+        if is_relabeling:
+            keep = part_samples[: max(room, 0)]
+            if room < 0:
+                expired_ids += list(
+                    relabel_images.filter(parts=part)
+                    .order_by("-timestamp")
+                    .values_list("id", flat=True)[:-room]
+                )
+        else:
+            keep = part_samples[max(len(part_samples) - instance.maxImages, 0) :]
+            if len(keep) > room:
+                expired_ids += list(
+                    relabel_images.filter(parts=part)
+                    .order_by("timestamp")
+                    .values_list("id", flat=True)[: len(keep) - room]
+                )
+        kept = {index for index, _ in keep}
+        for index, _ in part_samples:
+            if index not in kept:
+                rejected.append({"index": index, "detail": "Relabel images full."})
+        accepted += [(part, sample) for _, sample in keep]
+
+    with transaction.atomic():
+        for part, sample in accepted:
+            img = ImageFile(sample["img"].file)
+            img.name = str(timezone.now()) + ".jpg"
+            labels = json.loads(sample["labels"])
+            labels[0]["part"] = part.id
+            Image(
+                image=img,
+                camera_id=sample["camera_id"],
+                part_id=part.id,
+                part_ids=json.dumps([str(part.id)]),
+                labels=json.dumps(labels),
+                confidence=sample["confidence"],
+                project=project_obj,
+                is_relabel=True,
+            ).save()
+        Image.objects.filter(id__in=expired_ids).delete()
+    rejected.sort(key=lambda item: item["index"])
+    return {"accepted": len(accepted), "rejected": rejected}
+
+
 def if_trained_then_deploy_worker(part_detection_id):
     """if_trained_then_deploy_worker.
 
@@ -105,14 +203,19 @@ def if_trained_then_deploy_worker(part_detection_id):
     )
 
 
-def deploy_worker(part_detection_id):
-    """deploy.
+DEPLOY_REQUEST_TIMEOUT = 60
+
+
+def get_deployment(instance: PartDetection) -> dict:
+    """get_deployment.
+
+    Desired state of the inference module for a PartDetection, applied by
+    the inference module /apply in one call. version is the hash of the
+    content, so an unchanged deployment is not applied twice.
 
     Args:
-        part_detection_obj: Part Detection Objects
+        instance (PartDetection): instance
     """
-    REQUEST_TIMEOUT = 60
-    instance: PartDetection = PartDetection.objects.get(pk=part_detection_id)
     # if not instance.has_configured:
     #     logger.error("This PartDetection is not configured")
     #     logger.error("Not sending any request to inference")
@@ -129,106 +232,36 @@ def deploy_worker(part_detection_id):
     counting_end_time = getattr(instance, "counting_end_time", "")
 
     # =====================================================
-    # 1. Update params                                  ===
-    # =====================================================
-    requests.get(
-        "http://" + str(instance.inference_module.url) + "/update_part_detection_id",
-        params={"part_detection_id": instance.id},
-        timeout=REQUEST_TIMEOUT,
-    )
-    requests.get(
-        "http://" + str(instance.inference_module.url) + "/update_part_detection_mode",
-        params={"part_detection_mode": instance.inference_mode},
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    # =====================================================
-    # 2.1 Update endpoint                               ===
+    # 1. Endpoint                                       ===
     # =====================================================
-    if instance.deployment_type == 'cascade':
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_endpoint",
-            json={
-                "endpoint": "ovmsserver:9001",
-                "headers": "",
-                "pipeline": instance.cascade.flow,
-            },
-            timeout=REQUEST_TIMEOUT,
-        ) 
+    if instance.deployment_type == "cascade":
+        endpoint = {
+            "endpoint": "ovmsserver:9001",
+            "headers": "",
+            "pipeline": instance.cascade.flow,
+        }
     else:
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_endpoint",
-            json={
-                "endpoint": instance.project.get_prediction_uri(),
-                "headers": instance.project.prediction_header,
-            },
-            timeout=REQUEST_TIMEOUT,
-        )
+        endpoint = {
+            "endpoint": instance.project.get_prediction_uri(),
+            "headers": instance.project.prediction_header,
+        }
 
     # =====================================================
-    # 2.2 Update model                                  ===
+    # 2. Model, fp16 is picked by the module on vpu     ===
     # =====================================================
     if not instance.project:
-        pass
+        model = None
     elif instance.project.is_demo:
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_dir": instance.project.download_uri},
-            timeout=REQUEST_TIMEOUT,
-        )
-
-    elif not instance.inference_module.is_vpu():
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_uri": instance.project.download_uri},
-            timeout=REQUEST_TIMEOUT,
-        )
+        model = {"model_dir": instance.project.download_uri}
     else:
-        requests.post(
-            "http://" + str(instance.inference_module.url) + "/update_model",
-            json={"model_uri": instance.project.download_uri_fp16},
-            timeout=REQUEST_TIMEOUT,
-        )
-
-    # =====================================================
-    # 3. Update parts                                   ===
-    # =====================================================
-    logger.info("Update Parts!!!")
-    parts = instance.parts.all()
-    res_data = {"parts": []}
-
-    for part in parts.all():
-        res_data["parts"].append({"id": part.id, "name": part.name})
-    requests.post(
-        url="http://" + instance.inference_module.url + "/update_parts",
-        json=res_data,
-        timeout=REQUEST_TIMEOUT,
-    )
-
-    requests.get(
-        "http://" + instance.inference_module.url + "/update_retrain_parameters",
-        params={
-            "is_retrain": need_retraining,
-            "confidence_min": confidence_min,
-            "confidence_max": confidence_max,
-            "max_images": max_images,
-        },
-        timeout=REQUEST_TIMEOUT,
-    )
-    requests.get(
-        "http://" + instance.inference_module.url + "/update_iothub_parameters",
-        params={
-            "is_send": metrics_is_send_iothub,
-            "threshold": metrics_accuracy_threshold,
-            "fpm": metrics_frame_per_minutes,
-        },
-        timeout=REQUEST_TIMEOUT,
-    )
+        model = {
+            "model_uri": instance.project.download_uri,
+            "model_uri_fp16": instance.project.download_uri_fp16,
+        }
 
     # =====================================================
-    # 4. Update cams                                    ===
+    # 3. Cameras                                        ===
     # =====================================================
-    logger.info("Update Cam!!!")
     cameras = instance.cameras.all()
     if instance.deployment_type == "cascade":
         cascade_name = instance.cascade.name
@@ -243,6 +276,7 @@ def deploy_worker(part_detection_id):
     }
 
     for cam in cameras.all():
+        camera_task = cam.cameratask_set.first()
         cam_info = {
             "id": cam.id,
             "name": cam.name,
@@ -250,14 +284,14 @@ def deploy_worker(part_detection_id):
             "source": cam.rtsp,
             "lines": cam.lines,
             "zones": cam.danger_zones,
-            "send_video_to_cloud": cam.cameratask_set.first().send_video_to_cloud,
+            "send_video_to_cloud": camera_task.send_video_to_cloud,
             "send_video_to_cloud_parts": [
                 {"id": part.id, "name": part.name}
-                for part in cam.cameratask_set.first().parts.all()
+                for part in camera_task.parts.all()
             ],
-            "send_video_to_cloud_threshold": cam.cameratask_set.first().send_video_to_cloud_threshold,  # noqa: E501
-            "recording_duration": cam.cameratask_set.first().recording_duration,  # noqa: E501
-            "enable_tracking": cam.cameratask_set.first().enable_tracking,
+            "send_video_to_cloud_threshold": camera_task.send_video_to_cloud_threshold,
+            "recording_duration": camera_task.recording_duration,
+            "enable_tracking": camera_task.enable_tracking,
             "counting_start_time": counting_start_time,
             "counting_end_time": counting_end_time,
         }
@@ -267,32 +301,115 @@ def deploy_worker(part_detection_id):
 
     serializer = UpdateCamBodySerializer(data=res_data)
     serializer.is_valid(raise_exception=True)
-    logger.info(serializer.validated_data)
+
+    deployment = {
+        "part_detection_id": instance.id,
+        "part_detection_mode": instance.inference_mode,
+        "endpoint": endpoint,
+        "model": model,
+        "parts": [{"id": part.id, "name": part.name} for part in instance.parts.all()],
+        "retrain": {
+            "is_retrain": need_retraining,
+            "confidence_min": confidence_min,
+            "confidence_max": confidence_max,
+            "max_images": max_images,
+        },
+        "iothub": {
+            "is_send": metrics_is_send_iothub,
+            "threshold": metrics_accuracy_threshold,
+            "fpm": metrics_frame_per_minutes,
+        },
+        "prob_threshold": instance.prob_threshold,
+        "max_people": instance.max_people,
+        "cameras": json.loads(json.dumps(serializer.validated_data)),
+    }
+    deployment["version"] = hashlib.sha256(
+        json.dumps(deployment, sort_keys=True).encode()
+    ).hexdigest()
+    return deployment
+
+
+def deploy_legacy(url: str, deployment: dict, is_vpu: bool):
+    """deploy_legacy.
+
+    Push the deployment with one call per setting, for inference modules
+    without /apply.
+    """
+    requests.get(
+        url + "/update_part_detection_id",
+        params={"part_detection_id": deployment["part_detection_id"]},
+        timeout=DEPLOY_REQUEST_TIMEOUT,
+    )
+    requests.get(
+        url + "/update_part_detection_mode",
+        params={"part_detection_mode": deployment["part_detection_mode"]},
+        timeout=DEPLOY_REQUEST_TIMEOUT,
+    )
     requests.post(
-        url="http://" + instance.inference_module.url + "/update_cams",
-        json=dict(serializer.validated_data),
-        timeout=REQUEST_TIMEOUT,
+        url + "/update_endpoint", json=deployment["endpoint"], timeout=DEPLOY_REQUEST_TIMEOUT
+    )
+    model = deployment["model"]
+    if model:
+        if "model_dir" in model:
+            model_body = {"model_dir": model["model_dir"]}
+        elif is_vpu:
+            model_body = {"model_uri": model["model_uri_fp16"]}
+        else:
+            model_body = {"model_uri": model["model_uri"]}
+        requests.post(url + "/update_model", json=model_body, timeout=DEPLOY_REQUEST_TIMEOUT)
+    requests.post(
+        url + "/update_parts",
+        json={"parts": deployment["parts"]},
+        timeout=DEPLOY_REQUEST_TIMEOUT,
     )
-    # =====================================================
-    # 5. Update prob_threshold                          ===
-    # =====================================================
     requests.get(
-        "http://" + instance.inference_module.url + "/update_prob_threshold",
-        params={"prob_threshold": instance.prob_threshold},
-        timeout=REQUEST_TIMEOUT,
+        url + "/update_retrain_parameters",
+        params=deployment["retrain"],
+        timeout=DEPLOY_REQUEST_TIMEOUT,
+    )
+    requests.get(
+        url + "/update_iothub_parameters",
+        params=deployment["iothub"],
+        timeout=DEPLOY_REQUEST_TIMEOUT,
+    )
+    requests.post(
+        url + "/update_cams", json=deployment["cameras"], timeout=DEPLOY_REQUEST_TIMEOUT
     )
-
-    # =====================================================
-    # 5. Update max_people                              ===
-    # =====================================================
     requests.get(
-        "http://" + instance.inference_module.url + "/update_max_people",
-        params={"max_people": instance.max_people},
-        timeout=REQUEST_TIMEOUT,
+        url + "/update_prob_threshold",
+        params={"prob_threshold": deployment["prob_threshold"]},
+        timeout=DEPLOY_REQUEST_TIMEOUT,
     )
+    requests.get(
+        url + "/update_max_people",
+        params={"max_people": deployment["max_people"]},
+        timeout=DEPLOY_REQUEST_TIMEOUT,
+    )
+
+
+def deploy_worker(part_detection_id):
+    """deploy.
+
+    Args:
+        part_detection_obj: Part Detection Objects
+    """
+    instance: PartDetection = PartDetection.objects.get(pk=part_detection_id)
+    deployment = get_deployment(instance)
+    logger.info("Deploying %s", deployment["version"])
+
+    url = "http://" + str(instance.inference_module.url)
+    res = requests.post(url + "/apply", json=deployment, timeout=DEPLOY_REQUEST_TIMEOUT)
+    if res.status_code == 404:
+        logger.warning("Inference module has no /apply, deploying setting by setting")
+        deploy_legacy(url, deployment, instance.inference_module.is_vpu())
+    else:
+        res.raise_for_status()
+        logger.info("Deploy %s", res.json())
+    # recommended fps may change with the model
+    inference_module_status.request_refresh()
 
     # =====================================================
-    # 6. Update last fps                                ===
+    # Update last fps                                   ===
     # =====================================================
     # TODO filter PDScenario object, set its fps
     logger.info('Update last fps')
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_projects", "0013_project_is_trained"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="state",
+            field=models.TextField(blank=True, default=""),
+        ),
+    ]
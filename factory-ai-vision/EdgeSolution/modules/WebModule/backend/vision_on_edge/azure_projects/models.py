@@ -401,6 +401,8 @@ class Task(models.Model):
     status = models.CharField(max_length=200)
     log = models.CharField(max_length=1000)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    # JSON, what a restarted server needs to resume the task
+    state = models.TextField(blank=True, default="")
 
     def start_exporting(self):
         """start_exporting."""
@@ -0,0 +1,122 @@
+"""App test fakes.
+"""
+
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+
+class ThrottledError(Exception):
+    """Trainer error with a 429 response."""
+
+    def __init__(self):
+        super().__init__("Too many requests")
+        self.response = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+
+
+class FakeTrainer:
+    """Local Custom Vision training client.
+
+    Args:
+        tags: tags of the project.
+        images: tagged images of the project.
+        throttled (int): number of image uploads answered with a 429.
+    """
+
+    def __init__(self, tags=None, images=None, throttled: int = 0):
+        self.tags = tags or []
+        self.images = images or []
+        self.throttled = throttled
+        self.calls = 0
+        self.batches = []
+        self.iterations = []
+        self.exports = []
+        self.export_requests = []
+        self.mutex = threading.Lock()
+
+    # Project
+
+    def get_project(self, project_id):
+        return SimpleNamespace(
+            name="Fake Project",
+            settings=SimpleNamespace(domain_id="domain", classification_type=None),
+        )
+
+    def get_domain(self, domain_id):
+        return SimpleNamespace(type="ObjectDetection")
+
+    def get_tags(self, project_id):
+        return self.tags
+
+    # Images
+
+    def get_tagged_image_count(self, project_id):
+        return len(self.images)
+
+    def get_tagged_images(self, project_id, take=50, skip=0, tag_ids=None):
+        self.calls += 1
+        images = self.images
+        if tag_ids:
+            images = [
+                img
+                for img in images
+                if any(region.tag_id in tag_ids for region in img.regions)
+            ]
+        return images[skip : skip + take]
+
+    def create_images_from_files(self, project_id, batch):
+        with self.mutex:
+            if self.throttled > 0:
+                self.throttled -= 1
+                raise ThrottledError
+            self.batches.append(batch.images)
+            offset = sum(len(images) for images in self.batches)
+        return SimpleNamespace(
+            is_batch_successful=True,
+            images=[
+                SimpleNamespace(
+                    status="OK",
+                    image=SimpleNamespace(
+                        id=f"cv-{offset + i}", original_image_uri=f"https://fake/{i}"
+                    ),
+                )
+                for i in range(len(batch.images))
+            ],
+        )
+
+    # Training
+
+    def get_iterations(self, project_id):
+        return list(self.iterations)
+
+    def get_iteration(self, project_id, iteration_id):
+        return next(i for i in self.iterations if i.id == iteration_id)
+
+    def get_iteration_performance(self, project_id, iteration_id):
+        return mock.MagicMock(as_dict=mock.MagicMock(return_value={"id": iteration_id}))
+
+    def get_exports(self, project_id, iteration_id):
+        return list(self.exports)
+
+    def export_iteration(self, project_id, iteration_id, platform, flavor):
+        with self.mutex:
+            self.export_requests.append((platform, flavor))
+
+    def start_training(self):
+        self.iterations.insert(
+            0, SimpleNamespace(id="iteration-1", status="Training", exportable=False)
+        )
+
+    def complete_training(self):
+        self.iterations[0].status = "Completed"
+        self.iterations[0].exportable = True
+
+    def complete_exports(self):
+        self.exports = [
+            SimpleNamespace(platform=platform, flavor=flavor, download_uri=uri)
+            for platform, flavor, uri in [
+                ("ONNX", "", "https://fake/onnx"),
+                ("ONNX", "ONNXFloat16", "https://fake/fp16"),
+                ("OpenVino", "", "https://fake/openvino"),
+            ]
+        ]
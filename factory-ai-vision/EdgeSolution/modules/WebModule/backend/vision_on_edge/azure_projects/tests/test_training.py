@@ -0,0 +1,123 @@
+"""App training orchestrator tests.
+"""
+
+import json
+from concurrent.futures import wait
+from unittest import mock
+
+import pytest
+
+from ...azure_settings.models import Setting
+from ...azure_training_status.models import TrainingStatus
+from ..models import Project, Task
+from ..training import (
+    STAGE_DONE,
+    STAGE_EXPORTING,
+    STAGE_TRAINING,
+    TrainingOrchestrator,
+    poll_delay,
+)
+from .factories import ProjectFactory
+from .fakes import FakeTrainer
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def trainer(monkeypatch):
+    fake_trainer = FakeTrainer()
+    monkeypatch.setattr(
+        Setting, "get_trainer_obj", mock.MagicMock(return_value=fake_trainer)
+    )
+    return fake_trainer
+
+
+def training_project(customvision_id):
+    """Project with a training status."""
+    project = ProjectFactory(customvision_id=customvision_id)
+    TrainingStatus.objects.create(project=project)
+    return project
+
+
+def poll_all(orchestrator):
+    """Poll every project, whatever its next poll time."""
+    return orchestrator.poll_due(now=float("inf"))
+
+
+def test_poll_delay():
+    """Sparse polls far from the expected end, backoff after it."""
+    assert poll_delay(0, 600, 0) == 60
+    assert poll_delay(590, 600, 0) == 5
+    assert poll_delay(599, 600, 0) == 2
+    assert [poll_delay(700, 600, polls) for polls in range(6)] == [
+        2,
+        4,
+        8,
+        16,
+        32,
+        60,
+    ]
+
+
+def test_orchestrator_follows_training(trainer):
+    """Training and exports are followed until the model is saved."""
+    project = training_project("fake_id")
+    orchestrator = TrainingOrchestrator()
+    orchestrator.watch(project.id, has_new_parts=True)
+    assert orchestrator.is_watching(project.id)
+
+    # Custom Vision has not listed the iteration yet
+    assert poll_all(orchestrator) == 1
+    trainer.start_training()
+    poll_all(orchestrator)
+    assert Task.objects.get(project=project).status == STAGE_TRAINING
+    assert TrainingStatus.objects.get(project=project).status == "Training"
+
+    # The next polls back off from min_interval
+    poll_all(orchestrator)
+    next_poll = orchestrator.schedule[0][0]
+    poll_all(orchestrator)
+    assert orchestrator.schedule[0][0] > next_poll
+
+    trainer.complete_training()
+    poll_all(orchestrator)
+    assert Task.objects.get(project=project).status == STAGE_EXPORTING
+    wait(orchestrator.jobs[project.id].export_requests)
+    assert sorted(trainer.export_requests) == [
+        ("ONNX", ""),
+        ("ONNX", "ONNXFloat16"),
+        ("OPENVINO", ""),
+    ]
+
+    trainer.complete_exports()
+    poll_all(orchestrator)
+    assert not orchestrator.is_watching(project.id)
+    project = Project.objects.get(pk=project.id)
+    assert project.download_uri == "https://fake/onnx"
+    assert project.download_uri_fp16 == "https://fake/fp16"
+    assert project.download_uri_openvino == "https://fake/openvino"
+    assert project.training_counter == 1
+    assert TrainingStatus.objects.get(project=project).status == "Success"
+    task = Task.objects.get(project=project)
+    assert task.status == STAGE_DONE
+    assert json.loads(task.state)["training_time"] >= 0
+
+
+def test_orchestrator_resume(trainer):
+    """A new orchestrator resumes every training in progress."""
+    projects = [training_project(f"fake_id_{i}") for i in range(3)]
+    orchestrator = TrainingOrchestrator()
+    for project in projects:
+        orchestrator.watch(project.id)
+    trainer.start_training()
+    assert poll_all(orchestrator) == 3
+
+    restarted = TrainingOrchestrator()
+    restarted.resume()
+    assert all(restarted.is_watching(project.id) for project in projects)
+    assert restarted.jobs[projects[0].id].iteration_id == "iteration-1"
+    assert restarted.jobs[projects[0].id].stage == STAGE_TRAINING
+
+    trainer.complete_training()
+    assert poll_all(restarted) == 3
+    assert Task.objects.filter(status=STAGE_EXPORTING).count() == 3
@@ -0,0 +1,129 @@
+"""App utilities tests.
+"""
+
+import json
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from PIL import Image as PILImage
+
+from ...azure_parts.models import Part
+from ...azure_settings.models import Setting
+from ...images.models import Image
+from ...notifications.models import Notification
+from .. import utils
+from ..models import Project
+from .factories import ProjectFactory
+from .fakes import FakeTrainer
+
+pytestmark = pytest.mark.django_db
+
+
+def fake_tag(tag_id, name):
+    return SimpleNamespace(id=tag_id, name=name, description="")
+
+
+def fake_image(image_id, tag_names):
+    regions = [
+        SimpleNamespace(
+            tag_id="tag-" + name,
+            tag_name=name,
+            left=0.1,
+            top=0.2,
+            width=0.5,
+            height=0.5,
+        )
+        for name in tag_names
+    ]
+    return SimpleNamespace(
+        id=image_id,
+        original_image_uri=f"https://fake/{image_id}.png",
+        regions=regions,
+        tags=[],
+    )
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Serve a 100x50 png for every remote url."""
+    bytes_io = BytesIO()
+    PILImage.new("RGB", (100, 50)).save(bytes_io, format="PNG")
+    urls = []
+
+    def download(url):
+        urls.append(url)
+        return bytes_io.getvalue()
+
+    monkeypatch.setattr(utils, "download_remote_image", download)
+    return urls
+
+
+def test_pull_cv_images_helper(downloads):
+    """Pull images with labels, then only the new ones."""
+    project = ProjectFactory(customvision_id="fake_id")
+    bolt = Part.objects.create(project=project, name="bolt", customvision_id="tag-bolt")
+    nut = Part.objects.create(project=project, name="nut", customvision_id="tag-nut")
+    images = [fake_image(f"img-{i}", ["bolt"]) for i in range(7)]
+    images.append(fake_image("img-both", ["bolt", "nut"]))
+    images.append(fake_image("img-unknown", ["screw"]))
+    trainer = FakeTrainer(tags=[], images=images)
+
+    assert (
+        utils.pull_cv_images_helper(project, trainer, max_workers=3, page_size=2) == 8
+    )
+    assert trainer.calls == 5
+    assert Image.objects.filter(project=project).count() == 8
+    img_obj = Image.objects.get(customvision_id="img-both")
+    assert json.loads(img_obj.labels) == [
+        {"x1": 10, "y1": 10, "x2": 60, "y2": 35, "part": bolt.id},
+        {"x1": 10, "y1": 10, "x2": 60, "y2": 35, "part": nut.id},
+    ]
+    assert json.loads(img_obj.part_ids) == [str(bolt.id), str(nut.id)]
+    assert img_obj.part == nut
+    assert img_obj.manual_checked
+    assert img_obj.image.size > 0
+    assert Notification.objects.filter(notification_type="project").exists()
+
+    downloads.clear()
+    images.append(fake_image("img-new", ["nut"]))
+    assert utils.pull_cv_images_helper(project, trainer) == 1
+    assert downloads == ["https://fake/img-new.png"]
+    assert Image.objects.filter(project=project).count() == 9
+
+
+def test_pull_cv_images_helper_discard_failed_download(monkeypatch):
+    """Images that cannot be downloaded are not stored."""
+    project = ProjectFactory(customvision_id="fake_id")
+    Part.objects.create(project=project, name="bolt", customvision_id="tag-bolt")
+    trainer = FakeTrainer(tags=[], images=[fake_image("img", ["bolt"])])
+    monkeypatch.setattr(
+        utils, "download_remote_image", mock.MagicMock(side_effect=Exception)
+    )
+
+    assert utils.pull_cv_images_helper(project, trainer) == 0
+    assert not Image.objects.filter(project=project).exists()
+
+
+def test_pull_cv_project_helper(monkeypatch, setting, downloads):
+    """Pulling a project twice updates the same project."""
+    tags = [fake_tag("tag-bolt", "bolt"), fake_tag("tag-nut", "nut")]
+    images = [fake_image("img-1", ["bolt"]), fake_image("img-2", ["nut"])]
+    trainer = FakeTrainer(tags=tags, images=images)
+    monkeypatch.setattr(
+        Setting, "get_trainer_obj", mock.MagicMock(return_value=trainer)
+    )
+
+    utils.pull_cv_project_helper(customvision_project_id="fake_id", is_partial=False)
+    project = Project.objects.get(customvision_id="fake_id")
+    assert Part.objects.filter(project=project).count() == 2
+    assert Image.objects.filter(project=project).count() == 2
+
+    images.append(fake_image("img-3", ["bolt"]))
+    downloads.clear()
+    utils.pull_cv_project_helper(customvision_project_id="fake_id", is_partial=False)
+    assert Project.objects.filter(customvision_id="fake_id").count() == 1
+    assert Part.objects.filter(project=project).count() == 2
+    assert Image.objects.filter(project=project).count() == 3
+    assert downloads == ["https://fake/img-3.png"]
@@ -0,0 +1,483 @@
+"""App training orchestrator.
+
+Once a training task is submitted to Custom Vision, one scheduler thread
+follows every project in training instead of one thread polling every
+second per project:
+
+- a project is polled less often while its stage is far from the expected
+  end, then with exponential backoff once that end is reached. The expected
+  training time is the duration of the previous training of the project;
+- polls and export requests run on small thread pools, so exports of
+  several iterations are requested concurrently;
+- the stage of each project is stored in a Task, a restarted server resumes
+  monitoring.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from ..azure_training_status import progress
+from ..azure_training_status.utils import upcreate_training_status
+from .models import Project, Task
+
+logger = logging.getLogger(__name__)
+
+TRAINING_TASK_TYPE = "training"
+TRAINING_POLL_WORKERS = int(os.environ.get("TRAINING_POLL_WORKERS", "4"))
+TRAINING_EXPORT_WORKERS = int(os.environ.get("TRAINING_EXPORT_WORKERS", "4"))
+TRAINING_POLL_MIN_INTERVAL = 2  # Seconds
+TRAINING_POLL_MAX_INTERVAL = 60  # Seconds
+# Expected time of each stage, the training time of a project that was never
+# trained by this server comes from the environment.
+TRAINING_EXPECTED_TIME = float(
+    os.environ.get("TRAINING_EXPECTED_TIME", "600")
+)  # Seconds
+ITERATION_EXPECTED_TIME = 10  # Seconds
+EXPORT_EXPECTED_TIME = 30  # Seconds
+# Custom Vision should list the iteration soon after the submit
+ITERATION_TIMEOUT = 60  # Seconds
+# Consecutive failed polls before a training is reported as failed
+TRAINING_MAX_ERRORS = 5
+
+STAGE_ITERATION = "finding_iteration"
+STAGE_TRAINING = "training"
+STAGE_EXPORTING = "exporting"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+ACTIVE_STAGES = [STAGE_ITERATION, STAGE_TRAINING, STAGE_EXPORTING]
+
+# (platform, flavor) of the exported models
+EXPORTS = [("ONNX", ""), ("ONNX", "ONNXFloat16"), ("OPENVINO", "")]
+
+
+def poll_delay(
+    elapsed: float,
+    expected: float,
+    polls_after_end: int,
+    min_interval: float = TRAINING_POLL_MIN_INTERVAL,
+    max_interval: float = TRAINING_POLL_MAX_INTERVAL,
+) -> float:
+    """poll_delay.
+
+    Half of the expected remaining time before the expected end, doubling
+    from min_interval after it.
+    """
+    remaining = expected - elapsed
+    if remaining > 0:
+        delay = remaining / 2
+    else:
+        delay = min_interval * 2 ** polls_after_end
+    return min(max(delay, min_interval), max_interval)
+
+
+class TrainingJob:
+    """TrainingJob.
+
+    Monitoring state of one project. Everything but the trainer and the
+    pending export requests is stored in the Task of the project.
+    """
+
+    def __init__(
+        self,
+        project_id,
+        has_new_parts: bool = False,
+        has_new_images: bool = False,
+        training_time: float = TRAINING_EXPECTED_TIME,
+    ):
+        self.project_id = project_id
+        self.has_new_parts = has_new_parts
+        self.has_new_images = has_new_images
+        self.training_time = training_time
+        self.iteration_id = None
+        self.stage = STAGE_ITERATION
+        self.stage_started_at = time.time()
+        self.polls_after_end = 0
+        self.errors = 0
+        self.trainer = None
+        self.export_requests = []
+
+    @classmethod
+    def from_task(cls, task: Task):
+        """from_task."""
+        state = json.loads(task.state or "{}")
+        job = cls(
+            project_id=task.project_id,
+            has_new_parts=state.get("has_new_parts", False),
+            has_new_images=state.get("has_new_images", False),
+            training_time=state.get("training_time", TRAINING_EXPECTED_TIME),
+        )
+        job.iteration_id = state.get("iteration_id")
+        job.stage = task.status
+        job.stage_started_at = state.get("stage_started_at", time.time())
+        return job
+
+    def set_stage(self, stage: str):
+        """set_stage."""
+        self.stage = stage
+        self.stage_started_at = time.time()
+        self.polls_after_end = 0
+
+    def expected_time(self) -> float:
+        """expected_time of the current stage."""
+        if self.stage == STAGE_TRAINING:
+            return self.training_time
+        if self.stage == STAGE_EXPORTING:
+            return EXPORT_EXPECTED_TIME
+        return ITERATION_EXPECTED_TIME
+
+    def next_delay(self, min_interval, max_interval) -> float:
+        """next_delay."""
+        elapsed = time.time() - self.stage_started_at
+        delay = poll_delay(
+            elapsed,
+            self.expected_time(),
+            self.polls_after_end,
+            min_interval=min_interval,
+            max_interval=max_interval,
+        )
+        if elapsed >= self.expected_time():
+            self.polls_after_end += 1
+        return delay
+
+    def save(self):
+        """save."""
+        Task.objects.update_or_create(
+            project_id=self.project_id,
+            task_type=TRAINING_TASK_TYPE,
+            defaults={
+                "status": self.stage,
+                "log": f"Iteration {self.iteration_id}: {self.stage}",
+                "state": json.dumps(
+                    {
+                        "has_new_parts": self.has_new_parts,
+                        "has_new_images": self.has_new_images,
+                        "training_time": self.training_time,
+                        "iteration_id": self.iteration_id,
+                        "stage_started_at": self.stage_started_at,
+                    }
+                ),
+            },
+        )
+
+    def __repr__(self):
+        return f"<Training Job {self.project_id} {self.stage}>"
+
+
+class TrainingOrchestrator:
+    """TrainingOrchestrator.
+
+    Projects waiting for their next poll are kept in a heap ordered by poll
+    time. A job is either in the heap or being polled, never both.
+    """
+
+    def __init__(
+        self,
+        poll_workers=TRAINING_POLL_WORKERS,
+        export_workers=TRAINING_EXPORT_WORKERS,
+        min_interval=TRAINING_POLL_MIN_INTERVAL,
+        max_interval=TRAINING_POLL_MAX_INTERVAL,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jobs = {}
+        self.schedule = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.poll_executor = ThreadPoolExecutor(
+            poll_workers, thread_name_prefix="training_poll"
+        )
+        self.export_executor = ThreadPoolExecutor(
+            export_workers, thread_name_prefix="training_export"
+        )
+        self.worker = None
+
+    def start(self):
+        """start.
+
+        Resume the trainings of the last run, then run the scheduler.
+
+        IMPORTANT, autoreloader will not reload threading,
+        please restart the server if you modify the thread.
+        """
+        self.resume()
+        self.worker = threading.Thread(
+            target=self._run, name="training_orchestrator", daemon=True
+        )
+        self.worker.start()
+
+    def resume(self):
+        """resume.
+
+        Schedule every project stored in an active stage.
+        """
+        for task in Task.objects.filter(
+            task_type=TRAINING_TASK_TYPE, status__in=ACTIVE_STAGES
+        ):
+            job = TrainingJob.from_task(task)
+            logger.info("Resume monitoring %s", job)
+            with self.cond:
+                self.jobs[job.project_id] = job
+            self._schedule(job, 0)
+
+    def watch(self, project_id, has_new_parts=False, has_new_images=False):
+        """watch.
+
+        Follow the training submitted for a project until its models are
+        exported.
+        """
+        project_id = int(project_id)
+        task = Task.objects.filter(
+            project_id=project_id, task_type=TRAINING_TASK_TYPE
+        ).first()
+        training_time = TRAINING_EXPECTED_TIME
+        if task and task.state:
+            training_time = json.loads(task.state).get(
+                "training_time", TRAINING_EXPECTED_TIME
+            )
+        job = TrainingJob(
+            project_id=project_id,
+            has_new_parts=has_new_parts,
+            has_new_images=has_new_images,
+            training_time=training_time,
+        )
+        job.save()
+        upcreate_training_status(
+            project_id=project_id,
+            need_to_send_notification=True,
+            **progress.PROGRESS_6_PREPARING_CUSTOM_VISION_ENV,
+        )
+        with self.cond:
+            self.jobs[project_id] = job
+        self._schedule(job, self.min_interval)
+
+    def is_watching(self, project_id) -> bool:
+        """is_watching."""
+        with self.cond:
+            return int(project_id) in self.jobs
+
+    def _schedule(self, job: TrainingJob, delay: float):
+        with self.cond:
+            heapq.heappush(
+                self.schedule, (time.time() + delay, next(self.counter), job)
+            )
+            self.cond.notify()
+
+    def _pop_due(self, now: float) -> list:
+        jobs = []
+        while self.schedule and self.schedule[0][0] <= now:
+            _, _, job = heapq.heappop(self.schedule)
+            # skip jobs replaced by a new training of the same project
+            if self.jobs.get(job.project_id) is job:
+                jobs.append(job)
+        return jobs
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.schedule or self.schedule[0][0] > time.time():
+                    timeout = None
+                    if self.schedule:
+                        timeout = self.schedule[0][0] - time.time()
+                    self.cond.wait(timeout)
+                jobs = self._pop_due(time.time())
+            for job in jobs:
+                self.poll_executor.submit(self._poll_in_worker, job)
+
+    def _poll_in_worker(self, job: TrainingJob):
+        close_old_connections()
+        try:
+            self.poll(job)
+        finally:
+            close_old_connections()
+
+    def poll_due(self, now: float = None) -> int:
+        """poll_due.
+
+        Poll the due projects in the calling thread.
+
+        Returns:
+            int: number of polled projects.
+        """
+        with self.cond:
+            jobs = self._pop_due(time.time() if now is None else now)
+        for job in jobs:
+            self.poll(job)
+        return len(jobs)
+
+    def poll(self, job: TrainingJob):
+        """poll.
+
+        Ask Custom Vision about one project, then schedule its next poll.
+        """
+        try:
+            project_obj = Project.objects.get(pk=job.project_id)
+        except Project.DoesNotExist:
+            logger.info("Project %s removed, stop monitoring", job.project_id)
+            self._finish(job)
+            return
+
+        try:
+            if job.trainer is None:
+                job.trainer = project_obj.setting.get_trainer_obj()
+            if job.stage == STAGE_ITERATION:
+                self._poll_iteration(job, project_obj)
+            elif job.stage == STAGE_TRAINING:
+                self._poll_training(job, project_obj)
+            elif job.stage == STAGE_EXPORTING:
+                self._poll_exporting(job, project_obj)
+            job.errors = 0
+        except Exception:
+            job.errors += 1
+            logger.exception("Poll %s failed (%s)", job, job.errors)
+            if job.errors >= TRAINING_MAX_ERRORS:
+                self._fail(job, traceback.format_exc())
+
+        if job.stage in ACTIVE_STAGES:
+            self._schedule(job, job.next_delay(self.min_interval, self.max_interval))
+        else:
+            self._finish(job)
+
+    def _finish(self, job: TrainingJob):
+        with self.cond:
+            if self.jobs.get(job.project_id) is job:
+                del self.jobs[job.project_id]
+
+    def _fail(self, job: TrainingJob, log: str):
+        upcreate_training_status(
+            project_id=job.project_id,
+            status="Failed",
+            log=log,
+            need_to_send_notification=True,
+        )
+        job.set_stage(STAGE_FAILED)
+        job.save()
+
+    def _poll_iteration(self, job: TrainingJob, project_obj: Project):
+        iterations = job.trainer.get_iterations(project_obj.customvision_id)
+        if iterations:
+            logger.info("Iteration Found %s", iterations[0])
+            job.iteration_id = iterations[0].id
+            job.set_stage(STAGE_TRAINING)
+            job.save()
+            upcreate_training_status(
+                project_id=job.project_id,
+                need_to_send_notification=True,
+                **progress.PROGRESS_7_TRAINING,
+            )
+        elif time.time() - job.stage_started_at > ITERATION_TIMEOUT:
+            logger.info("Something went wrong...")
+            self._fail(job, "Get iteration from Custom Vision occurs error.")
+
+    def _poll_training(self, job: TrainingJob, project_obj: Project):
+        iteration = job.trainer.get_iteration(
+            project_obj.customvision_id, job.iteration_id
+        )
+        if iteration.status == "Failed":
+            self._fail(job, "Training failed on Custom Vision.")
+        elif iteration.exportable and iteration.status == "Completed":
+            job.training_time = time.time() - job.stage_started_at
+            job.set_stage(STAGE_EXPORTING)
+            job.save()
+            upcreate_training_status(
+                project_id=job.project_id,
+                need_to_send_notification=True,
+                **progress.PROGRESS_8_EXPORTING,
+            )
+            self._request_exports(job, project_obj, exports=[])
+        else:
+            logger.info("Still training...")
+
+    def _poll_exporting(self, job: TrainingJob, project_obj: Project):
+        exports = job.trainer.get_exports(project_obj.customvision_id, job.iteration_id)
+        if len([export for export in exports if export.download_uri]) >= 2:
+            self._save_exports(job, project_obj, exports)
+        else:
+            logger.info("Status: exporting model")
+            self._request_exports(job, project_obj, exports)
+
+    def _request_exports(self, job: TrainingJob, project_obj: Project, exports):
+        """_request_exports.
+
+        Request the exports Custom Vision does not list yet, without waiting
+        for the answers.
+        """
+        if any(not request.done() for request in job.export_requests):
+            return
+        listed = {(export.platform.upper(), export.flavor or "") for export in exports}
+        job.export_requests = [
+            self.export_executor.submit(
+                self._export,
+                job.trainer,
+                project_obj.customvision_id,
+                job.iteration_id,
+                platform,
+                flavor,
+            )
+            for platform, flavor in EXPORTS
+            if (platform, flavor) not in listed
+        ]
+
+    @staticmethod
+    def _export(trainer, customvision_id, iteration_id, platform, flavor):
+        try:
+            trainer.export_iteration(
+                project_id=customvision_id,
+                iteration_id=iteration_id,
+                platform=platform,
+                flavor=flavor,
+            )
+        except Exception:
+            logger.exception("Export already in queue")
+
+    def _save_exports(self, job: TrainingJob, project_obj: Project, exports):
+        """_save_exports.
+
+        Store model uris and performance of the trained project.
+        """
+        for export in exports:
+            if export.flavor:
+                project_obj.download_uri_fp16 = export.download_uri
+            elif "onnx" in export.platform.lower():
+                project_obj.download_uri = export.download_uri
+            else:
+                project_obj.download_uri_openvino = export.download_uri
+        logger.info("Successfully export model: %s", project_obj.download_uri)
+
+        customvision_id = project_obj.customvision_id
+        train_performance_list = []
+        for iteration in job.trainer.get_iterations(customvision_id)[:2]:
+            train_performance_list.append(
+                job.trainer.get_iteration_performance(
+                    customvision_id, iteration.id
+                ).as_dict()
+            )
+        upcreate_training_status(
+            project_id=job.project_id,
+            performance=json.dumps(train_performance_list),
+            need_to_send_notification=True,
+            **progress.PROGRESS_9_SUCCESS,
+        )
+        logger.info("Training Performance: %s", train_performance_list)
+
+        if job.has_new_parts:
+            logger.info("This is a training job")
+            project_obj.training_counter += 1
+        elif job.has_new_images:
+            logger.info("This is a re-training job")
+            project_obj.retraining_counter += 1
+        project_obj.save()
+
+        job.set_stage(STAGE_DONE)
+        job.save()
+
+
+training_orchestrator = TrainingOrchestrator()
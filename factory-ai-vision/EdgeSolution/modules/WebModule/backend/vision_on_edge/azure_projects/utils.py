@@ -3,10 +3,19 @@
 
 import json
 import logging
+import os
 import sys
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
+from rest_framework import status
 
 from configs.general_configs import PRINT_THREAD
 
@@ -17,14 +26,22 @@ from ..azure_settings.exceptions import SettingCustomVisionAccessFailed
 from ..azure_settings.models import Setting
 from ..azure_training_status import progress
 from ..azure_training_status.utils import upcreate_training_status
-from ..images.models import Image
+from ..images.exceptions import ImageGetRemoteImageRequestsError
+from ..images.models import Image, update_image_parts
 from ..images.utils import upload_images_to_customvision_helper
 from ..notifications.models import Notification
 from .exceptions import ProjectAlreadyTraining, ProjectRemovedError
 from .models import Project, Task
+from .training import training_orchestrator
 
 logger = logging.getLogger(__name__)
 
+# Pulling a Custom Vision project
+CV_SYNC_WORKERS = int(os.environ.get("CV_SYNC_WORKERS", "8"))
+CV_SYNC_PAGE_SIZE = 50
+CV_SYNC_NOTIFY_INTERVAL = 5  # seconds between two progress notifications
+CV_SYNC_TIMEOUT = 30  # seconds per image download
+
 
 def update_app_insight_counter(
     project_obj,
@@ -180,6 +197,195 @@ def update_tags_helper(project_id, tags=None):
     
 
 
+def download_remote_image(url: str) -> bytes:
+    """download_remote_image.
+
+    Args:
+        url (str): remote image url
+
+    Returns:
+        bytes: image content
+    """
+    try:
+        resp = requests.get(url, timeout=CV_SYNC_TIMEOUT)
+    except Exception:
+        raise ImageGetRemoteImageRequestsError(detail=("url: " + url))
+    if resp.status_code != status.HTTP_200_OK:
+        raise ImageGetRemoteImageRequestsError(detail=("url: " + url))
+    return resp.content
+
+
+def save_remote_image(url: str, name: str):
+    """save_remote_image.
+
+    Download and store an image without touching the database, safe to
+    run in a worker thread.
+
+    Returns:
+        (stored file name, width, height)
+    """
+    content = download_remote_image(url)
+    with PILImage.open(BytesIO(content)) as img:
+        width, height = img.size
+    file_name = Image._meta.get_field("image").generate_filename(None, name)
+    return default_storage.save(file_name, ContentFile(content)), width, height
+
+
+def get_region_label(region, width: int, height: int, part_id):
+    """get_region_label.
+
+    Same label as Image.set_labels, None if the region is out of range.
+    """
+    left, top = region.left, region.top
+    right, bottom = left + region.width, top + region.height
+    if min(left, top, region.width, region.height) < 0 or max(right, bottom) > 1:
+        logger.error("Region %s out of range", region)
+        return None
+    label = {
+        "x1": int(width * left),
+        "y1": int(height * top),
+        "x2": int(width * right),
+        "y2": int(height * bottom),
+        "part": part_id,
+    }
+    if label["x2"] <= label["x1"] or label["y2"] <= label["y1"]:
+        logger.warning("Label format not accepted")
+        return None
+    return label
+
+
+def pull_cv_images_helper(
+    project_obj, trainer, max_workers: int = CV_SYNC_WORKERS, page_size: int = CV_SYNC_PAGE_SIZE
+) -> int:
+    """pull_cv_images_helper.
+
+    Incrementally pull the tagged images of a Custom Vision project. Pages
+    and image binaries are fetched concurrently, images already pulled
+    (same customvision_id or remote_url) are skipped and new ones are
+    written with one bulk_create per page.
+
+    Args:
+        project_obj: Django ORM project, with customvision_id
+        trainer: Custom Vision training client
+        max_workers (int): concurrent page / image downloads
+        page_size (int): images per get_tagged_images call
+
+    Returns:
+        int: number of images pulled
+    """
+    customvision_project_id = project_obj.customvision_id
+    parts = {part.name: part for part in Part.objects.filter(project=project_obj)}
+    existing = set()
+    for customvision_id, remote_url in Image.objects.filter(project=project_obj).values_list(
+        "customvision_id", "remote_url"
+    ):
+        existing.update((customvision_id, remote_url))
+
+    imgs_count = trainer.get_tagged_image_count(project_id=customvision_project_id)
+    logger.info("Pulling %s tagged images, %s already pulled", imgs_count, len(existing))
+
+    def get_page(skip):
+        return trainer.get_tagged_images(
+            project_id=customvision_project_id, take=page_size, skip=skip
+        )
+
+    def save_image(img, part):
+        try:
+            return save_remote_image(
+                img.original_image_uri,
+                f"{part.name}-{img.original_image_uri.split('/')[-1]}",
+            )
+        except Exception:
+            logger.exception("Download remote image occur exception.")
+            return None
+
+    img_counter = 0
+    skipped = 0
+    last_notify = time.time()
+    with ThreadPoolExecutor(max_workers) as page_executor, ThreadPoolExecutor(
+        max_workers
+    ) as image_executor:
+        pages = page_executor.map(get_page, range(0, imgs_count, page_size))
+        for page in pages:
+            to_pull = []
+            for img in page:
+                if img.id in existing or img.original_image_uri in existing:
+                    skipped += 1
+                    continue
+                existing.update((img.id, img.original_image_uri))
+                regions = [
+                    region for region in img.regions or [] if region.tag_name in parts
+                ]
+                tag_names = [region.tag_name for region in regions] or [
+                    tag.tag_name for tag in img.tags or [] if tag.tag_name in parts
+                ]
+                if not tag_names:
+                    continue
+                to_pull.append((img, regions, parts[tag_names[-1]]))
+
+            saved = image_executor.map(
+                lambda args: save_image(args[0], args[2]), to_pull
+            )
+            img_objs = []
+            for (img, regions, part), result in zip(to_pull, saved):
+                if result is None:
+                    logger.error("Image %s discarded...", img.id)
+                    continue
+                file_name, width, height = result
+                labels = []
+                for region in regions:
+                    label = get_region_label(
+                        region, width, height, parts[region.tag_name].id
+                    )
+                    if label:
+                        labels.append(label)
+                part_ids = []
+                for tag_name in [region.tag_name for region in regions] or [part.name]:
+                    if str(parts[tag_name].id) not in part_ids:
+                        part_ids.append(str(parts[tag_name].id))
+                img_objs.append(
+                    Image(
+                        project=project_obj,
+                        part=part,
+                        part_ids=json.dumps(part_ids),
+                        image=file_name,
+                        labels=json.dumps(labels),
+                        remote_url=img.original_image_uri,
+                        customvision_id=img.id,
+                        manual_checked=True,
+                        box_count=len(labels),
+                        width=width,
+                        height=height,
+                    )
+                )
+            Image.objects.bulk_create(img_objs)
+            update_image_parts(
+                Image.objects.filter(
+                    project=project_obj,
+                    customvision_id__in=[img_obj.customvision_id for img_obj in img_objs],
+                )
+            )
+            img_counter += len(img_objs)
+            logger.info("Pulled %s images, skipped %s", img_counter, skipped)
+
+            if time.time() - last_notify > CV_SYNC_NOTIFY_INTERVAL:
+                last_notify = time.time()
+                Notification.objects.create(
+                    notification_type="project",
+                    sender="system",
+                    title="Pulling project",
+                    details=f"Pulled {img_counter + skipped} of {imgs_count} images",
+                )
+
+    Notification.objects.create(
+        notification_type="project",
+        sender="system",
+        title="Pulling project",
+        details=f"Pulled {img_counter} new images, {skipped} already up to date",
+    )
+    return img_counter
+
+
 def pull_cv_project_helper(customvision_project_id: str, is_partial: bool):
     """pull_cv_project_helper.
 
@@ -210,14 +416,21 @@ def pull_cv_project_helper(customvision_project_id: str, is_partial: bool):
     ]
     
     inputs = json.dumps(inputs_)
-    project_obj = Project.objects.create(
-        setting=setting_obj, 
-        is_demo=False, 
-        category="customvision", 
-        is_cascade=True, 
-        type="customvision_model",
-        inputs=inputs,
-    )
+    # Pull again into the same project, only new images are downloaded
+    project_obj = Project.objects.filter(
+        customvision_id=customvision_project_id, is_demo=False
+    ).first()
+    if project_obj is None:
+        project_obj = Project.objects.create(
+            setting=setting_obj, 
+            is_demo=False, 
+            category="customvision", 
+            is_cascade=True, 
+            type="customvision_model",
+            inputs=inputs,
+        )
+    else:
+        logger.info("Project %s already pulled, updating it", project_obj.id)
     # Check Training_Key, Endpoint
     if not project_obj.setting.is_trainer_valid:
         raise SettingCustomVisionAccessFailed
@@ -271,14 +484,16 @@ def pull_cv_project_helper(customvision_project_id: str, is_partial: bool):
         logger.info("Creating Part %s: %s %s", counter, tag.name, tag.description)
         part_obj, created = Part.objects.update_or_create(
             project_id=project_obj.id,
-            name=tag.name,
-            description=tag.description if tag.description else "",
             customvision_id=tag.id,
+            defaults={
+                "name": tag.name,
+                "description": tag.description if tag.description else "",
+            },
         )
 
-        # Make sure part is created
+        # Parts of a previous pull already have their icon
         if not created:
-            logger.exception("%s not created", tag.name)
+            logger.info("%s already pulled", tag.name)
             continue
         logger.info(
             "Create Part %s: %s %s Success!", counter, tag.name, tag.description
@@ -342,59 +557,7 @@ def pull_cv_project_helper(customvision_project_id: str, is_partial: bool):
 
     # Full Download
     logger.info("Pulling Tagged Images...")
-    img_counter = 0
-    imgs_count = trainer.get_tagged_image_count(project_id=customvision_project_id)
-    img_batch_size = 50
-    img_index = 0
-
-    while img_index <= imgs_count:
-        logger.info("Img Index: %s. Img Count: %s", img_index, imgs_count)
-        imgs = trainer.get_tagged_images(
-            project_id=customvision_project_id, take=img_batch_size, skip=img_index
-        )
-        for img in imgs:
-            logger.info("*** img %s", img_counter)
-            img_obj, created = Image.objects.update_or_create(
-                remote_url=img.original_image_uri,
-                project=project_obj,
-                customvision_id=img.id,
-                manual_checked=True,
-            )
-            img_id = img_obj.id
-            if created:
-                # logger.info("Downloading img %s", img.id)
-                # img_obj.get_remote_image()
-                # logger.info("Setting label of %s", img.id)
-                # img_obj.set_labels(
-                #     left=region.left,
-                #     top=region.top,
-                #     width=region.width,
-                #     height=region.height,
-                #     tag_id=img_obj.part.pk,
-                # )
-                img_counter += 1
-            for region in img.regions:
-                part_objs = Part.objects.filter(
-                    name=region.tag_name, project_id=project_obj.id
-                )
-                if not part_objs.exists():
-                    continue
-                part_obj = part_objs.first()
-
-                logger.info("Adding label to %s", img.id)
-                # img_obj = Image.objects.get(pk=img_id)
-                img_obj.part = part_obj
-                img_obj.get_remote_image()
-                img_obj.set_labels(
-                    left=region.left,
-                    top=region.top,
-                    width=region.width,
-                    height=region.height,
-                    tag_id=part_obj.id,
-                )
-
-        img_index += img_batch_size
-    logger.info("Pulled %s images", counter)
+    pull_cv_images_helper(project_obj=project_obj, trainer=trainer)
     logger.info("Pulling Tagged Images... End")
     logger.info("Pulling Custom Vision Project... End")
 
@@ -505,13 +668,9 @@ def train_project_worker(project_id):
     # =====================================================
     # 4. Upload images to Custom Vision Project         ===
     # =====================================================
-    for part_id in part_ids:
-        logger.info("Uploading images with part_id %s", part_id)
-        has_new_images = upload_images_to_customvision_helper(
-            project_id=project_obj.id, part_id=part_id
-        )
-        if has_new_images:
-            project_changed = True
+    has_new_images = upload_images_to_customvision_helper(project_id=project_obj.id)
+    if has_new_images:
+        project_changed = True
 
     # =====================================================
     # 5. Submit Training Task to Custom Vision          ===
@@ -542,145 +701,14 @@ def train_project_worker(project_id):
         )
 
     # =====================================================
-    # 6. Training (Finding Iteration)                   ===
-    # =====================================================
-    logger.info("Finding Iteration")
-    customvision_id = project_obj.customvision_id
-    wait_prepare = 0
-    max_wait_prepare = 60
-    status_init = False
-    while True:
-        time.sleep(1)
-        wait_prepare += 1
-        iterations = trainer.get_iterations(customvision_id)
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_6_PREPARING_CUSTOM_VISION_ENV,
-            )
-            status_init = True
-        if len(iterations) > 0:
-            logger.info("Iteration Found %s", iterations[0])
-            break
-        if wait_prepare > max_wait_prepare:
-            logger.info("Something went wrong...")
-            upcreate_training_status(
-                project_id=project_obj.id,
-                status="Failed",
-                log="Get iteration from Custom Vision occurs error.",
-                need_to_send_notification=True,
-            )
-            break
-
-    # =====================================================
-    # 6. Training (Waiting)                             ===
-    # =====================================================
-    logger.info("Training")
-    status_init = False
-    while True:
-        time.sleep(1)
-        iterations = trainer.get_iterations(customvision_id)
-        iteration = iterations[0]
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_7_TRAINING,
-            )
-            status_init = True
-        if iteration.exportable and iteration.status == "Completed":
-            break
-        logger.info("Still training...")
-
-    # =====================================================
-    # 7. Exporting                                      ===
+    # 6. Training, exporting and saving the model are   ===
+    #    followed by the training orchestrator          ===
     # =====================================================
-    status_init = False
-    while True:
-        time.sleep(1)
-        if not status_init:
-            upcreate_training_status(
-                project_id=project_obj.id,
-                need_to_send_notification=True,
-                **progress.PROGRESS_8_EXPORTING,
-            )
-            status_init = True
-        try:
-            project_obj.export_iteration(iteration.id)
-        except Exception:
-            logger.exception("Export already in queue")
-        try:
-            project_obj.export_iteration(iteration.id, flavor="ONNXFloat16")
-        except Exception:
-            logger.exception("Export already in queue")
-        try:
-            project_obj.export_iteration(iteration.id, platform="OPENVINO")
-        except Exception:
-            logger.exception("Export already in queue")
-        try:
-            exports = project_obj.get_exports(iteration.id)
-        except Exception:
-            logger.exception("get_exports exception")
-            continue
-        if (
-            len(exports) < 2
-            or not exports[0].download_uri
-            or not exports[1].download_uri
-        ):
-            logger.info("Status: exporting model")
-            continue
-        break
-
-    # =====================================================
-    # 8. Saving model and performance                   ===
-    # =====================================================
-    logger.info("Successfully export model: %s", project_obj.download_uri)
-    logger.info("Training about to completed.")
-
-    exports = trainer.get_exports(customvision_id, iteration.id)
-
-    for export in exports:
-        if export.flavor:
-            project_obj.download_uri_fp16 = export.download_uri
-        else:
-            if "onnx" in export.platform.lower():
-                project_obj.download_uri = export.download_uri
-            else:
-                project_obj.download_uri_openvino = export.download_uri
-
-    # if not exports[0].flavor:
-    #     project_obj.download_uri = exports[0].download_uri
-    #     project_obj.download_uri_fp16 = exports[1].download_uri
-    # else:
-    #     project_obj.download_uri = exports[1].download_uri
-    #     project_obj.download_uri_fp16 = exports[0].download_uri
-
-    train_performance_list = []
-
-    for iteration in iterations[:2]:
-        train_performance_list.append(
-            trainer.get_iteration_performance(customvision_id, iteration.id).as_dict()
-        )
-
-    upcreate_training_status(
+    training_orchestrator.watch(
         project_id=project_obj.id,
-        performance=json.dumps(train_performance_list),
-        need_to_send_notification=True,
-        **progress.PROGRESS_9_SUCCESS,
+        has_new_parts=has_new_parts,
+        has_new_images=has_new_images,
     )
-    logger.info("Training Performance: %s", train_performance_list)
-
-    # =====================================================
-    # 0. End                                            ===
-    # =====================================================
-    if has_new_parts:
-        logger.info("This is a training job")
-        project_obj.training_counter += 1
-    elif has_new_images:
-        logger.info("This is a re-training job")
-        project_obj.retraining_counter += 1
-    project_obj.save()
 
 
 def train_project_catcher(project_id):
@@ -710,6 +738,7 @@ class TrainingManager:
         self.training_tasks = {}
         self.mutex = threading.Lock()
         self.garbage_collector()
+        training_orchestrator.start()
 
     def add(self, project_id):
         """add.
@@ -718,6 +747,8 @@ class TrainingManager:
         """
         if project_id in self.training_tasks:
             raise ProjectAlreadyTraining
+        if training_orchestrator.is_watching(project_id):
+            raise ProjectAlreadyTraining
         self.mutex.acquire()
         task = TrainingTask(project_id=project_id)
         self.training_tasks[project_id] = task
@@ -26,7 +26,10 @@ class ImageViewSet(FiltersMixin, viewsets.ModelViewSet):
             queryset = Image.objects.filter(project=project)
         else:
             queryset = Image.objects.all()
-        return queryset
+        part = self.request.query_params.get('part')
+        if part:
+            queryset = queryset.filter(parts=part)
+        return queryset.prefetch_related("parts")
 
     def destroy(self, request, **kwargs):
         """destroy.
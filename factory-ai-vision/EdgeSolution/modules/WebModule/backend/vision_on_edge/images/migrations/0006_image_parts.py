@@ -0,0 +1,86 @@
+# Generated by Django 3.0.8 on 2021-10-06 03:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("azure_parts", "0003_auto_20210914_1020"),
+        ("images", "0005_image_part_ids"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImagePart",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("box_count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="box_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="height",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="width",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(
+                fields=["project", "is_relabel", "timestamp"],
+                name="images_imag_project_4bf0c2_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="image",
+            index=models.Index(
+                fields=["project", "manual_checked", "uploaded"],
+                name="images_imag_project_57e0ea_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="imagepart",
+            name="image",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="images.Image"
+            ),
+        ),
+        migrations.AddField(
+            model_name="imagepart",
+            name="part",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="azure_parts.Part"
+            ),
+        ),
+        migrations.AddField(
+            model_name="image",
+            name="parts",
+            field=models.ManyToManyField(
+                related_name="tagged_images",
+                through="images.ImagePart",
+                to="azure_parts.Part",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="imagepart",
+            unique_together={("image", "part")},
+        ),
+    ]
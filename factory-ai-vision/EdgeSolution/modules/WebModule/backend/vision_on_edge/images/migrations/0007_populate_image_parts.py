@@ -0,0 +1,54 @@
+# Generated by Django 3.0.8 on 2021-10-06 03:15
+
+import json
+
+from django.db import migrations
+from PIL import Image as PILImage
+
+
+def populate_image_parts(apps, schema_editor):
+    """Fill ImagePart, box_count and width / height from existing images."""
+    Image = apps.get_model("images", "Image")
+    ImagePart = apps.get_model("images", "ImagePart")
+    Part = apps.get_model("azure_parts", "Part")
+
+    part_ids = set(Part.objects.values_list("id", flat=True))
+    image_parts = []
+    for img_obj in Image.objects.all().iterator():
+        counts = {}
+        try:
+            for part_id in json.loads(img_obj.part_ids or "[]"):
+                counts[int(part_id)] = 0
+            labels = json.loads(img_obj.labels or "[]")
+            for label in labels:
+                counts[int(label["part"])] = counts.get(int(label["part"]), 0) + 1
+        except (TypeError, ValueError, KeyError):
+            labels = []
+        img_obj.box_count = len(labels)
+        try:
+            with PILImage.open(img_obj.image) as img:
+                img_obj.width, img_obj.height = img.size
+            img_obj.image.close()
+        except Exception:
+            pass
+        img_obj.save(update_fields=["box_count", "width", "height"])
+        for part_id, box_count in counts.items():
+            if part_id in part_ids:
+                image_parts.append(
+                    ImagePart(image_id=img_obj.id, part_id=part_id, box_count=box_count)
+                )
+        if len(image_parts) >= 1000:
+            ImagePart.objects.bulk_create(image_parts)
+            image_parts = []
+    ImagePart.objects.bulk_create(image_parts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("images", "0006_image_parts"),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_image_parts, migrations.RunPython.noop),
+    ]
@@ -8,7 +8,7 @@ from io import BytesIO
 import requests
 from django.core import files
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_save, pre_save
 from PIL import Image as PILImage
 from rest_framework import status
 
@@ -40,6 +40,18 @@ class Image(models.Model):
     remote_url = models.CharField(max_length=1000, null=True)
     timestamp = models.DateTimeField(auto_now=True)
 
+    # part_ids and labels normalized, kept in sync on save
+    parts = models.ManyToManyField(Part, through="ImagePart", related_name="tagged_images")
+    box_count = models.IntegerField(default=0)
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["project", "is_relabel", "timestamp"]),
+            models.Index(fields=["project", "manual_checked", "uploaded"]),
+        ]
+
     def get_remote_image(self):
         """get_remote_image.
 
@@ -84,35 +96,38 @@ class Image(models.Model):
             logger.error("top + height: %s + %s must be less than 1", top, height)
             return
 
-        with PILImage.open(self.image) as img:
-            size_width, size_height = img.size
-            logger.info("Setting labels. Image size %s", self.image)
-            label_x1 = int(size_width * left)
-            label_y1 = int(size_height * top)
-            label_x2 = int(size_width * (left + width))
-            label_y2 = int(size_height * (top + height))
-            # to be modified to multi-labels
-            if self.labels:
-                if len(self.labels) > 0:
-                    labels = json.loads(self.labels)
-            else:
-                labels = []
-
-            if self.part_ids:
-                if len(self.part_ids) > 0:
-                    part_ids = json.loads(self.part_ids)
-            else:
-                part_ids = []
-
-            labels.append({"x1": label_x1, "y1": label_y1,
-                           "x2": label_x2, "y2": label_y2, "part": tag_id})
-            if str(tag_id) not in part_ids:
-                part_ids.append(str(tag_id))
-                self.part_ids = json.dumps(part_ids)
-            self.labels = json.dumps(labels)
-            self.save()
-            logger.info("Set image labels success %s", self.labels)
-            logger.info("Set image part_ids success %s", self.part_ids)
+        if self.width and self.height:
+            size_width, size_height = self.width, self.height
+        else:
+            with PILImage.open(self.image) as img:
+                size_width, size_height = img.size
+        logger.info("Setting labels. Image size %s", self.image)
+        label_x1 = int(size_width * left)
+        label_y1 = int(size_height * top)
+        label_x2 = int(size_width * (left + width))
+        label_y2 = int(size_height * (top + height))
+        # to be modified to multi-labels
+        if self.labels:
+            if len(self.labels) > 0:
+                labels = json.loads(self.labels)
+        else:
+            labels = []
+
+        if self.part_ids:
+            if len(self.part_ids) > 0:
+                part_ids = json.loads(self.part_ids)
+        else:
+            part_ids = []
+
+        labels.append({"x1": label_x1, "y1": label_y1,
+                       "x2": label_x2, "y2": label_y2, "part": tag_id})
+        if str(tag_id) not in part_ids:
+            part_ids.append(str(tag_id))
+            self.part_ids = json.dumps(part_ids)
+        self.labels = json.dumps(labels)
+        self.save()
+        logger.info("Set image labels success %s", self.labels)
+        logger.info("Set image part_ids success %s", self.part_ids)
 
     @staticmethod
     def pre_save(**kwargs):
@@ -144,6 +159,28 @@ class Image(models.Model):
 
         instance.labels = json.dumps(updated_labels)
         instance.part_ids = json.dumps(part_ids)
+        instance.box_count = len(updated_labels)
+
+        saved = None
+        if instance.pk is not None:
+            saved = (
+                Image.objects.filter(pk=instance.pk)
+                .values("image", "labels", "part_ids")
+                .first()
+            )
+        # read by post_save, ImagePart rows only change with labels / part_ids
+        instance._labels_changed = (
+            saved is None
+            or saved["labels"] != instance.labels
+            or saved["part_ids"] != instance.part_ids
+        )
+        image_changed = saved is None or saved["image"] != instance.image.name
+        if instance.image and (image_changed or instance.width is None):
+            try:
+                instance.width = instance.image.width
+                instance.height = instance.image.height
+            except Exception:
+                logger.warning("Cannot read image size of %s", instance.image)
 
         if instance.project is None and instance.part is not None:
             instance.project = instance.part.project
@@ -151,4 +188,76 @@ class Image(models.Model):
             return
 
 
+    @staticmethod
+    def post_save(**kwargs):
+        """post_save.
+
+        Args:
+            instance:
+            kwargs:
+        """
+        instance = kwargs["instance"]
+        if getattr(instance, "_labels_changed", True):
+            update_image_parts([instance])
+
+
+class ImagePart(models.Model):
+    """ImagePart model.
+
+    Parts labeled on an image, with the number of boxes of each part.
+    """
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE)
+    part = models.ForeignKey(Part, on_delete=models.CASCADE)
+    box_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("image", "part")
+
+
+def get_part_box_counts(labels, part_ids) -> dict:
+    """get_part_box_counts.
+
+    Args:
+        labels: Image.labels
+        part_ids: Image.part_ids
+
+    Returns:
+        dict: part id -> number of boxes, parts without box included.
+    """
+    counts = {int(part_id): 0 for part_id in json.loads(part_ids or "[]")}
+    for label in json.loads(labels or "[]"):
+        part_id = int(label["part"])
+        counts[part_id] = counts.get(part_id, 0) + 1
+    return counts
+
+
+def update_image_parts(img_objs):
+    """update_image_parts.
+
+    Rebuild the ImagePart rows of saved images from labels / part_ids.
+
+    Args:
+        img_objs: saved images
+    """
+    counts = {
+        img_obj.pk: get_part_box_counts(img_obj.labels, img_obj.part_ids)
+        for img_obj in img_objs
+    }
+    all_part_ids = {part_id for c in counts.values() for part_id in c}
+    existing_part_ids = set(
+        Part.objects.filter(pk__in=all_part_ids).values_list("id", flat=True)
+    )
+    ImagePart.objects.filter(image_id__in=counts).delete()
+    ImagePart.objects.bulk_create(
+        [
+            ImagePart(image_id=image_id, part_id=part_id, box_count=box_count)
+            for image_id, c in counts.items()
+            for part_id, box_count in c.items()
+            if part_id in existing_part_ids
+        ]
+    )
+
+
 pre_save.connect(Image.pre_save, Image, dispatch_uid="Image_pre")
+post_save.connect(Image.post_save, Image, dispatch_uid="Image_post")
@@ -1,10 +1,19 @@
 """App model tests.
 """
 
+import importlib
+import json
+from io import BytesIO
+
 import pytest
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from PIL import Image as PILImage
 
 from ...azure_part_detections.models import PartDetection
-from ..models import Image
+from ...azure_parts.models import Part
+from ..models import Image, ImagePart
 
 pytestmark = pytest.mark.django_db
 
@@ -93,3 +102,109 @@ def test_not_delete_relabel_if_acc_range_not_change(project, part):
     part_detection.accuracyRangeMax -= 1
     part_detection.save()
     assert Image.objects.all().count() == 0
+
+
+def create_image_file(name="img.png", size=(100, 50)):
+    """create_image_file."""
+    bytes_io = BytesIO()
+    PILImage.new("RGB", size).save(bytes_io, format="PNG")
+    return ContentFile(bytes_io.getvalue(), name=name)
+
+
+def test_image_parts_follow_labels(project, part):
+    """ImagePart rows, box_count and size are kept in sync on save."""
+    other_part = Part.objects.create(project=project, name="other part")
+    img_obj = Image.objects.create(
+        project=project,
+        image=create_image_file(),
+        labels=json.dumps(
+            [
+                {"x1": 0, "y1": 0, "x2": 10, "y2": 10, "part": part.id},
+                {"x1": 5, "y1": 5, "x2": 20, "y2": 20, "part": part.id},
+                {"x1": 0, "y1": 0, "x2": 10, "y2": 10, "part": other_part.id},
+            ]
+        ),
+    )
+    assert (img_obj.width, img_obj.height) == (100, 50)
+    assert img_obj.box_count == 3
+    assert dict(
+        ImagePart.objects.filter(image=img_obj).values_list("part_id", "box_count")
+    ) == {part.id: 2, other_part.id: 1}
+    assert list(part.tagged_images.all()) == [img_obj]
+
+    img_obj.labels = json.dumps(
+        [{"x1": 0, "y1": 0, "x2": 10, "y2": 10, "part": other_part.id}]
+    )
+    img_obj.part_ids = "[]"
+    img_obj.save()
+    assert img_obj.box_count == 1
+    assert not part.tagged_images.exists()
+    assert list(Image.objects.filter(parts=other_part)) == [img_obj]
+
+
+def test_image_set_labels_without_opening_image(project, part, monkeypatch):
+    """set_labels uses the stored image size."""
+    img_obj = Image.objects.create(project=project, image=create_image_file())
+    monkeypatch.setattr(
+        "vision_on_edge.images.models.PILImage.open",
+        lambda *args: pytest.fail("image opened"),
+    )
+    img_obj.set_labels(left=0.1, top=0.2, width=0.5, height=0.5, tag_id=part.id)
+    assert json.loads(img_obj.labels) == [
+        {"x1": 10, "y1": 10, "x2": 60, "y2": 35, "part": part.id}
+    ]
+    assert list(part.tagged_images.all()) == [img_obj]
+
+
+def test_populate_image_parts_migration(project, part):
+    """The data migration builds ImagePart from part_ids / labels."""
+    img_obj = Image.objects.create(
+        project=project,
+        image=create_image_file(),
+        labels=json.dumps([{"x1": 0, "y1": 0, "x2": 10, "y2": 10, "part": part.id}]),
+    )
+    ImagePart.objects.all().delete()
+    Image.objects.update(box_count=0, width=None, height=None)
+
+    migration = importlib.import_module(
+        "vision_on_edge.images.migrations.0007_populate_image_parts"
+    )
+    state = MigrationLoader(connection).project_state(
+        ("images", "0007_populate_image_parts")
+    )
+    migration.populate_image_parts(state.apps, None)
+
+    img_obj.refresh_from_db()
+    assert (img_obj.box_count, img_obj.width, img_obj.height) == (1, 100, 50)
+    assert list(Image.objects.filter(parts=part)) == [img_obj]
+
+
+def test_image_size_follows_image_file(project):
+    """The stored size is read again when the image file changes."""
+    img_obj = Image.objects.create(project=project, image=create_image_file())
+    assert (img_obj.width, img_obj.height) == (100, 50)
+
+    img_obj.image = create_image_file(name="other.png", size=(30, 40))
+    img_obj.save()
+    assert (img_obj.width, img_obj.height) == (30, 40)
+
+
+def test_image_parts_only_rebuilt_when_labels_change(project, part, monkeypatch):
+    """Saving an image without touching its labels keeps its ImagePart rows."""
+    img_obj = Image.objects.create(
+        project=project,
+        image=create_image_file(),
+        labels=json.dumps([{"x1": 0, "y1": 0, "x2": 10, "y2": 10, "part": part.id}]),
+    )
+    rebuilt = []
+    monkeypatch.setattr(
+        "vision_on_edge.images.models.update_image_parts", rebuilt.extend
+    )
+
+    img_obj.manual_checked = True
+    img_obj.save()
+    assert not rebuilt
+
+    img_obj.labels = "[]"
+    img_obj.save()
+    assert rebuilt == [img_obj]
@@ -0,0 +1,105 @@
+"""App utilities tests.
+"""
+
+import json
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage
+
+from ...azure_parts.models import Part
+from ...azure_projects.tests.factories import ProjectFactory
+from ...azure_projects.tests.fakes import FakeTrainer
+from ...azure_settings.models import Setting
+from .. import utils
+from ..models import Image
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def trainer(monkeypatch):
+    fake_trainer = FakeTrainer()
+    monkeypatch.setattr(
+        Setting, "get_trainer_obj", mock.MagicMock(return_value=fake_trainer)
+    )
+    return fake_trainer
+
+
+def create_images(part, count):
+    bytes_io = BytesIO()
+    PILImage.new("RGB", (100, 50)).save(bytes_io, format="PNG")
+    for i in range(count):
+        img_obj = Image(
+            part=part,
+            labels=json.dumps(
+                [{"x1": 10, "y1": 10, "x2": 60, "y2": 35, "part": part.id}]
+            ),
+            manual_checked=True,
+        )
+        img_obj.image.save(f"img-{i}.png", ContentFile(bytes_io.getvalue()), save=False)
+        img_obj.save()
+
+
+def test_upload_images_to_customvision_helper(trainer):
+    """Upload every image of the project in batches of 64."""
+    project = ProjectFactory(customvision_id="fake_id")
+    part = Part.objects.create(project=project, name="bolt", customvision_id="tag-bolt")
+    create_images(part, 130)
+
+    assert utils.upload_images_to_customvision_helper(project_id=project.id)
+    assert sorted(len(images) for images in trainer.batches) == [2, 64, 64]
+    region = trainer.batches[0][0].regions[0]
+    assert region.tag_id == "tag-bolt"
+    assert (region.left, region.top, region.width, region.height) == (
+        0.1,
+        0.2,
+        0.5,
+        0.5,
+    )
+    assert not Image.objects.filter(uploaded=False).exists()
+    assert Image.objects.filter(customvision_id__startswith="cv-").count() == 130
+
+    trainer.batches = []
+    assert not utils.upload_images_to_customvision_helper(project_id=project.id)
+    assert trainer.batches == []
+
+
+def test_upload_images_to_customvision_helper_failed_batch(trainer, monkeypatch):
+    """Batches uploaded beside a failed one are still marked uploaded."""
+    project = ProjectFactory(customvision_id="fake_id")
+    part = Part.objects.create(project=project, name="bolt", customvision_id="tag-bolt")
+    create_images(part, 130)
+    create_images_from_files = trainer.create_images_from_files
+    calls = []
+
+    def fail_first_batch(project_id, batch):
+        with trainer.mutex:
+            calls.append(batch)
+            if len(calls) == 1:
+                raise RuntimeError("Custom Vision error")
+        return create_images_from_files(project_id, batch)
+
+    monkeypatch.setattr(trainer, "create_images_from_files", fail_first_batch)
+
+    with pytest.raises(RuntimeError):
+        utils.upload_images_to_customvision_helper(project_id=project.id)
+    uploaded = sum(len(images) for images in trainer.batches)
+    assert uploaded == 130 - len(calls[0].images)
+    assert Image.objects.filter(uploaded=True).count() == uploaded
+
+
+def test_upload_images_to_customvision_helper_throttled(trainer):
+    """Throttled batches are retried."""
+    project = ProjectFactory(customvision_id="fake_id")
+    part = Part.objects.create(project=project, name="bolt", customvision_id="tag-bolt")
+    create_images(part, 3)
+    trainer.throttled = 2
+
+    assert utils.upload_images_to_customvision_helper(
+        project_id=project.id, part_id=part.id
+    )
+    assert [len(images) for images in trainer.batches] == [3]
+    assert not Image.objects.filter(uploaded=False).exists()
@@ -4,12 +4,17 @@
 import datetime
 import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
 
 from azure.cognitiveservices.vision.customvision.training.models import (
     ImageFileCreateBatch,
     ImageFileCreateEntry,
     Region,
 )
+from PIL import Image as PILImage
 
 from ..azure_parts.models import Part
 from ..azure_projects.models import Project
@@ -17,9 +22,97 @@ from .models import Image
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_BATCH_SIZE = 64  # max images per create_images_from_files
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))  # concurrent batches
+UPLOAD_READ_WORKERS = 8
+UPLOAD_MAX_RETRIES = 5
+UPLOAD_BACKOFF = 1  # seconds, doubled on each throttled retry
+
+
+def get_throttle_delay(error, retry: int):
+    """get_throttle_delay.
+
+    Args:
+        error: exception raised by the trainer
+        retry (int): number of retries so far
+
+    Returns:
+        seconds to wait before retrying, None if error is not throttling.
+    """
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return UPLOAD_BACKOFF * 2 ** retry
+
+
+def create_images_with_retry(trainer, customvision_project_id, img_entries):
+    """create_images_with_retry.
+
+    create_images_from_files, retried with backoff while throttled.
+    """
+    retry = 0
+    while True:
+        try:
+            return trainer.create_images_from_files(
+                project_id=customvision_project_id,
+                batch=ImageFileCreateBatch(images=img_entries),
+            )
+        except Exception as error:
+            delay = get_throttle_delay(error, retry)
+            if delay is None or retry >= UPLOAD_MAX_RETRIES:
+                raise
+            retry += 1
+            logger.warning("Upload throttled, retry %s in %s s", retry, delay)
+            time.sleep(delay)
+
+
+def read_image_entry(image_obj, tags_dict: dict):
+    """read_image_entry.
+
+    Read the image file and convert its labels to regions, without touching
+    the database.
+
+    Args:
+        image_obj: Image
+        tags_dict (dict): part id -> Custom Vision tag id
+
+    Returns:
+        ImageFileCreateEntry, None if the image has no label.
+    """
+    labels = json.loads(image_obj.labels)
+    if len(labels) == 0:
+        return None
+    image = image_obj.image
+    image.open()
+    try:
+        contents = image.read()
+    finally:
+        image.close()
+    width, height = image_obj.width, image_obj.height
+    if not width or not height:
+        with PILImage.open(BytesIO(contents)) as img:
+            width, height = img.size
+
+    regions = []
+    for label in labels:
+        regions.append(
+            Region(
+                tag_id=tags_dict[int(label["part"])],
+                left=label["x1"] / width,
+                top=label["y1"] / height,
+                width=(label["x2"] - label["x1"]) / width,
+                height=(label["y2"] - label["y1"]) / height,
+            )
+        )
+    img_name = "img-" + datetime.datetime.utcnow().isoformat()
+    return ImageFileCreateEntry(name=img_name, contents=contents, regions=regions)
+
 
 def upload_images_to_customvision_helper(
-    project_id, part_id, batch_size: int = 10
+    project_id, part_id=None, batch_size: int = UPLOAD_BATCH_SIZE
 ) -> bool:
     """upload_images_to_customvision_helper.
 
@@ -27,10 +120,13 @@ def upload_images_to_customvision_helper(
     Make sure part already upload to Custom Vision (
     customvision_id not null or blank).
 
+    Files are read by a thread pool and batches are uploaded concurrently,
+    each batch status is written back with one bulk update.
+
     Args:
         project_id:
-        part_id:
-        batch_size (int): batch_size
+        part_id: upload the images of this part, all parts if None.
+        batch_size (int): batch_size, at most 64
 
     Returns:
         bool:
@@ -41,90 +137,87 @@ def upload_images_to_customvision_helper(
     has_new_images = False
     project_obj = Project.objects.get(pk=project_id)
     trainer = project_obj.setting.get_trainer_obj()
-    part_obj: Part = Part.objects.get(pk=part_id)
-    tag_id = part_obj.customvision_id
-    images = Image.objects.filter(part_ids__contains='"{}"'.format(
-        str(part_id)), manual_checked=True, uploaded=False)
-    logger.info("Tag id %s", tag_id)
-    count = 0
-    img_entries = []
-    img_objs = []
-
+    if part_id is None:
+        images = Image.objects.filter(project=project_obj)
+    else:
+        images = Image.objects.filter(parts=part_id)
+    images = list(images.filter(manual_checked=True, uploaded=False))
     logger.info("Image length: %s", len(images))
-
-    for index, image_obj in enumerate(images):
-        logger.info("*** image %s, %s", index + 1, image_obj)
-        has_new_images = True
-
-        img_name = "img-" + datetime.datetime.utcnow().isoformat()
-
-        regions = []
-        width = image_obj.image.width
-        height = image_obj.image.height
+    if not images:
+        return has_new_images
+
+    # Resolve every label once
+    part_pks = set(
+        Part.objects.filter(project=project_obj).values_list("id", flat=True)
+    )
+    for image_obj in images:
+        for label in json.loads(image_obj.labels or "[]"):
+            part_pks.add(int(label["part"]))
+    tags_dict = dict(
+        Part.objects.filter(pk__in=part_pks).values_list("id", "customvision_id")
+    )
+
+    def read_entry(image_obj):
         try:
-            labels = json.loads(image_obj.labels)
-            if len(labels) == 0:
-                continue
-            for label in labels:
-                label_x = label["x1"] / width
-                label_y = label["y1"] / height
-                label_w = (label["x2"] - label["x1"]) / width
-                label_h = (label["y2"] - label["y1"]) / height
-                label_tag_id = int(label["part"])
-                part_obj: Part = Part.objects.get(pk=label_tag_id)
-                tag_id = part_obj.customvision_id
-                region = Region(
-                    tag_id=tag_id,
-                    left=label_x,
-                    top=label_y,
-                    width=label_w,
-                    height=label_h,
-                )
-                regions.append(region)
-
-            image = image_obj.image
-            image.open()
-            img_entry = ImageFileCreateEntry(
-                name=img_name, contents=image.read(), regions=regions
-            )
-            img_objs.append(image_obj)
-            img_entries.append(img_entry)
-            count += 1
+            return read_image_entry(image_obj, tags_dict)
         except Exception:
             logger.exception("unexpected error")
-
-        if len(img_entries) >= batch_size:
-            logger.info("Uploading %s images", len(img_entries))
-            upload_result = trainer.create_images_from_files(
-                project_id=project_obj.customvision_id,
-                batch=ImageFileCreateBatch(images=img_entries),
-            )
+            return None
+
+    def upload_batch(img_objs):
+        # Read files while the other batches are uploading, keeping at
+        # most UPLOAD_WORKERS batches in memory
+        entries = read_executor.map(read_entry, img_objs)
+        batch = [(img_obj, entry) for img_obj, entry in zip(img_objs, entries) if entry]
+        if not batch:
+            return batch, None
+        logger.info("Uploading %s images", len(batch))
+        upload_result = create_images_with_retry(
+            trainer, project_obj.customvision_id, [entry for _, entry in batch]
+        )
+        return batch, upload_result
+
+    has_new_images = True
+    batch_size = min(batch_size, UPLOAD_BATCH_SIZE)
+    with ThreadPoolExecutor(UPLOAD_READ_WORKERS) as read_executor, ThreadPoolExecutor(
+        UPLOAD_WORKERS
+    ) as upload_executor:
+        uploads = [
+            upload_executor.submit(upload_batch, images[i : i + batch_size])
+            for i in range(0, len(images), batch_size)
+        ]
+        error = None
+        for future in as_completed(uploads):
+            try:
+                batch, upload_result = future.result()
+            except Exception as e:
+                # the other batches are still written back
+                logger.exception("Uploading images failed")
+                error = error or e
+                continue
+            if upload_result is None:
+                continue
             logger.info(
                 "Uploading images... Is batch success: %s",
                 upload_result.is_batch_successful,
             )
-            img_entries = []
-            for i, img_obj in enumerate(img_objs):
-                img_obj.customvision_id = upload_result.images[i].image.id
-                img_obj.uploaded = True
-                img_obj.save()
             img_objs = []
+            for (img_obj, _), result in zip(batch, upload_result.images):
+                if result.image is None:
+                    logger.error(
+                        "Upload image %s failed: %s", img_obj.id, result.status
+                    )
+                    continue
+                img_obj.customvision_id = result.image.id
+                img_obj.remote_url = result.image.original_image_uri
+                img_obj.uploaded = True
+                img_objs.append(img_obj)
+            Image.objects.bulk_update(
+                img_objs, ["customvision_id", "remote_url", "uploaded"]
+            )
+    if error is not None:
+        raise error
 
-    if len(img_entries) >= 1:
-        logger.info("Uploading %s images", len(img_entries))
-        upload_result = trainer.create_images_from_files(
-            project_id=project_obj.customvision_id,
-            batch=ImageFileCreateBatch(images=img_entries),
-        )
-        logger.info(
-            "Uploading images... Is batch success: %s",
-            upload_result.is_batch_successful,
-        )
-        for i, img_obj in enumerate(img_objs):
-            img_obj.customvision_id = upload_result.images[i].image.id
-            img_obj.remote_url = upload_result.images[i].image.original_image_uri
-            img_obj.uploaded = True
-            img_obj.save()
     logger.info("Uploading images... Done")
     logger.info("Has new images: %s", has_new_images)
     return has_new_images
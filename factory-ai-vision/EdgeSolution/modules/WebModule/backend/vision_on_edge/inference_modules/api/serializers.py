@@ -16,6 +16,8 @@ class InferenceModuleSerializer(serializers.ModelSerializer):
     device = serializers.CharField(required=False, read_only=True)
     upload_status = serializers.CharField(required=False, read_only=True)
     recommended_fps = serializers.FloatField(required=False, read_only=True)
+    status_updated_at = serializers.FloatField(required=False, read_only=True)
+    status_is_stale = serializers.BooleanField(required=False, read_only=True)
 
     class Meta:
         model = InferenceModule
@@ -22,6 +22,7 @@ class InferenceModulesConfig(AppConfig):
         if "runserver" in sys.argv:
             # pylint: disable= import-outside-toplevel
             from .models import InferenceModule
+            from .status import inference_module_status
 
             logger.info("App ready ready while running server")
             InferenceModule.objects.update_or_create(
@@ -31,4 +32,6 @@ class InferenceModulesConfig(AppConfig):
                 },
             )
 
+            inference_module_status.start()
+
             logger.info("App ready end while running server")
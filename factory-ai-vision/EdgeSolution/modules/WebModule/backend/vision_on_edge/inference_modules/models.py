@@ -3,10 +3,9 @@
 
 import logging
 
-import requests
 from django.db import models
 
-from ..azure_iot.utils import upload_module_url
+from .status import inference_module_status
 
 logger = logging.getLogger(__name__)
 
@@ -17,42 +16,30 @@ class InferenceModule(models.Model):
     name = models.CharField(max_length=200)
     url = models.CharField(max_length=1000, unique=True)
 
+    def get_status(self) -> dict:
+        """get_status.
+
+        Cached status, refreshed in the background by inference_module_status.
+        """
+        return inference_module_status.get(self.url)
+
     def recommended_fps(self) -> float:
-        try:
-            response = requests.get(
-                "http://" + self.url + "/get_recommended_total_fps", timeout=3
-            )
-            result = float(response.json()["fps"])
-        except Exception:
-            logger.exception(
-                "Get recommended_fps from inference module failed. Fallback to default."
-            )
-            result = 10.0
-        return result
-
-    def device(self) -> bool:
-        try:
-            response = requests.get("http://" + self.url + "/get_device", timeout=1)
-            result = response.json()["device"]
-            return result
-        except Exception:
-            return "cpu"
+        return self.get_status()["recommended_fps"]
+
+    def device(self) -> str:
+        return self.get_status()["device"]
 
     def is_vpu(self) -> bool:
-        try:
-            response = requests.get("http://" + self.url + "/get_device")
-            result = response.json()["device"]
-            return result == "vpu"
-        except Exception:
-            return False
+        return self.device() == "vpu"
 
     def upload_status(self) -> bool:
-        try:
-            response = requests.get("http://" + str(upload_module_url()) + "/status")
-            result = response.json()
-            return result == "ready"
-        except Exception:
-            return False
+        return self.get_status()["upload_status"]
+
+    def status_updated_at(self):
+        return self.get_status()["updated_at"]
+
+    def status_is_stale(self) -> bool:
+        return self.get_status()["is_stale"]
 
     def __str__(self):
         return self.name
@@ -0,0 +1,142 @@
+"""App status cache.
+
+Device, recommended fps and upload module status of every inference module
+are polled in the background and read from memory by the model, so API
+requests never wait for a module.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+
+from ..azure_iot.utils import upload_module_url
+
+logger = logging.getLogger(__name__)
+
+STATUS_POLL_INTERVAL = 30  # Seconds
+STATUS_REQUEST_TIMEOUT = 3  # Seconds
+# Older values are reported as stale
+STATUS_MAX_AGE = 3 * STATUS_POLL_INTERVAL
+
+DEFAULT_STATUS = {
+    "device": "cpu",
+    "recommended_fps": 10.0,
+    "upload_status": False,
+}
+
+
+def fetch_status(url: str) -> dict:
+    """fetch_status.
+
+    Ask the inference module and the upload module for their status.
+
+    Raises:
+        requests.exceptions.RequestException: a module is unreachable.
+    """
+    status = {}
+    response = requests.get(
+        "http://" + url + "/get_device", timeout=STATUS_REQUEST_TIMEOUT
+    )
+    status["device"] = response.json()["device"]
+    response = requests.get(
+        "http://" + url + "/get_recommended_total_fps", timeout=STATUS_REQUEST_TIMEOUT
+    )
+    status["recommended_fps"] = float(response.json()["fps"])
+    try:
+        response = requests.get(
+            "http://" + str(upload_module_url()) + "/status",
+            timeout=STATUS_REQUEST_TIMEOUT,
+        )
+        status["upload_status"] = response.json() == "ready"
+    except Exception:
+        status["upload_status"] = False
+    return status
+
+
+class InferenceModuleStatus:
+    """InferenceModuleStatus.
+
+    Last status of each inference module url, with freshness metadata:
+    updated_at (last successful poll), checked_at (last attempt) and the
+    error of the last attempt.
+    """
+
+    def __init__(self, interval=STATUS_POLL_INTERVAL, max_age=STATUS_MAX_AGE):
+        self.interval = interval
+        self.max_age = max_age
+        self.statuses = {}
+        self.mutex = threading.Lock()
+        self.wake = threading.Event()
+        self.worker = None
+
+    def start(self):
+        """start.
+
+        IMPORTANT, autoreloader will not reload threading,
+        please restart the server if you modify the thread.
+        """
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        # pylint: disable=import-outside-toplevel
+        from .models import InferenceModule
+
+        while True:
+            self.wake.clear()
+            for url in InferenceModule.objects.values_list("url", flat=True):
+                self.refresh(url)
+            self.wake.wait(self.interval)
+
+    def request_refresh(self):
+        """request_refresh.
+
+        Poll every module now, e.g. after a deployment.
+        """
+        self.wake.set()
+
+    def refresh(self, url: str) -> dict:
+        """refresh.
+
+        Poll one module. Values of a module that cannot be reached are kept
+        until they are stale.
+        """
+        now = time.time()
+        try:
+            values = fetch_status(url)
+            error = None
+        except Exception as err:
+            logger.warning("Get status of inference module %s failed: %s", url, err)
+            values = {}
+            error = str(err)
+        with self.mutex:
+            status = self.statuses.get(url) or dict(DEFAULT_STATUS, updated_at=None)
+            status = dict(status, checked_at=now, error=error, **values)
+            if error is None:
+                status["updated_at"] = now
+            self.statuses[url] = status
+            return status
+
+    def get(self, url: str) -> dict:
+        """get.
+
+        Cached status of the module, the defaults if it was never polled.
+        """
+        with self.mutex:
+            status = self.statuses.get(url)
+        if status is None:
+            self.request_refresh()
+            status = dict(DEFAULT_STATUS, updated_at=None, checked_at=None, error=None)
+        return dict(status, is_stale=self.is_stale(status))
+
+    def is_stale(self, status: dict) -> bool:
+        """is_stale."""
+        return (
+            status["updated_at"] is None
+            or status["updated_at"] + self.max_age < time.time()
+        )
+
+
+inference_module_status = InferenceModuleStatus()
@@ -0,0 +1,96 @@
+"""App status cache tests.
+"""
+
+from unittest import mock
+
+import pytest
+import requests
+
+from .. import status
+from ..status import InferenceModuleStatus
+
+pytestmark = pytest.mark.django_db
+
+
+def fake_get(url, timeout=None):
+    """Inference module and upload module answers."""
+    response = mock.MagicMock()
+    if url.endswith("/get_device"):
+        response.json.return_value = {"device": "vpu"}
+    elif url.endswith("/get_recommended_total_fps"):
+        response.json.return_value = {"fps": 24.5}
+    else:
+        response.json.return_value = "ready"
+    return response
+
+
+@pytest.fixture
+def module_status(monkeypatch):
+    cache = InferenceModuleStatus()
+    monkeypatch.setattr(status, "inference_module_status", cache)
+    monkeypatch.setattr(
+        "vision_on_edge.inference_modules.models.inference_module_status", cache
+    )
+    return cache
+
+
+def test_model_reads_cache(inference_module, module_status, monkeypatch):
+    """Model methods only read the cache."""
+    get = mock.MagicMock(side_effect=fake_get)
+    monkeypatch.setattr(status.requests, "get", get)
+    module_status.refresh(inference_module.url)
+    get.reset_mock()
+
+    assert inference_module.device() == "vpu"
+    assert inference_module.is_vpu()
+    assert inference_module.recommended_fps() == 24.5
+    assert inference_module.upload_status()
+    assert not inference_module.status_is_stale()
+    get.assert_not_called()
+
+
+def test_cold_cache(inference_module, module_status, monkeypatch):
+    """A module never polled gets the defaults and a refresh request."""
+    get = mock.MagicMock(side_effect=fake_get)
+    monkeypatch.setattr(status.requests, "get", get)
+
+    assert inference_module.recommended_fps() == 10.0
+    assert inference_module.device() == "cpu"
+    assert inference_module.status_is_stale()
+    assert module_status.wake.is_set()
+    get.assert_not_called()
+
+
+def test_unreachable_module(inference_module, module_status, monkeypatch):
+    """Last values are kept, and become stale."""
+    monkeypatch.setattr(status.requests, "get", mock.MagicMock(side_effect=fake_get))
+    module_status.refresh(inference_module.url)
+    monkeypatch.setattr(
+        status.requests,
+        "get",
+        mock.MagicMock(side_effect=requests.exceptions.ConnectionError("down")),
+    )
+
+    result = module_status.refresh(inference_module.url)
+    assert result["error"] == "down"
+    assert inference_module.device() == "vpu"
+    assert not inference_module.status_is_stale()
+
+    module_status.statuses[inference_module.url]["updated_at"] -= (
+        status.STATUS_MAX_AGE + 1
+    )
+    assert inference_module.status_is_stale()
+
+
+def test_serializer(inference_module, module_status, monkeypatch):
+    """The API exposes the cached values."""
+    # pylint: disable=import-outside-toplevel
+    from ..api.serializers import InferenceModuleSerializer
+
+    monkeypatch.setattr(status.requests, "get", mock.MagicMock(side_effect=fake_get))
+    module_status.refresh(inference_module.url)
+
+    data = InferenceModuleSerializer(inference_module).data
+    assert data["device"] == "vpu"
+    assert data["recommended_fps"] == 24.5
+    assert data["status_is_stale"] is False
@@ -39,3 +39,8 @@ class NotificationConsumer(JsonWebsocketConsumer):
         """websocket send"""
         logger.info("notification_send!")
         self.send_json(event)
+
+    def notification_batch(self, event):
+        """websocket send, notifications coalesced by NotificationBus"""
+        logger.info("notification_batch! %s", len(event["notifications"]))
+        self.send_json({"notifications": event["notifications"]})
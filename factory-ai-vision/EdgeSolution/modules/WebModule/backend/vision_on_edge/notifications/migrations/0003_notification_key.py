@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("notifications", "0002_auto_20200828_0746")]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="key",
+            field=models.CharField(
+                blank=True, db_index=True, default="", max_length=200
+            ),
+        )
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.8 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+def close_runs(apps, schema_editor):
+    """Notifications without key get NULL, duplicated keys keep the latest."""
+    Notification = apps.get_model("notifications", "Notification")
+    Notification.objects.filter(key="").update(key=None)
+    latest = {}
+    for notification in Notification.objects.exclude(key=None).order_by("id"):
+        previous = latest.get(notification.key)
+        if previous is not None:
+            Notification.objects.filter(pk=previous.pk).update(
+                key=f"{previous.key}-{previous.pk}"
+            )
+        latest[notification.key] = notification
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("notifications", "0003_notification_key")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="notification",
+            name="key",
+            field=models.CharField(
+                blank=True, db_index=True, default=None, max_length=200, null=True
+            ),
+        ),
+        migrations.RunPython(close_runs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="notification",
+            name="key",
+            field=models.CharField(
+                blank=True, default=None, max_length=200, null=True, unique=True
+            ),
+        ),
+    ]
@@ -21,6 +21,11 @@ class Notification(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=200)
     details = models.CharField(max_length=1000, blank=True, default="")
+    # progress updates of one run share one notification, the key of a
+    # finished run gets the notification id appended
+    key = models.CharField(
+        max_length=200, null=True, blank=True, default=None, unique=True
+    )
 
     def __str__(self):
         return " ".join(
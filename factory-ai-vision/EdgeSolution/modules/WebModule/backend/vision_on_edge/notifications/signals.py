@@ -3,46 +3,46 @@
 
 import logging
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from ..azure_pd_deploy_status import progress as deploy_progress
 from ..azure_pd_deploy_status.models import DeployStatus
+from ..azure_training_status import progress as training_progress
 from ..azure_training_status.models import TrainingStatus
 from .models import Notification
+from .utils import notification_bus
 
 logger = logging.getLogger(__name__)
 
+# statuses ending a training / deployment, the next one is a new run
+TRAINING_FINAL_STATUSES = {
+    training_progress.PROGRESS_0_OK["status"],
+    training_progress.PROGRESS_9_SUCCESS["status"],
+    training_progress.PROGRESS_10_NO_CHANGE["status"],
+    "Failed",
+}
+DEPLOY_FINAL_STATUSES = {
+    deploy_progress.PROGRESS_0_OK["status"],
+    deploy_progress.PROGRESS_0_FAILED["status"],
+}
+
 
 @receiver(signal=post_save, sender=Notification, dispatch_uid="send_to_websocket")
 def notification_post_save_websocket_handler(**kwargs):
     """notification_post_save_websocket_handler.
 
-    When there is a notification been save, push to channel
-    layer to send to websocket.
+    When there is a notification been save, queue it for the next
+    batch sent to websocket.
 
     Args:
         kwargs:
     """
 
     logger.info("notification_post_save...")
-    logger.info("Sending notifications...")
 
     instance = kwargs["instance"]
-    channels_layer = get_channel_layer()
-    async_to_sync(channels_layer.group_send)(
-        "notification",
-        {
-            "id": instance.id,
-            "type": "notification.send",
-            "notification_type": instance.notification_type,
-            "timestamp": str(instance.timestamp),
-            "sender": instance.sender,
-            "title": instance.title,
-            "details": instance.details,
-        },
-    )
+    notification_bus.send(instance)
 
 
 # @receiver(signal=pre_save,
@@ -83,11 +83,12 @@ def training_status_listener(**kwargs):
         logger.info(
             "instance.need_to_send_notification %s", instance.need_to_send_notification
         )
-        Notification.objects.create(
+        notification_bus.publish(
             notification_type="project",
-            sender="system",
             title=instance.status.capitalize(),
             details=instance.log.capitalize(),
+            key=f"project-{instance.project_id}",
+            final=instance.status in TRAINING_FINAL_STATUSES,
         )
     logger.info("Signal end")
 
@@ -108,9 +109,10 @@ def deploy_status_listener(**kwargs):
         logger.info(
             "instance.need_to_send_notification %s", instance.need_to_send_notification
         )
-        Notification.objects.create(
+        notification_bus.publish(
             notification_type="part_detection",
-            sender="system",
             title=instance.status.capitalize(),
             details=instance.log.capitalize(),
+            key=f"part_detection-{instance.part_detection_id}",
+            final=instance.status in DEPLOY_FINAL_STATUSES,
         )
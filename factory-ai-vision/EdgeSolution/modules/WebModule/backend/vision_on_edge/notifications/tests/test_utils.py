@@ -0,0 +1,121 @@
+"""App utilities tests.
+"""
+
+from datetime import timedelta
+
+import pytest
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.utils import timezone
+
+from ..models import Notification
+from ..utils import NOTIFICATION_GROUP, notification_bus, prune_notifications
+from .factories import NotificationFactory
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    """Shared bus, saved notifications are queued to it by post_save."""
+    monkeypatch.setattr(notification_bus, "window", 60)
+    monkeypatch.setattr(notification_bus, "last_flush", timezone.now().timestamp())
+    yield notification_bus
+    notification_bus.flush()
+
+
+def test_progress_updates_coalesced(bus):
+    """test_progress_updates_coalesced.
+
+    Progress updates with the same key in one window are written once and
+    sent in one websocket frame.
+    """
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(NOTIFICATION_GROUP, channel)
+
+    for progress in range(10):
+        bus.publish(
+            notification_type="project",
+            title="Training",
+            details=f"Progress {progress}",
+            key="project-1",
+        )
+    bus.publish(
+        notification_type="part_detection",
+        title="Deploying",
+        details="Progress 0",
+        key="part_detection-1",
+    )
+    assert Notification.objects.count() == 0
+    bus.flush()
+
+    assert Notification.objects.count() == 2
+    assert Notification.objects.get(key="project-1").details == "Progress 9"
+
+    event = async_to_sync(layer.receive)(channel)
+    assert event["type"] == "notification.batch"
+    assert [n["details"] for n in event["notifications"]] == [
+        "Progress 9",
+        "Progress 0",
+    ]
+
+    # Next updates of the same key replace the notification
+    bus.publish(
+        notification_type="project",
+        title="Done",
+        details="Training completed",
+        key="project-1",
+    )
+    bus.flush()
+    assert Notification.objects.filter(key="project-1").count() == 1
+    assert Notification.objects.get(key="project-1").title == "Done"
+    async_to_sync(layer.group_discard)(NOTIFICATION_GROUP, channel)
+
+
+def test_final_update_closes_run(bus):
+    """test_final_update_closes_run.
+
+    The final update of a run keeps its notification, the next run of the
+    same key gets a new one.
+    """
+    bus.publish(
+        notification_type="project", title="Training", details="", key="project-1"
+    )
+    bus.flush()
+    first = Notification.objects.get(key="project-1")
+
+    bus.publish(
+        notification_type="project",
+        title="Success",
+        details="Model trained",
+        key="project-1",
+        final=True,
+    )
+    # the next run starts within the same window
+    bus.publish(
+        notification_type="project",
+        title="Training",
+        details="Second run",
+        key="project-1",
+    )
+    bus.flush()
+
+    first.refresh_from_db()
+    assert (first.key, first.title) == (f"project-1-{first.id}", "Success")
+    second = Notification.objects.get(key="project-1")
+    assert second.id != first.id
+    assert second.details == "Second run"
+    assert Notification.objects.count() == 2
+
+
+def test_prune_notifications():
+    """test_prune_notifications."""
+    for _ in range(5):
+        NotificationFactory()
+    Notification.objects.filter(
+        id=Notification.objects.order_by("id").first().id
+    ).update(timestamp=timezone.now() - timedelta(days=30))
+
+    assert prune_notifications(days=7, count=3) == 2
+    assert Notification.objects.count() == 3
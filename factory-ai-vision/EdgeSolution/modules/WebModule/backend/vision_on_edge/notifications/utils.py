@@ -0,0 +1,197 @@
+"""App utilities.
+
+NotificationBus coalesces notifications before they reach the database and
+the websocket:
+
+- progress updates published with the same key within
+  NOTIFICATION_COALESCE_WINDOW are written once, with the latest state, to
+  the single row kept for that key. The final update of a run closes the
+  row, the next run starts a new one;
+- every notification saved within the window goes out in one websocket
+  frame;
+- stored notifications are pruned by age and count.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import connection
+from django.utils import timezone
+
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_GROUP = "notification"
+NOTIFICATION_COALESCE_WINDOW = float(
+    os.environ.get("NOTIFICATION_COALESCE_WINDOW", "1")
+)  # Seconds
+NOTIFICATION_RETENTION_DAYS = 7
+NOTIFICATION_RETENTION_COUNT = 200
+NOTIFICATION_PRUNE_INTERVAL = 60  # Seconds
+
+
+def notification_to_event(instance: Notification) -> dict:
+    """notification_to_event.
+
+    Websocket payload of a notification.
+    """
+    return {
+        "id": instance.id,
+        "notification_type": instance.notification_type,
+        "timestamp": str(instance.timestamp),
+        "sender": instance.sender,
+        "title": instance.title,
+        "details": instance.details,
+    }
+
+
+def prune_notifications(
+    days=NOTIFICATION_RETENTION_DAYS, count=NOTIFICATION_RETENTION_COUNT
+) -> int:
+    """prune_notifications.
+
+    Delete notifications older than days, then all but the latest count.
+
+    Returns:
+        int: number of deleted notifications.
+    """
+    deleted, _ = Notification.objects.filter(
+        timestamp__lt=timezone.now() - timedelta(days=days)
+    ).delete()
+    expired_ids = list(
+        Notification.objects.order_by("-timestamp", "-id").values_list("id", flat=True)[
+            count:
+        ]
+    )
+    if expired_ids:
+        deleted += Notification.objects.filter(id__in=expired_ids).delete()[0]
+    return deleted
+
+
+class NotificationBus:
+    """NotificationBus.
+
+    The first call in a quiet period is flushed right away, later ones
+    within the window wait for one trailing flush.
+    """
+
+    def __init__(self, window=NOTIFICATION_COALESCE_WINDOW):
+        self.window = window
+        self.mutex = threading.Lock()
+        self.flush_mutex = threading.Lock()
+        self.writes = OrderedDict()
+        # final updates replaced by the next run within the window
+        self.closed = []
+        self.events = OrderedDict()
+        self.timer = None
+        self.flushing_thread = None
+        self.last_flush = 0
+        self.last_prune = time.time()
+
+    def publish(
+        self, notification_type, title, details, key, sender="system", final=False
+    ):
+        """publish.
+
+        Store a progress update, replacing the pending one with the same
+        key. final ends the run of key, its notification is kept as is.
+        """
+        with self.mutex:
+            pending = self.writes.pop(key, None)
+            if pending is not None and pending["final"]:
+                self.closed.append((key, pending))
+            self.writes[key] = {
+                "notification_type": notification_type,
+                "sender": sender,
+                "title": title,
+                "details": details,
+                "final": final,
+            }
+        self._schedule()
+
+    def send(self, instance: Notification):
+        """send.
+
+        Queue a saved notification for the next websocket frame.
+        """
+        with self.mutex:
+            self.events.pop(instance.id, None)
+            self.events[instance.id] = notification_to_event(instance)
+        self._schedule()
+
+    def _schedule(self):
+        with self.mutex:
+            # saved by flush itself, sent by the same flush
+            if self.timer is not None:
+                return
+            if self.flushing_thread == threading.get_ident():
+                return
+            delay = self.last_flush + self.window - time.time()
+            if delay > 0:
+                self.timer = threading.Timer(delay, self._trailing_flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.flush()
+
+    def _trailing_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Notification flush failed")
+        finally:
+            connection.close()
+
+    def flush(self):
+        """flush.
+
+        Write the pending progress updates, send every pending notification
+        in one frame and prune old ones.
+        """
+        with self.flush_mutex:
+            with self.mutex:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.last_flush = time.time()
+                self.flushing_thread = threading.get_ident()
+                writes = self.closed + list(self.writes.items())
+                self.closed = []
+                self.writes.clear()
+
+            try:
+                # post_save queues the notifications in self.events
+                for key, values in writes:
+                    values = dict(values)
+                    final = values.pop("final")
+                    obj, _ = Notification.objects.update_or_create(
+                        key=key, defaults=values
+                    )
+                    if final:
+                        Notification.objects.filter(pk=obj.pk).update(
+                            key=f"{key}-{obj.pk}"
+                        )
+            finally:
+                with self.mutex:
+                    self.flushing_thread = None
+                    events = list(self.events.values())
+                    self.events.clear()
+            if events:
+                async_to_sync(get_channel_layer().group_send)(
+                    NOTIFICATION_GROUP,
+                    {"type": "notification.batch", "notifications": events},
+                )
+
+            if time.time() > self.last_prune + NOTIFICATION_PRUNE_INTERVAL:
+                self.last_prune = time.time()
+                prune_notifications()
+
+
+notification_bus = NotificationBus()
@@ -30,7 +30,7 @@ from ..exceptions import (
     StreamPartIdNotFound,
     StreamRtspCameraNotFound,
 )
-from ..models import Stream, StreamManager
+from ..models import PREVIEW_SCALE, Stream, StreamManager
 from .serializers import (
     StreamCaptureResponseSerializer,
     StreamConnectResponseSerializer,
@@ -116,12 +116,20 @@ def disconnect_stream(request, stream_id):
 
 
 def video_feed(request, stream_id):
-    """video feed"""
+    """video feed
+
+    The optional scale query parameter (0.1 to 1) resizes the frames.
+    """
 
     stream = stream_manager.get_stream_by_id(stream_id)
     if stream:
+        try:
+            scale = min(1.0, max(0.1, float(request.GET.get("scale", PREVIEW_SCALE))))
+        except ValueError:
+            scale = PREVIEW_SCALE
         return StreamingHttpResponse(
-            stream.gen(), content_type="multipart/x-mixed-replace;boundary=frame"
+            stream.gen(scale=scale),
+            content_type="multipart/x-mixed-replace;boundary=frame",
         )
 
     return HttpResponse(
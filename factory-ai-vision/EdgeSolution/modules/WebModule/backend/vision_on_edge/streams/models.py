@@ -17,12 +17,185 @@ logger = logging.getLogger(__name__)
 # Stream
 KEEP_ALIVE_THRESHOLD = 10  # Seconds
 
+# Preview
+PREVIEW_SCALE = 0.5
+PREVIEW_MAX_FPS = 30
+PREVIEW_FRAME_TIMEOUT = 5  # Seconds
+
 # Stream Manager
 STREAM_GC_TIME_THRESHOLD = 5  # Seconds
 
 
+class PreviewSource:
+    """PreviewSource.
+
+    One decoder shared by every viewer of a camera. Each frame is encoded
+    once, at the lowest scale asked by a viewer, and handed to all of them.
+    last_img keeps the frame at PREVIEW_SCALE, as captures expect. The
+    decoder stops when the last viewer leaves, then calls on_stop.
+    """
+
+    def __init__(self, rtsp, on_stop=None):
+        self.rtsp = rtsp
+        self.on_stop = on_stop
+        self.cond = threading.Condition()
+        self.subscribers = {}
+        self.is_running = False
+        self.has_error = False
+        self.seq = 0
+        self.last_img = None
+        self.last_jpg = None
+
+    def subscribe(self, token, scale):
+        """subscribe.
+
+        Start the decoder on the first viewer.
+        """
+        with self.cond:
+            self.subscribers[token] = scale
+            if not self.is_running:
+                self.is_running = True
+                self.has_error = False
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def unsubscribe(self, token):
+        with self.cond:
+            self.subscribers.pop(token, None)
+            self.cond.notify_all()
+
+    def wait_frame(self, seq, timeout=PREVIEW_FRAME_TIMEOUT):
+        """wait_frame.
+
+        Wait for a frame newer than seq.
+
+        Returns:
+            (seq, jpg, img), jpg and img are None on timeout.
+        """
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.seq != seq or self.has_error, timeout=timeout
+            )
+            if self.seq == seq:
+                return seq, None, None
+            return self.seq, self.last_jpg, self.last_img
+
+    def _run(self):
+        logger.info("Start decoding %s.", self.rtsp)
+        try:
+            self._decode()
+        except Exception:
+            logger.exception("Decoding %s failed.", self.rtsp)
+            with self.cond:
+                self.is_running = False
+                self.has_error = True
+                self.cond.notify_all()
+        logger.info("%s decoder released.", self.rtsp)
+        if self.on_stop:
+            self.on_stop(self)
+
+    def _decode(self):
+        cap = cv2.VideoCapture(self.rtsp)
+        try:
+            while True:
+                with self.cond:
+                    if not cap.isOpened():
+                        self.has_error = True
+                    if not self.subscribers or self.has_error:
+                        self.is_running = False
+                        self.cond.notify_all()
+                        return
+                    scale = min(self.subscribers.values())
+                time_begin = time.time()
+                has_img, img = cap.read()
+                # Need to add the video flag FIXME
+                if not has_img:
+                    cap.release()
+                    cap = cv2.VideoCapture(self.rtsp)
+                    time.sleep(1)
+                    continue
+
+                last_img = cv2.resize(img, None, fx=PREVIEW_SCALE, fy=PREVIEW_SCALE)
+                if scale != PREVIEW_SCALE:
+                    img = cv2.resize(img, None, fx=scale, fy=scale)
+                else:
+                    img = last_img
+                jpg = cv2.imencode(".jpg", img)[1].tobytes()
+                with self.cond:
+                    self.seq += 1
+                    self.last_img = last_img
+                    self.last_jpg = jpg
+                    self.cond.notify_all()
+                time.sleep(max(0, 1 / PREVIEW_MAX_FPS - (time.time() - time_begin)))
+        finally:
+            cap.release()
+
+
+class PreviewHub:
+    """PreviewHub.
+
+    Preview sources keyed by camera. A source stays until its decoder
+    stopped, so a viewer coming back meanwhile reuses the running decoder.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self.mutex = threading.Lock()
+
+    def subscribe(self, camera_id, rtsp, token, scale) -> PreviewSource:
+        """subscribe."""
+        with self.mutex:
+            source = self.sources.get((camera_id, rtsp))
+            if source is None:
+                source = PreviewSource(
+                    rtsp, on_stop=lambda source: self._remove(camera_id, rtsp, source)
+                )
+                self.sources[(camera_id, rtsp)] = source
+            source.subscribe(token, scale)
+            return source
+
+    def unsubscribe(self, camera_id, rtsp, token):
+        """unsubscribe."""
+        with self.mutex:
+            source = self.sources.get((camera_id, rtsp))
+        if source is not None:
+            source.unsubscribe(token)
+            # already stopped after a decoding error
+            self._remove(camera_id, rtsp, source)
+
+    def _remove(self, camera_id, rtsp, source):
+        """_remove.
+
+        Forget a stopped source, unless a viewer subscribed again.
+        """
+        with self.mutex:
+            if self.sources.get((camera_id, rtsp)) is not source:
+                return
+            with source.cond:
+                if source.is_running or source.subscribers:
+                    return
+            del self.sources[(camera_id, rtsp)]
+
+    def get_last_img(self, camera_id, rtsp):
+        """get_last_img.
+
+        Last frame decoded for the camera, None if nobody watches it.
+        """
+        with self.mutex:
+            source = self.sources.get((camera_id, rtsp))
+        if source is None:
+            return None
+        with source.cond:
+            return source.last_img
+
+
+preview_hub = PreviewHub()
+
+
 class Stream:
-    """Stream Class"""
+    """Stream Class
+
+    A viewer of a camera, frames come from the shared preview_hub.
+    """
 
     def __init__(self, rtsp, camera_id, part_id=None):
         self.rtsp = normalize_rtsp(rtsp=rtsp)
@@ -35,45 +208,51 @@ class Stream:
         self.last_get_img_index = 1
         self.id = id(self)
 
-        # test rtsp
-        if not verify_rtsp(self.rtsp):
-            raise StreamOpenRTSPError
-        self.cap = cv2.VideoCapture(self.rtsp)
-        self.last_img = self.cap.read()[1]
+        # another viewer already decodes the camera
+        self.last_img = preview_hub.get_last_img(self.camera_id, self.rtsp)
+        if self.last_img is None:
+            # test rtsp
+            if not verify_rtsp(self.rtsp):
+                raise StreamOpenRTSPError
+            cap = cv2.VideoCapture(self.rtsp)
+            self.last_img = cap.read()[1]
+            cap.release()
 
     def update_keep_alive(self):
         """update_keep_alive."""
         self.last_active = time.time()
 
-    def gen(self):
-        """generator for stream."""
+    def gen(self, scale=PREVIEW_SCALE):
+        """generator for stream.
+
+        Args:
+            scale (float): resize factor of the frames, viewers of a camera
+                get the lowest one asked.
+        """
         self.status = "running"
 
         logger.info("Start streaming with %s.", self.rtsp)
-        while self.status == "running" and (
-            self.last_active + KEEP_ALIVE_THRESHOLD > time.time()
-        ):
-            if not self.cap.isOpened():
-                raise StreamOpenRTSPError
-            has_img, img = self.cap.read()
-            # Need to add the video flag FIXME
-            if not has_img:
-                self.cap = cv2.VideoCapture(self.rtsp)
-                time.sleep(1)
-                continue
-
-            img = cv2.resize(img, None, fx=0.5, fy=0.5)
-            self.last_active = time.time()
-            self.last_img = img.copy()
-            self.cur_img_index = (self.cur_img_index + 1) % 10000
-            yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n"
-                + cv2.imencode(".jpg", img)[1].tobytes()
-                + b"\r\n"
-            )
-        self.cap.release()
-        logger.info("%s cap released.", self)
+        source = preview_hub.subscribe(self.camera_id, self.rtsp, self.id, scale)
+        seq = 0
+        try:
+            while self.status == "running" and (
+                self.last_active + KEEP_ALIVE_THRESHOLD > time.time()
+            ):
+                seq, jpg, img = source.wait_frame(seq)
+                if source.has_error:
+                    raise StreamOpenRTSPError
+                if jpg is None:
+                    continue
+
+                self.last_active = time.time()
+                self.last_img = img
+                self.cur_img_index = (self.cur_img_index + 1) % 10000
+                yield (
+                    b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + jpg + b"\r\n"
+                )
+        finally:
+            preview_hub.unsubscribe(self.camera_id, self.rtsp, self.id)
+            logger.info("%s unsubscribed.", self)
 
     def get_frame(self):
         """get_frame."""
@@ -112,30 +291,19 @@ class StreamManager:
     """StreamManager"""
 
     def __init__(self):
-        self.streams = []
+        self.streams = {}
         self.mutex = threading.Lock()
         self.gc()
 
     def add(self, stream: Stream):
         """add stream"""
-        self.mutex.acquire()
-        self.streams.append(stream)
-        self.mutex.release()
+        with self.mutex:
+            self.streams[stream.id] = stream
 
     def get_stream_by_id(self, stream_id):
         """get_stream_by_id"""
-
-        self.mutex.acquire()
-
-        for i in range(len(self.streams)):
-            stream = self.streams[i]
-            if stream.id == stream_id:
-
-                self.mutex.release()
-                return stream
-
-        self.mutex.release()
-        return None
+        with self.mutex:
+            return self.streams.get(stream_id)
 
     def gc(self):
         """Garbage collector
@@ -148,9 +316,9 @@ class StreamManager:
             while True:
                 self.mutex.acquire()
                 if PRINT_THREAD:
-                    logger.info("streams: %s", self.streams)
+                    logger.info("streams: %s", list(self.streams.values()))
                 to_delete = []
-                for stream in self.streams:
+                for stream in self.streams.values():
                     if stream.last_active + STREAM_GC_TIME_THRESHOLD < time.time():
 
                         # stop the inactive stream
@@ -164,7 +332,7 @@ class StreamManager:
                         to_delete.append(stream)
 
                 for stream in to_delete:
-                    self.streams.remove(stream)
+                    del self.streams[stream.id]
 
                 self.mutex.release()
                 time.sleep(3)
@@ -5,10 +5,12 @@
 
 import time
 
+import cv2
+import numpy as np
 import pytest
 
 from ...cameras.tests.factories import CameraFactory
-from ..models import Stream
+from ..models import PREVIEW_SCALE, Stream, StreamManager, preview_hub
 
 pytestmark = pytest.mark.django_db
 
@@ -144,3 +146,68 @@ def test_method_stop(camera):
     assert stream_obj.status == "running"
     stream_obj.close()
     assert stream_obj.status == "stopped"
+
+
+@pytest.mark.fast
+def test_viewers_share_decoder(camera):
+    """Viewers of a camera share one decoder and one encoded frame."""
+    stream1 = Stream(rtsp=camera.rtsp, camera_id=camera.id)
+    width = stream1.last_img.shape[1]
+    gen1 = stream1.gen(scale=0.5)
+    next(gen1)
+    decoders = cv2.VideoCapture.call_count
+
+    stream2 = Stream(rtsp=camera.rtsp, camera_id=camera.id)
+    gen2 = stream2.gen(scale=0.25)
+    frame2 = next(gen2)
+    assert cv2.VideoCapture.call_count == decoders
+    source = preview_hub.sources[(camera.id, stream1.rtsp)]
+    assert len(source.subscribers) == 2
+
+    # the next frames are encoded at the lowest scale asked
+    seq = source.seq
+    while source.seq <= seq:
+        frame2 = next(gen2)
+    jpg = frame2.split(b"\r\n\r\n", 1)[1][:-2]
+    img = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+    assert img.shape[1] == int(width * 0.25)
+    # captures still get the frame at the preview scale
+    assert stream2.last_img.shape[1] == int(width * PREVIEW_SCALE)
+
+    gen1.close()
+    assert len(source.subscribers) == 1
+    gen2.close()
+    with source.cond:
+        assert source.cond.wait_for(lambda: not source.is_running, timeout=3)
+    deadline = time.time() + 3
+    while (camera.id, stream1.rtsp) in preview_hub.sources:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.fast
+def test_viewer_reuses_stopping_decoder(camera):
+    """A viewer coming back before the decoder stopped reuses it."""
+    stream1 = Stream(rtsp=camera.rtsp, camera_id=camera.id)
+    gen1 = stream1.gen()
+    next(gen1)
+    source = preview_hub.sources[(camera.id, stream1.rtsp)]
+    with source.cond:
+        # hold the decoder before it sees the last viewer left
+        gen1.close()
+        assert source.is_running
+        stream2 = Stream(rtsp=camera.rtsp, camera_id=camera.id)
+        gen2 = stream2.gen()
+        next(gen2)
+        assert preview_hub.sources[(camera.id, stream1.rtsp)] is source
+    gen2.close()
+
+
+@pytest.mark.fast
+def test_stream_manager_lookup(camera):
+    """Streams are found by id."""
+    stream_manager = StreamManager()
+    stream_obj = Stream(rtsp=camera.rtsp, camera_id=camera.id)
+    stream_manager.add(stream_obj)
+    assert stream_manager.get_stream_by_id(stream_obj.id) is stream_obj
+    assert stream_manager.get_stream_by_id(0) is None
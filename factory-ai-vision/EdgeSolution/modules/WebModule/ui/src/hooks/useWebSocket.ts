@@ -14,14 +14,18 @@ export const useWebSocket = (): void => {
 
     ws.onmessage = ({ data }): void => {
       const deSerializedData = JSON.parse(data);
+      // Notifications coalesced by the server come in one batch
+      const notifications = deSerializedData.notifications || [deSerializedData];
 
-      // For camera create setting
-      if (deSerializedData.notification_type === 'upload') {
-        alert(deSerializedData.details);
-        window.location.reload();
-      }
+      notifications.forEach((notification) => {
+        // For camera create setting
+        if (notification.notification_type === 'upload') {
+          alert(notification.details);
+          window.location.reload();
+        }
 
-      dispatch(receiveNotification(deSerializedData));
+        dispatch(receiveNotification(notification));
+      });
     };
 
     ws.onerror = (evt): void => {
@@ -50,7 +50,7 @@ const slice = createSlice({
   initialState: entityAdapter.getInitialState(),
   reducers: {
     receiveNotification: (state, action) => {
-      entityAdapter.addOne(state, getNormalizeNotification(action.payload, true));
+      entityAdapter.upsertOne(state, getNormalizeNotification(action.payload, true));
     },
     openNotificationPanel: (state) => {
       state.ids.forEach((id) => {